@@ -0,0 +1,730 @@
+import math
+import numpy as np
+from scipy import sparse
+
+import core.nuc_util as util
+
+# #   Globals  # #
+
+BALANCE_TOL = 1e-3       # Max. relative deviation of balanced row sums from their mean
+BALANCE_MAX_ITER = 500
+EXPT_BLOCK_SIZE = 2**20  # Max. matrix elements of expected values made at once
+
+# #   Sparse contact matrices  # #
+
+def get_pair_matrix(mat, off_a, lim_a, off_b, lim_b, is_cis):
+  """
+  Get a chromosome pair contact matrix as a float COO sparse matrix that spans whole chromosomes
+  from the first bin, i.e. moved by the bin offsets and limited to the bin ranges.
+  Cis matrices have the diagonal removed and are made symmetric if only one triangle is stored.
+  """
+
+  mat = sparse.coo_matrix(mat)
+  rows = mat.row.astype(np.int64) + off_a
+  cols = mat.col.astype(np.int64) + off_b
+  data = mat.data.astype(float)
+
+  idx = (rows < lim_a) & (cols < lim_b) & (data != 0)
+
+  if is_cis:
+    idx &= rows != cols
+
+  mat = sparse.coo_matrix((data[idx], (rows[idx], cols[idx])), shape=(lim_a, lim_b))
+
+  if is_cis:
+    mat.sum_duplicates()
+    csr = mat.tocsr()
+
+    if not np.all(csr.diagonal(1) == csr.diagonal(-1)): # Not symmetric
+      mat = (csr + csr.T).tocoo()
+
+  return mat
+
+
+def get_marginals(mat):
+  """
+  Row and column sums of a sparse or dense matrix, without making dense intermediates
+  """
+
+  mat = sparse.coo_matrix(mat)
+  rows = np.bincount(mat.row, weights=mat.data, minlength=mat.shape[0])
+  cols = np.bincount(mat.col, weights=mat.data, minlength=mat.shape[1])
+
+  return rows, cols
+
+
+def scale_matrix(mat, scale_a, scale_b):
+  """
+  Scale a COO matrix, in place, by row and column vectors i.e. as by np.outer(scale_a, scale_b)
+  """
+
+  mat.data *= scale_a[mat.row] * scale_b[mat.col]
+
+  return mat
+
+
+def downsample_matrix(mat, new_shape):
+  """
+  Sparse equivalent of nuc_util.downsample_matrix: sum bins into the new shape, padding as required.
+  """
+
+  p, q = mat.shape
+  n, m = new_shape
+
+  if (p,q) == (n,m):
+    return mat
+
+  mat = sparse.coo_matrix(mat)
+  rows = mat.row // int(math.ceil(p/float(n)))
+  cols = mat.col // int(math.ceil(q/float(m)))
+  mat = sparse.coo_matrix((mat.data, (rows, cols)), shape=(n, m))
+  mat.sum_duplicates()
+
+  return mat
+
+
+def get_balance_scales(matrix_dict, chromo_scales, tol=BALANCE_TOL, max_iter=BALANCE_MAX_ITER):
+  """
+  Iterative correction (ICE) matrix balancing over several chromosome pair COO matrices, which
+  includes full, symmetric cis matrices. Gives per-chromosome scaling vectors such that each
+  M_ij * scale_i * scale_j has near uniform row sums. Initial scales with zeros mark excluded bins.
+  """
+
+  scales = {chromo:(chromo_scales[chromo] > 0).astype(float) for chromo in chromo_scales}
+
+  for i in range(max_iter):
+    row_sums = {chromo:np.zeros(len(scales[chromo])) for chromo in scales}
+
+    for (chr_a, chr_b), mat in matrix_dict.items():
+      n = len(scales[chr_a])
+      m = len(scales[chr_b])
+      vals = mat.data * scales[chr_a][mat.row] * scales[chr_b][mat.col]
+      row_sums[chr_a] += np.bincount(mat.row, weights=vals, minlength=n)
+
+      if chr_a != chr_b:
+        row_sums[chr_b] += np.bincount(mat.col, weights=vals, minlength=m)
+
+    all_sums = np.concatenate([row_sums[chromo] for chromo in sorted(row_sums)])
+    all_sums = all_sums[all_sums > 0]
+
+    if not len(all_sums):
+      break
+
+    mean = all_sums.mean()
+    dev = np.abs(all_sums/mean - 1.0).max()
+
+    for chromo in scales:
+      corr = row_sums[chromo]/mean
+      corr[corr == 0] = 1.0
+      scales[chromo] /= np.sqrt(corr) # Damped, symmetric update avoids oscillation
+
+    if dev < tol:
+      break
+
+  else:
+    util.warn('Matrix balancing did not converge after {:,} iterations; max. deviation {:.3g}'.format(max_iter, dev))
+
+  return scales
+
+
+def normalize_contacts(contact_dict, chromo_limits, bin_size, new_chromo_limits=None,
+                       new_bin_size=None, compare_trans=False, clip=0.1, store_sparse=True,
+                       balance=False, tol=BALANCE_TOL, max_iter=BALANCE_MAX_ITER):
+  """
+  Normalise chromosome pair contact matrices, in place, using sparse matrices throughout.
+  All pairs are placed on the full bin range of the (new) chromosome limits and bins with
+  extreme total counts, relative to the median, are removed. By default each pair is scaled by
+  the reciprocal of the square root of its row and column totals. If balance is set, iterative
+  correction is used instead, over all the normalised pairs, until the row sums deviate by
+  less than tol. Each pair is then scaled so that its mean non-void bin count is one or, if
+  balanced, all pairs are scaled by one factor so that their overall mean is one.
+  """
+
+  if not new_bin_size:
+    new_bin_size = bin_size
+
+  if not new_chromo_limits:
+    new_chromo_limits = chromo_limits
+
+  chromo_sizes = {}
+  contact_scale = {}
+  chromo_offsets = {}
+
+  chromos = sorted(new_chromo_limits) # contact dict pair keys will always be in alphabetic order
+
+  for chr_a in chromos:
+    s, e = chromo_limits[chr_a]
+    off = int(s/bin_size) # Offset in the original data
+    chromo_offsets[chr_a] = off
+
+    s2, e2 = new_chromo_limits[chr_a] # Range in new data
+    num_bins = int(math.ceil(e2/bin_size))
+    contact_scale[chr_a] = np.zeros(num_bins, float) # Always start from zero
+    chromo_sizes[chr_a] = num_bins
+
+  # Get row sums over whole map
+
+  util.info(' .. fetch scalings', line_return=True)
+  pairs = []
+
+  for k, chr_a in enumerate(chromos):
+    for chr_b in chromos[k:]:
+      pair = (chr_a, chr_b)
+
+      if pair not in contact_dict:
+        continue
+
+      pairs.append(pair)
+      off_a = chromo_offsets[chr_a]
+      off_b = chromo_offsets[chr_b]
+
+      # Matrix can exceed the new chromo limits
+      sums_a, sums_b = get_marginals(contact_dict[pair])
+      sums_a = sums_a[:max(0, len(contact_scale[chr_a])-off_a)]
+      sums_b = sums_b[:max(0, len(contact_scale[chr_b])-off_b)]
+
+      contact_scale[chr_a][off_a:off_a+len(sums_a)] += sums_a
+      contact_scale[chr_b][off_b:off_b+len(sums_b)] += sums_b
+
+  # Make reciprocal and remove void regions
+
+  for chr_a in contact_scale:
+    scale = contact_scale[chr_a]
+    med = np.median(scale)
+
+    too_small = scale < (clip*med)
+    too_large = scale > (med/clip)
+
+    scale[scale == 0] = 1.0
+    scale = 1.0/scale
+
+    scale[too_small] = 0.0
+    scale[too_large] = 0.0
+
+    contact_scale[chr_a] = scale
+
+  matrix_dict = {}
+
+  for chr_a, chr_b in pairs: # Sorted and available
+    is_cis = chr_a == chr_b
+
+    if (not compare_trans) and (not is_cis):
+      del contact_dict[(chr_a, chr_b)]
+      continue
+
+    matrix_dict[(chr_a, chr_b)] = get_pair_matrix(contact_dict[(chr_a, chr_b)],
+                                                  chromo_offsets[chr_a], chromo_sizes[chr_a],
+                                                  chromo_offsets[chr_b], chromo_sizes[chr_b], is_cis)
+
+  if balance:
+    util.info(' .. balancing', line_return=True)
+    contact_scale = get_balance_scales(matrix_dict, contact_scale, tol, max_iter)
+
+  else:
+    contact_scale = {chr_a:np.sqrt(contact_scale[chr_a]) for chr_a in contact_scale}
+
+  pair_nnz = {}
+  pair_sums = {}
+
+  for (chr_a, chr_b), mat in matrix_dict.items():
+    scale_a = contact_scale[chr_a]
+    scale_b = contact_scale[chr_b]
+    scale_matrix(mat, scale_a, scale_b)
+    pair_nnz[(chr_a, chr_b)] = np.count_nonzero(scale_a) * np.count_nonzero(scale_b)
+    pair_sums[(chr_a, chr_b)] = mat.data.sum()
+
+  if balance: # One factor for all pairs, so the balance between them is kept
+    total = sum(pair_sums.values())
+    global_factor = sum(pair_nnz.values())/total if total else 0.0
+
+  for chr_a, chr_b in sorted(matrix_dict):
+    is_cis = chr_a == chr_b
+    util.info(' .. {} {}   '.format(chr_a, chr_b), line_return=True)
+
+    mat = matrix_dict.pop((chr_a, chr_b))
+    msum = pair_sums[(chr_a, chr_b)]
+
+    if not msum:
+      continue
+
+    if balance:
+      mat.data *= global_factor
+    else:
+      mat.data *= pair_nnz[(chr_a, chr_b)]/msum # The counts scale with the chromosome sizes
+    mat.data = mat.data.astype(np.float32)
+
+    if new_bin_size > bin_size: # i.e. do nothing if smaller or equal (smaller is not valid)
+      ratio = bin_size / float(new_bin_size)
+      a, b = mat.shape
+      p = int(math.ceil(a * ratio))
+      q = int(math.ceil(b * ratio))
+      mat = downsample_matrix(mat, (p, q))
+
+    if not store_sparse:
+      mat = mat.toarray()
+    elif is_cis:
+      mat = mat.tocsr()
+
+    contact_dict[(chr_a, chr_b)] = mat
+
+  util.info(' .. normalised {} chromosomes/pairs'.format(len(pairs)), line_return=True)
+
+
+# #   Expected contacts  # #
+
+def get_distance_profile(obs):
+  """
+  Mean contact value for each sequence separation, i.e. diagonal offset, of a square cis matrix,
+  dense or sparse, as given by the upper triangle. The main diagonal value is set to zero.
+  """
+
+  n = obs.shape[0]
+
+  if sparse.issparse(obs):
+    mat = sparse.coo_matrix(obs)
+    seps = mat.col.astype(np.int64) - mat.row
+    idx = seps > 0
+    sep_sig = np.bincount(seps[idx], weights=mat.data[idx], minlength=n).astype(float)
+
+  else:
+    sep_sig = np.zeros(n, float)
+
+    for d in range(1, n):
+      sep_sig[d] = obs.diagonal(d).sum() # A view; no copy
+
+  sep_sig[1:] /= np.arange(n-1, 0, -1)
+  sep_sig[0] = 0.0
+
+  return sep_sig
+
+
+def get_cis_expectation_factors(obs):
+  """
+  Factors of the expected contacts of a square cis matrix, with its main diagonal excluded, given
+  the distance-decay profile and the coverage: expt[i,j] = scale * sep_sig[|i-j|] * vals[i] * vals[j].
+  The scale makes the expected total equal the observed total.
+  """
+
+  from scipy.signal import fftconvolve
+
+  n = obs.shape[0]
+  sep_sig = get_distance_profile(obs)
+
+  if sparse.issparse(obs):
+    mat = sparse.coo_matrix(obs)
+    idx = mat.row != mat.col
+    sobs = mat.data[idx].sum()
+    vals = np.bincount(mat.col[idx], weights=mat.data[idx], minlength=n).astype(float)
+
+  else:
+    sobs = obs.sum() - np.trace(obs)
+    vals = obs.sum(axis=0).astype(float) - obs.diagonal()
+
+  vals /= vals.sum() or 1.0
+
+  # Expected total over all diagonals, from the autocorrelation of the coverage
+
+  if n > 1:
+    auto_corr = fftconvolve(vals, vals[::-1])[n:]
+    total = 2.0 * np.dot(sep_sig[1:], auto_corr)
+  else:
+    total = 0.0
+
+  scale = sobs/total if total else 0.0
+
+  return sep_sig, vals, scale
+
+
+def _get_expectation_block(sep_sig, vals_a, vals_b, scale, row_start, row_end):
+  """
+  Expected contacts for a range of matrix rows; cis if a distance profile is given, otherwise trans
+  """
+
+  rows = np.arange(row_start, row_end)
+
+  if sep_sig is None:
+    expt = np.ones((len(rows), len(vals_b)))
+  else:
+    seps = np.abs(rows[:,None] - np.arange(len(vals_b))[None,:])
+    expt = sep_sig[seps]
+
+  expt *= vals_a[row_start:row_end,None]
+  expt *= vals_b[None,:]
+  expt *= scale
+
+  return expt
+
+
+def _divide_expected(obs, factors, log=True, clip=None):
+  """
+  Observed/expected contacts, or their log, computed in row blocks so that no full expectation
+  matrix is made. Where either value is zero the observed value is kept.
+  """
+
+  sep_sig, vals_a, vals_b, scale = factors
+
+  if sparse.issparse(obs):
+    mat = sparse.coo_matrix(obs)
+    rows = mat.row.astype(np.int64)
+    cols = mat.col.astype(np.int64)
+    data = mat.data.astype(float)
+
+    if sep_sig is None:
+      expt = np.ones(len(data))
+    else:
+      idx = rows != cols
+      rows, cols, data = rows[idx], cols[idx], data[idx]
+      expt = sep_sig[np.abs(cols-rows)]
+
+    expt *= scale * vals_a[rows] * vals_b[cols]
+    nz = (expt * data) != 0.0
+    data[nz] /= expt[nz]
+
+    if log:
+      data[nz] = np.log(data[nz])
+
+    if clip is not None:
+      data = np.clip(data, -clip, clip)
+
+    return sparse.coo_matrix((data, (rows, cols)), shape=obs.shape)
+
+  n, m = obs.shape
+  dtype = obs.dtype if np.issubdtype(obs.dtype, np.floating) else float
+  ratio = np.array(obs, dtype)
+  block_rows = max(1, EXPT_BLOCK_SIZE // max(m, 1))
+
+  for i in range(0, n, block_rows):
+    j = min(n, i+block_rows)
+    expt = _get_expectation_block(sep_sig, vals_a, vals_b, scale, i, j)
+    block = ratio[i:j]
+    nz = (expt * block) != 0.0
+    block[nz] /= expt[nz]
+
+    if log:
+      block[nz] = np.log(block[nz])
+
+    if clip is not None:
+      np.clip(block, -clip, clip, out=block)
+
+  return ratio
+
+
+def get_cis_expectation(obs):
+  """
+  Full, dense matrix of expected contacts for a square cis matrix. Only for small matrices;
+  get_obs_vs_exp() doesn't make this.
+  """
+
+  n = obs.shape[0]
+  sep_sig, vals, scale = get_cis_expectation_factors(obs)
+
+  return _get_expectation_block(sep_sig, vals, vals, scale, 0, n)
+
+
+def get_obs_vs_exp(obs, clip=10, log=True):
+  """
+  Log of observed/expected contacts for a square cis matrix, dense or sparse, relative to the
+  distance-decay and coverage of the matrix. Dense matrices have their main diagonal set to zero,
+  in place, and give a dense result. Sparse matrices give a COO matrix of the non-zero, off-diagonal
+  elements. Where the expected or observed value is zero the observed value is kept. Values are
+  clipped to +/- clip, unless clip is None. If log is not set, plain ratios are given.
+  """
+
+  if not sparse.issparse(obs):
+    np.fill_diagonal(obs, 0)
+
+  sep_sig, vals, scale = get_cis_expectation_factors(obs)
+
+  return _divide_expected(obs, (sep_sig, vals, vals, scale), log, clip)
+
+
+def get_trans_obs_vs_exp(obs_ab, vals_a, vals_b, clip=None, log=True):
+  """
+  Observed/expected contacts for a trans matrix, as get_obs_vs_exp(), where the expectation is the
+  outer product of the given row and column coverage, scaled to the observed total.
+  """
+
+  vals_a = np.asarray(vals_a, float)
+  vals_b = np.asarray(vals_b, float)
+  sobs = obs_ab.sum()
+  total = vals_a.sum() * vals_b.sum()
+  scale = sobs/total if total else 0.0
+
+  return _divide_expected(obs_ab, (None, vals_a, vals_b, scale), log, clip)
+
+
+# #   Sequence separations  # #
+
+def get_diagonal_band(mat, max_sep=None):
+  """
+  Row, column and value arrays of the non-zero upper triangle elements, i.e. col >= row, of a
+  square cis matrix, dense or sparse, optionally only those within max_sep diagonals of the main
+  diagonal. Sparse matrices are used directly, without making any dense array.
+  """
+
+  if sparse.issparse(mat):
+    mat = sparse.coo_matrix(mat)
+    rows = mat.row.astype(np.int64)
+    cols = mat.col.astype(np.int64)
+    data = mat.data
+
+  else:
+    rows, cols = np.nonzero(mat)
+    data = mat[rows, cols]
+
+  seps = cols - rows
+  idx = (seps >= 0) & (data != 0)
+
+  if max_sep is not None:
+    idx &= seps <= max_sep
+
+  return rows[idx], cols[idx], data[idx]
+
+
+def get_sep_weights(rows, cols, n):
+  """
+  Weights for contacts in a cis matrix of n bins which correct for the fraction of the chromosome
+  that could give rise to each sequence separation, i.e. n/(n-d) for diagonal offset d.
+  """
+
+  return n / (n - np.abs(cols - rows)).astype(float)
+
+
+def get_sep_class_counts(rows, cols, data, seps, sep_edges, n_bins):
+  """
+  Per-bin contact totals for classes of sequence separation, bounded by the ascending sep_edges, so
+  that class k has sep_edges[k-1] <= sep < sep_edges[k]. Each contact counts toward both its row
+  and column bins. Returns an array of shape (len(sep_edges)+1, n_bins).
+  """
+
+  n_classes = len(sep_edges) + 1
+  offsets = np.searchsorted(sep_edges, seps, side='right') * n_bins
+  weights = None if data is None else np.asarray(data, float)
+  size = n_classes * n_bins
+
+  counts = np.bincount(offsets + rows, weights=weights, minlength=size)
+  counts = counts + np.bincount(offsets + cols, weights=weights, minlength=size)
+
+  return counts.reshape(n_classes, n_bins)
+
+
+# #   Insulation  # #
+
+def _get_band_tables(mat, width):
+  """
+  Summed-area tables of the upper triangle of a square matrix, dense or sparse, within width
+  diagonals of the main diagonal. Elements of row_table[i, w] and col_table[j, w] are the totals
+  for diagonal offsets up to w in rows before i and in columns before j, respectively. Returns
+  (row_table, col_table) pairs for the matrix values and for the numbers of non-zero values; the
+  latter are exact, so can tell empty regions from float cancellation residue in the former.
+  """
+
+  n = mat.shape[0]
+  rows, cols, data = get_diagonal_band(mat, width)
+  seps = cols - rows
+  data = np.asarray(data, float)
+  shape = (n+1, width+1)
+  value_tables = []
+  count_tables = []
+
+  for weights, tables in ((data, value_tables), ((data != 0).astype(float), count_tables)):
+    for idx in (rows, cols):
+      table = np.bincount((idx+1) * (width+1) + seps, weights=weights, minlength=shape[0]*shape[1])
+      table = table.reshape(shape).cumsum(axis=0).cumsum(axis=1)
+      tables.append(table)
+
+  return value_tables, count_tables
+
+
+def _get_band_sums(tables, starts, ends, width):
+  """
+  Totals of the upper triangles start <= row <= col <= end, restricted to within width diagonals,
+  from the tables of _get_band_tables(). Empty ranges, where end < start, give zero.
+  """
+
+  row_table, col_table = tables
+  seps = np.minimum(width, ends-starts)
+  valid = seps >= 0
+  seps = np.where(valid, seps, 0)
+  starts = np.where(valid, starts, 0)
+  ends = np.where(valid, ends, -1)
+
+  # Elements with row < start and col > end can't be within the diagonals
+  sums = col_table[ends+1, seps] - row_table[starts, seps]
+
+  return np.where(valid, sums, 0.0)
+
+
+def _get_band_counts(starts, ends, width):
+  """
+  Numbers of elements in the triangles of _get_band_sums()
+  """
+
+  m = np.maximum(0, ends-starts+1)
+  seps = np.minimum(width, m-1)
+
+  return np.where(m > 0, (seps+1) * m - (seps * (seps+1)) // 2, 0)
+
+
+def get_insulation(mat, max_sep, bins=None):
+  """
+  Insulation scores of a square, non-negative cis matrix, dense or sparse, at boundary bins, by
+  default every bin. Windows extend max_sep bins either side of each boundary, both including it,
+  and are clipped at the matrix edges. The score is the larger of the mean values within the two
+  windows divided by the mean value between them, i.e. for bin pairs which span the boundary and
+  are at most max_sep apart, or zero where the latter mean is zero. Sums are taken from
+  summed-area tables of the matrix band, so each boundary takes constant time.
+  """
+
+  n = mat.shape[0]
+
+  if bins is None:
+    bins = np.arange(n)
+  else:
+    bins = np.asarray(bins, int)
+
+  if not len(bins):
+    return np.zeros(0)
+
+  starts = np.maximum(0, bins-max_sep)
+  ends = np.minimum(n-1, bins+max_sep)
+  upper, upper_counts = _get_band_tables(mat, max_sep)
+  lower, lower_counts = _get_band_tables(mat.T, max_sep)
+
+  def get_square_sums(a, b, up, low):
+    diag = up[0][:,0] # Cumulative main diagonal
+    return _get_band_sums(up, a, b, max_sep) + _get_band_sums(low, a, b, max_sep) - (diag[b+1] - diag[a])
+
+  def get_span_sums(tables):
+    return _get_band_sums(tables, starts, ends, max_sep) \
+           - _get_band_sums(tables, starts, bins-1, max_sep) \
+           - _get_band_sums(tables, bins+1, ends, max_sep)
+
+  def get_inter_sums(up, low):
+    diag = up[0][:,0]
+    return get_span_sums(up) + get_span_sums(low) - (diag[bins+1] - diag[bins])
+
+  # Differences of the tables leave rounding residue where the true sums are zero,
+  # so windows without non-zero values are set to zero exactly
+  prev = get_square_sums(starts, bins, upper, lower)
+  prev[get_square_sums(starts, bins, upper_counts, lower_counts) == 0] = 0.0
+  prev = np.maximum(prev, 0.0) / (bins-starts+1.0) ** 2
+
+  next = get_square_sums(bins, ends, upper, lower)
+  next[get_square_sums(bins, ends, upper_counts, lower_counts) == 0] = 0.0
+  next = np.maximum(next, 0.0) / (ends-bins+1.0) ** 2
+
+  inter = get_inter_sums(upper, lower)
+  inter[get_inter_sums(upper_counts, lower_counts) == 0] = 0.0
+  n_inter = _get_band_counts(starts, ends, max_sep) \
+            - _get_band_counts(starts, bins-1, max_sep) \
+            - _get_band_counts(bins+1, ends, max_sep)
+  inter = np.maximum(inter, 0.0) / (2.0 * n_inter - 1.0)
+
+  ratios = np.zeros(len(bins))
+  nz = inter > 0
+  ratios[nz] = np.maximum(prev[nz], next[nz]) / inter[nz]
+
+  return ratios
+
+
+# #   Contact neighbourhoods  # #
+
+def _get_ragged_index(starts, counts):
+  """
+  Concatenated ranges start:start+count, as one index array
+  """
+
+  total = counts.sum()
+  offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+  return np.repeat(starts, counts) + offsets
+
+
+def get_grid_neighbours(pos_a, pos_b, cell_size, max_cell_count=None):
+  """
+  Bin 2D points, e.g. contact positions, into a square grid with the given cell size. Returns the
+  number of points in the cell of each point and index arrays (i, j) of the pairs where point j
+  is in one of the eight cells that surround the cell of point i. Only points in cells with at
+  most max_cell_count points, if specified, are used for i. Cells are located by searching the
+  sorted cell keys, so no per-point hashing is needed.
+  """
+
+  pos_a = np.asarray(pos_a)
+  pos_b = np.asarray(pos_b)
+  n = len(pos_a)
+
+  if not n:
+    return np.zeros(0, int), np.zeros(0, int), np.zeros(0, int)
+
+  cells_a = np.floor(pos_a/float(cell_size)).astype(np.int64)
+  cells_b = np.floor(pos_b/float(cell_size)).astype(np.int64)
+  cells_a -= cells_a.min() - 1 # Neighbours of all cells have positive keys
+  cells_b -= cells_b.min() - 1
+  width = cells_b.max() + 2
+
+  keys = cells_a * width + cells_b
+  order = np.argsort(keys, kind='stable')
+  sorted_keys = keys[order]
+
+  cell_counts = np.empty(n, np.int64)
+  cell_counts[order] = np.searchsorted(sorted_keys, sorted_keys, 'right') - np.searchsorted(sorted_keys, sorted_keys, 'left')
+
+  query = order # Sorted keys are searched much faster
+
+  if max_cell_count is not None:
+    query = query[cell_counts[query] <= max_cell_count]
+
+  idx_i = []
+  idx_j = []
+
+  for da in (-1, 0, 1):
+    for db in (-1, 0, 1):
+      if da or db:
+        keys2 = keys[query] + (da * width + db)
+        starts = np.searchsorted(sorted_keys, keys2, 'left')
+        counts = np.searchsorted(sorted_keys, keys2, 'right') - starts
+        idx_i.append(np.repeat(query, counts))
+        idx_j.append(order[_get_ragged_index(starts, counts)])
+
+  return cell_counts, np.concatenate(idx_i), np.concatenate(idx_j)
+
+
+def get_isolated(pos_a, pos_b, threshold):
+  """
+  Boolean array of which contacts are isolated, i.e. have no other contact within the threshold
+  distance in both positions. This is judged on a grid with the threshold as the cell size: other
+  contacts in the same cell prevent isolation and contacts in the surrounding cells are checked
+  directly and with their positions swapped, i.e. as the mirrored, symmetric contact.
+  """
+
+  pos_a = np.asarray(pos_a)
+  pos_b = np.asarray(pos_b)
+  cell_counts, idx_i, idx_j = get_grid_neighbours(pos_a, pos_b, threshold, max_cell_count=1)
+
+  a_i, b_i = pos_a[idx_i], pos_b[idx_i]
+  a_j, b_j = pos_a[idx_j], pos_b[idx_j]
+
+  close = (np.abs(a_j-a_i) < threshold) & (np.abs(b_j-b_i) < threshold)
+  close |= (np.abs(b_j-a_i) < threshold) & (np.abs(a_j-b_i) < threshold)
+
+  isolated = cell_counts == 1
+  isolated[idx_i[close]] = False
+
+  return isolated
+
+
+def count_neighbours(pos_a, pos_b, threshold):
+  """
+  Number of contacts near to each contact: those in the same grid cell, which has the threshold
+  as its size, plus those in the surrounding cells that are within the threshold in both positions.
+  Contacts count themselves.
+  """
+
+  pos_a = np.asarray(pos_a)
+  pos_b = np.asarray(pos_b)
+  cell_counts, idx_i, idx_j = get_grid_neighbours(pos_a, pos_b, threshold)
+
+  close = (np.abs(pos_a[idx_j]-pos_a[idx_i]) < threshold) & (np.abs(pos_b[idx_j]-pos_b[idx_i]) < threshold)
+
+  return cell_counts + np.bincount(idx_i[close], minlength=len(pos_a))
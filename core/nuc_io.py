@@ -16,6 +16,11 @@ import core.nuc_util as util
 FILENAME_SPLIT   = re.compile('[_\.]')
 FILE_BUFFER_SIZE = 2**16
 GZIP_EXTENSIONS = ('.gz','.gzip')
+CACHE_MAGIC = b'NUCB'
+CACHE_ALIGN = 64
+TRACK_CACHE_EXT = '.ntrk'
+TRACK_CACHE_VERSION = 1
+TEXT_CHUNK_LINES = 2**16 # Lines of text parsed together by chunked readers
 
 # #   Path naming  # #
 
@@ -269,7 +274,7 @@ def compress_file(file_path):
     
 def open_file(file_path, mode=None, buffer_size=FILE_BUFFER_SIZE, gzip_exts=('.gz','.gzip'), partial=False):
   """
-  GZIP agnostic file opening
+  GZIP agnostic file opening. Binary modes give undecoded bytes.
   """
   import io
   
@@ -287,11 +292,14 @@ def open_file(file_path, mode=None, buffer_size=FILE_BUFFER_SIZE, gzip_exts=('.g
         except OSError:
           file_obj = BufferedReader(gzip.open(file_path, mode or 'rb'), buffer_size)
     
-    if sys.version_info.major > 2:
+    if (sys.version_info.major > 2) and not (mode and 'b' in mode):
       file_obj = io.TextIOWrapper(file_obj, encoding="utf-8")
  
   else:
-    if sys.version_info.major > 2:
+    if mode and 'b' in mode:
+      file_obj = open(file_path, mode, buffer_size)
+    
+    elif sys.version_info.major > 2:
       file_obj = open(file_path, mode or 'rU', buffer_size, encoding='utf-8')
       
     else:
@@ -300,6 +308,20 @@ def open_file(file_path, mode=None, buffer_size=FILE_BUFFER_SIZE, gzip_exts=('.g
   return file_obj
  
  
+def iter_line_chunks(file_obj, n_lines=TEXT_CHUNK_LINES):
+  """Yield lists of up to n_lines lines from an open text file"""
+  
+  from itertools import islice
+  
+  while True:
+    lines = list(islice(file_obj, n_lines))
+    
+    if not lines:
+      break
+    
+    yield lines
+
+
 def check_regular_file(file_path):
   
   msg = check_invalid_file(file_path)
@@ -339,3 +361,189 @@ def is_same_file(file_path_a, file_path_b):
   
   return file_path_a == file_path_b
   
+  
+
+# #  Binary array caches  # #
+
+def get_file_stamp(file_path):
+  """Size and modification time of a file; used to detect when a derived cache is stale"""
+  
+  stat = os.stat(file_path)
+  
+  return [int(stat.st_size), float(stat.st_mtime)]
+
+
+def get_cache_path(file_path, cache_ext):
+  """
+  Path of a binary cache file derived from a source file. The full source file name, including
+  any compression extension, is kept so that e.g. x.ncc and x.ncc.gz have separate caches.
+  """
+  
+  return file_path + cache_ext
+
+
+def can_write_cache(cache_path):
+  """
+  Whether a cache file could be made, i.e. its directory is writable. Checked before any
+  parsing for the cache, so that read-only or shared locations are simply skipped.
+  """
+  
+  return os.access(os.path.dirname(os.path.abspath(cache_path)), os.W_OK)
+
+
+def save_array_cache(cache_path, header, arrays, source_path=None):
+  """
+  Save named NumPy arrays, plus a JSON-serialisable header dict, to a binary file from which
+  the arrays can be memory-mapped. A source file's size and modification time are recorded,
+  if specified, so the cache may be invalidated. The file is written to a temporary path and
+  then moved, so readers never see a partial cache. Returns False if the cache could not be
+  written, e.g. in a read-only directory.
+  """
+  import json
+  from numpy.lib import format as npy_format
+  
+  header = dict(header)
+  
+  if source_path:
+    header['source_stamp'] = get_file_stamp(source_path)
+    
+  array_info = []
+  offset = 0
+  
+  for name in arrays:
+    array = np.ascontiguousarray(arrays[name])
+    arrays[name] = array
+    array_info.append((name, npy_format.dtype_to_descr(array.dtype), list(array.shape), offset))
+    offset += CACHE_ALIGN * int(np.ceil(array.nbytes/float(CACHE_ALIGN)))
+  
+  header['arrays'] = array_info
+  header_bytes = json.dumps(header).encode('utf-8')
+  data_start = len(CACHE_MAGIC) + 8 + len(header_bytes)
+  data_start = CACHE_ALIGN * int(np.ceil(data_start/float(CACHE_ALIGN)))
+  
+  temp_path = get_temp_path(cache_path)
+  
+  try:
+    with open(temp_path, 'wb') as file_obj:
+      file_obj.write(CACHE_MAGIC)
+      file_obj.write(np.array([len(header_bytes)], '<u8').tobytes())
+      file_obj.write(header_bytes)
+      
+      for name, descr, shape, offset in array_info:
+        file_obj.seek(data_start + offset)
+        arrays[name].tofile(file_obj)
+ 
+    os.rename(temp_path, cache_path)
+  
+  except (IOError, OSError) as err:
+    util.warn('Could not write cache file %s: %s' % (cache_path, err))
+    
+    if os.path.exists(temp_path):
+      os.unlink(temp_path)
+    
+    return False
+  
+  return True
+  
+  
+def load_array_cache(cache_path, source_path=None):
+  """
+  Load the header dict and memory-mapped arrays from a file written by save_array_cache().
+  Arrays are mapped copy-on-write, so may be modified in memory without changing the file.
+  Returns None if the cache does not exist, is not valid, or doesn't match the current
+  size and modification time of the specified source file.
+  """
+  import json
+  from numpy.lib import format as npy_format
+  
+  if not os.path.exists(cache_path):
+    return None
+  
+  with open(cache_path, 'rb') as file_obj:
+    if file_obj.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+      return None
+    
+    n_bytes = int(np.frombuffer(file_obj.read(8), '<u8')[0])
+    
+    try:
+      header = json.loads(file_obj.read(n_bytes).decode('utf-8'))
+    except ValueError:
+      return None
+  
+  if source_path and (header.get('source_stamp') != get_file_stamp(source_path)):
+    return None
+  
+  data_start = len(CACHE_MAGIC) + 8 + n_bytes
+  data_start = CACHE_ALIGN * int(np.ceil(data_start/float(CACHE_ALIGN)))
+  file_size = os.path.getsize(cache_path)
+  arrays = {}
+  
+  for name, descr, shape, offset in header.pop('arrays'):
+    dtype = npy_format.descr_to_dtype(descr)
+    shape = tuple(shape)
+    size = int(np.prod(shape)) * dtype.itemsize
+    
+    if size and (data_start + offset + size > file_size): # Truncated
+      return None
+    
+    if size:
+      arrays[name] = np.memmap(cache_path, dtype, mode='c', offset=data_start+offset, shape=shape)
+    else:
+      arrays[name] = np.zeros(shape, dtype)
+      
+  return header, arrays
+
+
+def get_track_cache_path(file_path):
+  """Path of the binary cache file of parsed data tracks for a BED, WIG or GFF file"""
+  
+  return get_cache_path(file_path, TRACK_CACHE_EXT)
+
+
+def save_data_track_cache(file_path, data_dicts, cache_path=None):
+  """
+  Save parsed data tracks, a dict of {track name:{chromo:DATA_TRACK_TYPE array}}, to a binary
+  cache file for the source file_path. Returns the cache path, or None if it could not be written.
+  """
+  
+  if not cache_path:
+    cache_path = get_track_cache_path(file_path)
+  
+  tracks = []
+  arrays = {}
+  
+  for i, name in enumerate(data_dicts):
+    chromos = sorted(data_dicts[name])
+    tracks.append((name, chromos))
+    
+    for j, chromo in enumerate(chromos):
+      arrays['track_%d_%d' % (i, j)] = data_dicts[name][chromo]
+  
+  header = {'version':TRACK_CACHE_VERSION,
+            'tracks':tracks}
+  
+  if save_array_cache(cache_path, header, arrays, file_path):
+    return cache_path
+
+
+def load_data_track_cache(file_path, cache_path=None):
+  """
+  Load parsed data tracks from the binary cache for a source file, if present and current, as
+  a dict of {track name:{chromo:DATA_TRACK_TYPE array}} with memory-mapped arrays. Returns None otherwise.
+  """
+  
+  if not cache_path:
+    cache_path = get_track_cache_path(file_path)
+  
+  cache_data = load_array_cache(cache_path, file_path)
+  
+  if cache_data:
+    header, arrays = cache_data
+    
+    if header.get('version') == TRACK_CACHE_VERSION:
+      data_dicts = {}
+      
+      for i, (name, chromos) in enumerate(header['tracks']):
+        data_dicts[name] = {chromo:arrays['track_%d_%d' % (i, j)] for j, chromo in enumerate(chromos)}
+      
+      return data_dicts
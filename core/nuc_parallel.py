@@ -1,118 +1,344 @@
+import atexit
+import functools
 import multiprocessing
 import os
+import pickle
 import subprocess
+import sys
+import numpy as np
+
+from collections import deque
+
+try:
+  from concurrent.futures import ProcessPoolExecutor
+  from concurrent.futures.process import BrokenProcessPool
+  from multiprocessing import shared_memory, resource_tracker
+
+except ImportError: # Python < 3.8; jobs are run serially in this process
+  ProcessPoolExecutor = shared_memory = resource_tracker = None
+  BrokenProcessPool = RuntimeError
 
 
 # #   Globals  # #
 
 MAX_CORES = multiprocessing.cpu_count()
+HAVE_POOLS = shared_memory is not None # Otherwise shared arrays are plain, in-process arrays
+CHUNKS_PER_CORE = 4 # Tasks are sent to workers in this many chunks per core, for load balancing
 
+_POOLS = {}    # Persistent worker pools : number of workers
+_SHARED = {}   # Shared memory name : (SharedMemory, array) for blocks made by this process
+_ATTACHED = {} # As above, for blocks attached by a worker during a task
+_CLOSING = []  # Attached blocks which were still referenced when their task finished
+_TARGET = None # Un-picklable target function and arguments, inherited by forked workers
 
-# #  Job execution  # #    
-    
-def run(target_func, job_data, common_args=(), common_kw={},
-        num_cpu=MAX_CORES, verbose=True):
-  # This does not use Pool.apply_async because of its inability to pass
-  # pickled non-global functions
+
+# #  Worker pools  # #
+
+def get_pool(num_cpu=MAX_CORES):
+  """
+  Get a persistent pool of worker processes, which is made when first needed and then reused.
+  """
+
+  pool = _POOLS.get(num_cpu)
+
+  if pool is None:
+    pool = _get_executor(num_cpu, _init_worker)
+    _POOLS[num_cpu] = pool
+
+  return pool
+
+
+def start_pool(num_cpu=MAX_CORES):
+  """
+  Start the workers of a persistent pool now, e.g. before opening a pipe to another process, which
+  workers forked later would hold open.
+  """
+
+  if HAVE_POOLS and (num_cpu > 1):
+    get_pool(num_cpu).submit(int).result()
+
+
+def _shutdown(pool, cancel=False):
+
+  if cancel and (sys.version_info >= (3, 9)):
+    pool.shutdown(wait=True, cancel_futures=True)
+  else:
+    pool.shutdown(wait=True)
+
+
+def close_pools():
+
+  for num_cpu in list(_POOLS):
+    _shutdown(_POOLS.pop(num_cpu))
+
+
+atexit.register(close_pools)
+
+
+def _is_picklable(obj):
+
+  try:
+    pickle.dumps(obj)
+  except Exception:
+    return False
+
+  return True
+
+
+def _call(target_func, args, kw, data_item):
+
+  try:
+    return target_func(data_item, *args, **kw)
+
+  finally:
+    _release_attached()
+
+
+def _get_executor(num_cpu, initializer, initargs=()):
   
-  from multiprocessing import Queue, Process
-  from nuc_util import info
+  # Workers share this process's resource tracker, which unlinks shared memory only if leaked 
+  resource_tracker.ensure_running()
   
-  def _wrapper(job, out_queue, target_func, data_item, args, kw):
-    result = target_func(data_item, *args, **kw)
-    out_queue.put((job, result))
+  return ProcessPoolExecutor(num_cpu, mp_context=multiprocessing.get_context('fork'),
+                             initializer=initializer, initargs=initargs)
+
+
+def _init_worker():
+
+  _SHARED.clear() # Forked copies; workers attach to shared arrays when needed
+
+
+def _set_target(target_func, args, kw):
+
+  global _TARGET
+
+  _init_worker()
+  _TARGET = (target_func, args, kw)
+
+
+def _call_target(data_item):
+
+  target_func, args, kw = _TARGET
+
+  return _call(target_func, args, kw, data_item)
+
+
+# #  Job execution  # #
+
+def _get_job_pool(target_func, common_args, common_kw, num_proc):
+
+  if _is_picklable(target_func): # Only the function decides the pool; arguments may be large
+    pool = get_pool(num_proc)
+    func = functools.partial(_call, target_func, common_args, common_kw)
+    temp_pool = None
+
+  else:
+    temp_pool = pool = _get_executor(num_proc, _set_target, (target_func, common_args, common_kw))
+    func = _call_target
+
+  return pool, func, temp_pool
+
+
+def imap(target_func, job_data, common_args=(), common_kw={}, num_cpu=MAX_CORES, chunk_size=None):
+  """
+  Generator for the results of target_func(data_item, *common_args, **common_kw) for each item of
+  job_data, run on parallel worker processes, yielding results in the order of job_data.
+  Tasks are sent to workers in chunks and any exception raised by a task is raised here.
+  Picklable, i.e. module-level, target functions are run on a persistent pool of workers, so
+  their common arguments must also be picklable. Otherwise, e.g. for closures, a pool is forked
+  for this call, which inherits the function and its arguments.
+  Large array arguments or results are best passed via share_array() and get_shared_array().
+  """
 
   num_jobs = len(job_data)
   num_proc = min(num_cpu, num_jobs)
-  procs = {} # Current processes
-  queue = Queue() # Collect output
-  results = [None] * num_jobs
-  
+
+  if (num_proc < 2) or not HAVE_POOLS:
+    for data_item in job_data:
+      yield target_func(data_item, *common_args, **common_kw)
+
+    return
+
+  if not chunk_size:
+    chunk_size = max(1, num_jobs // (num_proc * CHUNKS_PER_CORE))
+
+  pool, func, temp_pool = _get_job_pool(target_func, common_args, common_kw, num_proc)
+
+  try:
+    for result in pool.map(func, job_data, chunksize=chunk_size):
+      yield result
+
+  except BrokenProcessPool:
+    _POOLS.pop(num_proc, None) # Will be remade
+    raise
+
+  finally:
+    if temp_pool:
+      _shutdown(temp_pool, cancel=True)
+
+
+def stream(target_func, job_iter, common_args=(), common_kw={}, num_cpu=MAX_CORES, max_pending=None):
+  """
+  As imap(), but job data items are taken from an iterable, e.g. a generator reading a large
+  file, which need not fit in memory. Items are only read ahead of the yielded results by
+  max_pending tasks, by default two per worker, and results are yielded in order.
+  """
+
+  if (num_cpu < 2) or not HAVE_POOLS:
+    for data_item in job_iter:
+      yield target_func(data_item, *common_args, **common_kw)
+
+    return
+
+  max_pending = max_pending or 2 * num_cpu
+  pool, func, temp_pool = _get_job_pool(target_func, common_args, common_kw, num_cpu)
+  pending = deque()
+
+  try:
+    for data_item in job_iter:
+      pending.append(pool.submit(func, data_item))
+
+      if len(pending) >= max_pending:
+        yield pending.popleft().result()
+
+    while pending:
+      yield pending.popleft().result()
+
+  except BrokenProcessPool:
+    _POOLS.pop(num_cpu, None)
+    raise
+
+  finally:
+    for future in pending:
+      future.cancel()
+
+    if temp_pool:
+      _shutdown(temp_pool, cancel=True)
+
+
+def run(target_func, job_data, common_args=(), common_kw={},
+        num_cpu=MAX_CORES, verbose=True, chunk_size=None):
+  """
+  Run target_func(data_item, *common_args, **common_kw) for each item of job_data, on parallel
+  worker processes, returning a list of results in the same order as job_data.
+  """
+
+  from core.nuc_util import info
+
+  num_jobs = len(job_data)
+  num_proc = min(num_cpu, num_jobs)
+  results = []
+
   if verbose:
     msg = 'Running %s for %d tasks on %d cores'
     info(msg % (target_func.__name__, num_jobs, num_proc))
-  
-  k = 0
-  for j in range(num_jobs):
-    
-    if len(procs) == num_proc: # Full
-      i, result = queue.get()  # Async wait
-      results[i] = result
-      del procs[i]
-      
-      if verbose:
-        k += 1
-        msg = ' .. done %d of %d'
-        info(msg % (k, num_jobs))
-        
-    args = (j, queue, target_func, job_data[j], common_args, common_kw)
-    proc = Process(target=_wrapper, args=args)
-    procs[j] = proc
-    proc.start()
-  
-  # Last waits
-  
-  while procs:
-    i, result = queue.get()
-    results[i] = result
-    del procs[i]
-   
+
+  for k, result in enumerate(imap(target_func, job_data, common_args, common_kw, num_cpu, chunk_size), 1):
+    results.append(result)
+
     if verbose:
-      k += 1
       msg = ' .. done %d of %d'
       info(msg % (k, num_jobs))
- 
-  queue.close()
- 
+
   return results
-  
+
 
 def parallel_split_job(target_func, split_data, common_args, num_cpu=MAX_CORES, collect_output=True):
-  
-  num_tasks   = len(split_data)
-  num_process = min(num_cpu, num_tasks)
-  processes   = []
-  
-  def _parallel_func_wrapper(queue, target_func, proc_data, common_args):
- 
-    for t, data_item in proc_data:
-      result = target_func(data_item, *common_args)
- 
-      if queue:
-        queue.put((t, result))
-  
+
+  results = run(target_func, split_data, common_args, num_cpu=num_cpu, verbose=False)
+
   if collect_output:
-    queue = multiprocessing.Queue() # Queue will collect parallel process output
+    return results
+
+
+# #  Shared memory arrays  # #
+
+def share_array(array=None, shape=None, dtype=float):
+  """
+  Place a copy of an array, or a new array of zeros given shape and dtype, in shared memory.
+  Returns a small, picklable handle, which workers pass to get_shared_array() to access the
+  same data without copying, and the shared array itself. Free with free_shared_array().
+  Without worker pools, jobs run in this process, so a plain array is used.
+  """
+
+  if array is not None:
+    shape = array.shape
+    dtype = array.dtype
+
+  dtype = np.dtype(dtype)
   
-  else:
-    queue = None
+  if not HAVE_POOLS:
+    shared = np.zeros(shape, dtype)
     
-  for p in range(num_process):
-    # Task IDs and data for each task
-    # Each process can have multiple tasks if there are more tasks than processes/cpus
-    proc_data = [(t, data_item) for t, data_item in enumerate(split_data) if t % num_cpu == p]
-    args = (queue, target_func, proc_data, common_args)
-
-    proc = multiprocessing.Process(target=_parallel_func_wrapper, args=args)
-    processes.append(proc)
-  
-  for proc in processes:
-    proc.start()
+    if array is not None:
+      shared[...] = array
+    
+    name = 'local_%d' % id(shared)
+    _SHARED[name] = (None, shared)
+    
+    return (name, tuple(shape), dtype.str), shared
   
+  n_bytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+  shm = shared_memory.SharedMemory(create=True, size=n_bytes) # Zero-filled
+  shared = np.ndarray(shape, dtype, buffer=shm.buf)
+
+  if array is not None:
+    shared[...] = array
+
+  _SHARED[shm.name] = (shm, shared)
+
+  return (shm.name, tuple(shape), dtype.str), shared
+
+
+def get_shared_array(handle):
+  """
+  Get the array for a shared memory handle from share_array(). In workers, the array is
+  only valid for the duration of the current task, so should not be returned.
+  """
+
+  name, shape, dtype = handle
+
+  if name in _SHARED:
+    return _SHARED[name][1]
+
+  if name in _ATTACHED:
+    return _ATTACHED[name][1]
+
+  shm = shared_memory.SharedMemory(name=name) # Unlinked by the creating process
+  shared = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+  _ATTACHED[name] = (shm, shared)
+
+  return shared
+
+
+def _release_attached():
+
+  for name in list(_ATTACHED):
+    shm, shared = _ATTACHED.pop(name)
+    _CLOSING.append(shm)
+
+  for shm in list(_CLOSING):
+    try:
+      shm.close()
+      _CLOSING.remove(shm)
+    except BufferError: # Still referenced; try again after the next task
+      pass
+
+
+def free_shared_array(handle):
+  """
+  Release a shared memory array made by share_array(). The array must no longer be used.
+  """
+
+  shm, shared = _SHARED.pop(handle[0])
+  del shared
   
-  if queue:
-    results = [None] * num_tasks
-    
-    for i in range(num_tasks):
-      t, result = queue.get() # Asynchronous fetch output: whichever process completes a task first
-      results[t] = result
- 
-    queue.close()
- 
-    return results
+  if shm is None: # In-process array
+    return
   
-  else:
-    for proc in processes: # Asynchromous wait and no output captured
-      proc.join()
-    
- 
+  shm.unlink()
+
+  try:
+    shm.close()
+  except BufferError: # Views remain; memory is released once they are garbage collected
+    pass
@@ -1,6 +1,7 @@
 import random, sys, string, subprocess
 import uuid
 import numpy as np
+from collections import namedtuple
 
 # #   Globals  # #
 
@@ -14,6 +15,8 @@ LOG_FILE_OBJ     = None # Created when needed
 DATA_TRACK_TYPE = np.dtype([('pos1', 'uint32'), ('pos2', 'uint32'), ('strand', 'bool'),
                            ('value', 'float32'), ('orig_value', 'float32'), ('label', 'S32')])
 
+IntervalIndex = namedtuple('IntervalIndex', ['starts', 'ends', 'max_ends', 'sorted_ends', 'order', 'max_len'])
+
 import core.nuc_parallel as parallel
 
 # #   Srcreen reporting  # # 
@@ -102,6 +105,7 @@ def call(cmd_args, stdin=None, stdout=None, stderr=None, verbose=True, wait=True
   """
   Wrapper for external calls to log and report commands,
   open stdin, stderr and stdout etc.
+  Returns the running process if not waiting for it.
   """
   
   if verbose:
@@ -137,7 +141,7 @@ def call(cmd_args, stdin=None, stdout=None, stderr=None, verbose=True, wait=True
     subprocess.call(cmd_args, stdin=stdin, stdout=stdout, stderr=stderr, env=env, shell=shell)
       
   else:
-    subprocess.Popen(cmd_args, stdin=stdin, stdout=stdout, stderr=stderr, env=env, shell=shell)
+    return subprocess.Popen(cmd_args, stdin=stdin, stdout=stdout, stderr=stderr, env=env, shell=shell)
 
 
 # #  Strings  # #    
@@ -273,20 +277,105 @@ def sort_chromosomes(chromos):
   return [x[1] for x in sort_chromos]  
 
 
-def points_region_intersect(pos, regions):
+def get_interval_index(regions):
+  """
+  Make an index of (start, end) regions, e.g. for one chromosome, for fast, batched overlap queries.
+  Regions are sorted by start and augmented with the running maximum of their ends; the ends are also
+  sorted separately so that overlaps may be counted. Regions are treated as closed intervals.
+  """
+  
+  regions = np.asarray(regions).reshape(-1, 2)
+  order = regions[:,0].argsort(kind='stable')
+  starts = regions[order,0]
+  ends = regions[order,1]
+  
+  if len(order):
+    max_ends = np.maximum.accumulate(ends)
+    max_len = (ends-starts).max()
+  else:
+    max_ends = ends
+    max_len = 0
+  
+  return IntervalIndex(starts, ends, max_ends, np.sort(ends), order, max_len)
+  
+
+def _get_query_limits(starts, ends):
+  
+  starts = np.asarray(starts)
   
-  starts = np.array(regions[:,0])
-  ends = np.array(regions[:,1])
+  if ends is None: # Points
+    return starts, starts
   
-  idx = np.argsort(starts)
+  return starts, np.asarray(ends)
+
+
+def interval_index_any(index, starts, ends=None):
+  """
+  For query points, or intervals if ends are specified, whether each overlaps any indexed region
+  """
+  
+  starts, ends = _get_query_limits(starts, ends)
+
+  if not len(index.starts):
+    return np.zeros(starts.shape, bool)
+
+  # Last region starting before the query end; earlier regions all start before it
+  k = np.searchsorted(index.starts, ends, 'right') - 1
 
-  starts = starts[idx]
-  ends = ends[idx]
+  return (k >= 0) & (index.max_ends[np.maximum(k, 0)] >= starts)
   
-  before_end = np.searchsorted(ends, pos)
-  after_start = np.searchsorted(starts, pos)-1
   
-  intersection = after_start == before_end
+def interval_index_count(index, starts, ends=None):
+  """
+  For query points, or intervals if ends are specified, the number of overlapping indexed regions
+  """
+  
+  starts, ends = _get_query_limits(starts, ends)
+  
+  # Regions starting at or before query end, less those which end before query start
+  return np.searchsorted(index.starts, ends, 'right') - np.searchsorted(index.sorted_ends, starts, 'left')
+  
+  
+def interval_index_overlaps(index, starts, ends=None):
+  """
+  All overlaps of query points, or intervals if ends are specified, with indexed regions.
+  Returns arrays of query indices and of the overlapping region indices, in the original region order.
+  Candidate regions are those starting within the longest region length of a query.
+  """
+  
+  starts, ends = _get_query_limits(starts, ends)
+  
+  lo = np.searchsorted(index.starts, starts - index.max_len, 'left')
+  hi = np.searchsorted(index.starts, ends, 'right')
+  lens = np.maximum(hi-lo, 0)
+  
+  limits = np.cumsum(lens)
+  n = limits[-1] if len(limits) else 0
+  query_idx = np.repeat(np.arange(len(starts)), lens)
+  region_idx = np.arange(n) - np.repeat(limits-lens, lens) + np.repeat(lo, lens)
+  
+  valid = index.ends[region_idx] >= starts[query_idx]
+  
+  return query_idx[valid], index.order[region_idx[valid]]
+  
+
+def points_region_intersect(pos, regions):
+  """
+  Whether each position is within any region, i.e. start < pos <= end.
+  Regions may be an array of (start, end) or an index made by get_interval_index().
+  """
+  
+  if not isinstance(regions, IntervalIndex):
+    regions = get_interval_index(regions)
+  
+  pos = np.asarray(pos)
+  
+  if not len(regions.starts):
+    return np.zeros(pos.shape, bool)
+  
+  k = np.searchsorted(regions.starts, pos, 'left') - 1 # Last region starting before pos
+  
+  intersection = (k >= 0) & (regions.max_ends[np.maximum(k, 0)] >= pos)
   
   return intersection
 
@@ -310,7 +399,22 @@ def hist_to_data_track(hist, bin_size):
   return track
   
 
+def _unique_data_track(track):
+  """Sort a DATA_TRACK_TYPE array by all fields, in order, and remove duplicate rows"""
+  
+  track = track[np.lexsort([track[name] for name in DATA_TRACK_TYPE.names[::-1]])]
+  
+  keep = np.ones(len(track), bool)
+  keep[1:] = track[1:] != track[:-1]
+  
+  return track[keep]
+
+
 def finalise_data_track(data_dict):
+  """
+  Convert a dict of chromosome data, as sets of (pos1, pos2, strand, value, orig_value, label) tuples
+  or DATA_TRACK_TYPE arrays, to sorted, unique DATA_TRACK_TYPE arrays with normalised values
+  """
   
   vmax = float('-inf')
   vmin = float('inf')
@@ -318,7 +422,11 @@ def finalise_data_track(data_dict):
   n = 0.0
   for chromo in list(data_dict.keys()):
     if len(data_dict[chromo]):
-      data_dict[chromo] = np.array(sorted(data_dict[chromo]), dtype=DATA_TRACK_TYPE)
+      if isinstance(data_dict[chromo], np.ndarray): # Already structured
+        data_dict[chromo] = _unique_data_track(data_dict[chromo].astype(DATA_TRACK_TYPE))
+      else:
+        data_dict[chromo] = np.array(sorted(data_dict[chromo]), dtype=DATA_TRACK_TYPE)
+        
       values = data_dict[chromo]['value']
       vmax = max(vmax,  values.max())
       vmin = min(vmin,  values.min())
@@ -362,68 +470,103 @@ def finalise_data_track(data_dict):
   return dict(data_dict)
 
 
-def bin_data_track(data_track, bin_size, start, end):
+def _bin_region_sets(region_sets, bin_size, starts, ends, dtype, proportional):
+  """
+  Vectorised binning of several sets of (start positions, end positions, values), each into a
+  histogram of regular bins over its own start and end limits. Regions that fall in one bin
+  are set in that bin. For regions that span bins, the value is added to each bin, or if
+  proportional is set, allocated in proportion to the region length within each bin.
+  Returns a list of histograms.
   """
-  For DATA_TRACK_TYPE which are sorted
-  """  
-  n = len(data_track)
   
-  s = int(start/bin_size)
-  e = 1 + int(end/bin_size) # Limit, not last index
-  n_bins = e-s
-  value_hist = np.zeros(n_bins, float)
+  n_sets = len(region_sets)
+  starts = np.broadcast_to(starts, (n_sets,))
+  ends = np.broadcast_to(ends, (n_sets,))
   
-  if not n:
-    return value_hist
+  first_bins = np.array([int(x/bin_size) for x in starts], int)
+  set_bins = np.array([1 + int(x/bin_size) for x in ends], int) - first_bins # Limit, not last index
+  offsets = np.zeros(n_sets+1, int)
+  offsets[1:] = np.cumsum(set_bins)
+  value_hist = np.zeros(offsets[-1], dtype)
   
-  s *= bin_size
-  e *= bin_size   
+  sizes = [len(x[0]) for x in region_sets]
   
-  boundaries = np.linspace(s,e,n_bins+1)
-   
-  starts = data_track['pos1']
-  ends   = data_track['pos2'] 
-  values = data_track['value']
-   
-  start_bin  = np.searchsorted(boundaries, starts)
-  end_bin    = np.searchsorted(boundaries, ends)
+  if not sum(sizes):
+    return np.split(value_hist, offsets[1:-1])
+  
+  pos1 = np.concatenate([x[0] for x in region_sets])
+  pos2 = np.concatenate([x[1] for x in region_sets])
+  values = np.concatenate([x[2] for x in region_sets])
+  
+  # Bin limits for each region's set
+  n_bins = np.repeat(set_bins, sizes)
+  offset = np.repeat(offsets[:-1], sizes)
+  s = np.repeat(first_bins * bin_size, sizes)
+  
+  # Bins are numbered by how many boundaries precede a position
+  start_bin = np.clip(-((s-pos1)//bin_size), 0, n_bins+1).astype(int)
+  end_bin = np.clip(-((s-pos2)//bin_size), 0, n_bins+1).astype(int)
   
   keep = (start_bin > 0) & (end_bin < n_bins) # Data often exceeds common structure regions
 
   mask = (end_bin == start_bin) & keep
-  value_hist[start_bin[mask]] += values[mask]
+  value_hist[offset[mask] + start_bin[mask]] += values[mask]
   
-  spanning = (~mask & keep).nonzero()[0]
+  spanning = (keep & (end_bin > start_bin)).nonzero()[0]
   
-  if len(spanning): # Overlapping cases (should be rare)
-    for i in spanning:
-      v = values[i]
-      p1 = starts[i]
-      p2 = ends[i]
-      r = float(p2-p1)
- 
-      for j in range(start_bin[i], end_bin[i]+1): # Region ovelaps bins 
-        """
-        p3 = s + j * bin_size # Bin start pos
-        p4 = p3 + bin_size    # Bin limit
- 
-        if (p1 >= p3) and (p1 < p4): # Start of region in bin
-          f = float(p4 - p1) / r
- 
-        elif (p2 >= p3) and (p2 < p4): # End of region in bin
-          f = float(p2 - p3) / r
- 
-        elif (p1 < p3) and (p2 > p4): # Mid region in bin
-          f = bin_size / r
- 
-        else:
-          f = 0.0
-        
-        print j, f"""
-        
-        value_hist[j] += v # * f
+  if len(spanning): # Overlapping cases
+    values = values[spanning].astype(float)
+    pos1 = pos1[spanning]
+    pos2 = pos2[spanning]
+    s = s[spanning]
+    start_bin = start_bin[spanning]
+    end_bin = end_bin[spanning]
+    
+    if proportional:
+      # Region length in each bin: whole bins up to the bin containing the region end
+      lens = end_bin-start_bin
+      r = (pos2-pos1).astype(float)
+      weights = np.repeat(values * bin_size / r, lens)
+      
+      p3 = s + (end_bin-1) * bin_size # Start of bin containing the region end
+      g = np.where(pos2 < p3 + bin_size, pos2-p3, 0).astype(float)
+      g[(lens == 1) & (pos1 == p3)] = bin_size # Region starts at boundary
+      
+      ends = np.cumsum(lens)
+      weights[ends-1] = values * g / r
+      
+    else:
+      lens = end_bin-start_bin + 1
+      weights = np.repeat(values, lens)
+      ends = np.cumsum(lens)
+    
+    # Bin indices of all the region spans
+    idx = np.arange(ends[-1]) - np.repeat(ends-lens, lens)
+    idx += np.repeat(offset[spanning] + start_bin, lens)
+    
+    value_hist += np.bincount(idx, weights, minlength=len(value_hist)).astype(dtype)
+  
+  return np.split(value_hist, offsets[1:-1])
+  
+  
+def bin_data_track(data_track, bin_size, start, end):
+  """
+  For DATA_TRACK_TYPE which are sorted
+  """  
+  
+  return bin_data_tracks([data_track], bin_size, start, end)[0]
   
-  return value_hist  
+  
+def bin_data_tracks(data_tracks, bin_size, starts, ends):
+  """
+  Batched version of bin_data_track, for several sorted DATA_TRACK_TYPE arrays, e.g. different
+  strands, tracks or chromosomes. Start and end may be single values or one per data track.
+  Returns a list of histograms.
+  """
+  
+  region_sets = [(x['pos1'], x['pos2'], x['value']) for x in data_tracks]
+  
+  return _bin_region_sets(region_sets, bin_size, starts, ends, float, False)
   
   
 def bin_region_values(regions, values, bin_size, start, end):
@@ -431,68 +574,38 @@ def bin_region_values(regions, values, bin_size, start, end):
   Bin input regions and asscociated values into a histogram of new, regular
   regions. Accounts for partial overlap using proportinal allocation.
   """  
-  n = len(values)
   
-  if len(regions) != n:
-    data = (len(regions), n)
-    msg = 'Number of regions (%d) does not match number of values (%d)'
-    raise Exception(msg % data)  
-    
-  s = int(start/bin_size)
-  e = 1 + int(end/bin_size) # Limit, not last index
-  n_bins = e-s
-  value_hist = np.zeros(n_bins, 'float32')
-  
-  if not len(regions):
-    return value_hist
-  
-  np.sort(regions)
-  sort_idx = regions[:,0].argsort()
-  regions = regions[sort_idx]
-  values = values[sort_idx]
-  
-  s *= bin_size
-  e *= bin_size   
-  boundaries = np.linspace(s,e,n_bins+1)
- 
-  starts = regions[:,0]
-  ends = regions[:,1]  
-  start_bin  = np.searchsorted(boundaries, starts)
-  end_bin    = np.searchsorted(boundaries, ends)
+  return bin_region_values_multi([regions], [values], bin_size, start, end)[0]
   
-  keep = (start_bin > 0) & (end_bin < n_bins) # Data often exceeds common structure regions
 
-  mask = (end_bin == start_bin) & keep
-  value_hist[start_bin[mask]] += values[mask]
+def bin_region_values_multi(regions_list, values_list, bin_size, starts, ends):
+  """
+  Batched version of bin_region_values, for several sets of regions and values, e.g. different
+  tracks or chromosomes, binned together. Start and end may be single values or one per set.
+  Returns a list of histograms.
+  """  
   
-  spanning = (~mask & keep).nonzero()[0]
+  region_sets = []
   
-  if len(spanning): # Overlapping cases (should be rare)
-    for i in spanning:
-      v = values[i]
-      p1 = starts[i]
-      p2 = ends[i]
-      r = float(p2-p1)
- 
-      for j in range(start_bin[i], end_bin[i]+1): # Region ovelaps bins 
-        p3 = s + j * bin_size # Bin start pos
-        p4 = p3 + bin_size    # Bin limit
- 
-        if (p1 >= p3) and (p1 < p4): # Start of region in bin
-          f = float(p4 - p1) / r
- 
-        elif (p2 >= p3) and (p2 < p4): # End of region in bin
-          f = float(p2 - p3) / r
- 
-        elif (p1 < p3) and (p2 > p4): # Mid region in bin
-          f = bin_size / r
- 
-        else:
-          f = 0.0
- 
-        value_hist[j] += v * f
+  for regions, values in zip(regions_list, values_list):
+    n = len(values)
   
-  return value_hist
+    if len(regions) != n:
+      data = (len(regions), n)
+      msg = 'Number of regions (%d) does not match number of values (%d)'
+      raise Exception(msg % data)  
+    
+    if n:
+      regions = np.asarray(regions)
+      sort_idx = regions[:,0].argsort()
+      regions = regions[sort_idx]
+      values = np.asarray(values)[sort_idx]
+      region_sets.append((regions[:,0], regions[:,1], values))
+      
+    else:
+      region_sets.append((np.zeros(0, int), np.zeros(0, int), np.zeros(0)))
+  
+  return _bin_region_sets(region_sets, bin_size, starts, ends, 'float32', True)
 
 
 def unpack_chromo_coords(coords, chromosomes, seq_pos_dict):
@@ -547,23 +660,29 @@ def svd_rotate(coords_a, coords_b, weights=None):
   Aligns coords_b to coords_a by rotation, returning transformed coords
   """
   
-  coords_bt = coords_b.transpose()
+  return svd_rotate_models(coords_a, coords_b[None,:], weights)[0]
+ 
+ 
+def svd_rotate_models(coords_a, coord_models, weights=None):
+  """
+  Batched version of svd_rotate; aligns each of a stack of coord models to coords_a, or to the
+  corresponding array of a stack of reference coords. Weights may be per particle or per model and particle.
+  """
   
   if weights is None:
-    coords_bt = coords_b.transpose()
+    wt_coords = coord_models
   else:
-    coords_bt = coords_b.transpose() * weights
-
-  mat = np.dot(coords_bt, coords_a)
-  rot_mat1, _scales, rot_mat2 = np.linalg.svd(mat)
-  sign = np.linalg.det(rot_mat1) * np.linalg.det(rot_mat2)
-
-  if sign < 0:
-    rot_mat1[:,2] *= -1
+    wt_coords = coord_models * weights[...,None]
+  
+  # Cross-covariance matrices for all models at once
+  mats = np.einsum('...ij,...ik->...jk', wt_coords, coords_a)
+  rot_mats1, _scales, rot_mats2 = np.linalg.svd(mats)
+  sign = np.linalg.det(rot_mats1) * np.linalg.det(rot_mats2)
+  rot_mats1[sign < 0,:,2] *= -1
   
-  rotation = np.dot(rot_mat1, rot_mat2)
+  rotations = np.matmul(rot_mats1, rot_mats2)
   
-  return np.dot(coords_b, rotation)
+  return np.matmul(coord_models, rotations)
  
  
 def center_coords(coords, weights=None):
@@ -571,27 +690,32 @@ def center_coords(coords, weights=None):
   Transpose coords to zero at centroid
   """
   
+  return center_coord_models(coords[None,:], weights)[0]
+
+
+def center_coord_models(coord_models, weights=None):
+  """
+  Transpose each of a stack of coord models to zero at its centroid.
+  Weights may be per particle or per model and particle.
+  """
+  
   if weights is None:
-    sum_weights = float(len(coords))
-    wt_coords = coords.transpose()
+    center = coord_models.mean(axis=-2)
   else:
-    sum_weights = sum(weights)
-    wt_coords = coords.transpose() * weights
-    
-  xyz_totals = wt_coords.sum(axis=1)
-  center = xyz_totals/sum_weights
-  cen_coords = coords - center
+    weights = np.broadcast_to(weights, coord_models.shape[:-1])
+    center = np.einsum('...i,...ij->...j', weights, coord_models) / weights.sum(axis=-1)[...,None]
   
-  return cen_coords
+  return coord_models - center[...,None,:]
 
 
 def calc_rmsds(ref_coords, coord_models, weights=None):
   """
-  Calculates per model and per particle RMSDs compared to reference coords
+  Calculates per model and per particle RMSDs compared to reference coords,
+  which may be a single array or one for each model
   """
   
-  n_coords = len(ref_coords)
-  n_models = len(coord_models)
+  coord_models = np.asarray(coord_models)
+  n_models, n_coords = coord_models.shape[:2]
   
   if weights is None:
     weights = np.ones(n_coords)
@@ -599,61 +723,78 @@ def calc_rmsds(ref_coords, coord_models, weights=None):
   else:
     sum_weights = sum(weights)
   
-  model_rmsds = []
-  sum_deltas2 = np.zeros((n_coords, 3))
+  deltas = coord_models-ref_coords
+  dists2 = (deltas*deltas).sum(axis=2)
   
-  for coords in coord_models:
-    deltas2 = (coords-ref_coords)**2
-    sum_deltas2 += deltas2
-    dists2 = weights*deltas2.sum(axis=1)
-    model_rmsds.append(np.sqrt(sum(dists2)/sum_weights))
+  model_rmsds = np.sqrt(dists2.dot(weights)/sum_weights)
+  particle_rmsds = np.sqrt(dists2.sum(axis=0)/n_models)
+
+  return model_rmsds, particle_rmsds
   
-  particle_rmsds = np.sqrt(sum_deltas2.sum(axis=1)/n_models)
 
-  return np.array(model_rmsds), particle_rmsds
+def calc_rmsd_matrix(coord_models):
+  """
+  Calculates the RMSDs between all pairs of coord models, without realignment
+  """
   
- 
+  n_models, n_coords = coord_models.shape[:2]
+  
+  flat = coord_models.reshape(n_models, -1)
+  sq_sums = (flat*flat).sum(axis=1)
+  
+  dists2 = sq_sums[:,None] + sq_sums[None,:] - 2.0 * np.dot(flat, flat.T)
+  dists2 = np.clip(dists2, 0.0, None)/n_coords # Rounding errors can go negative
+  np.fill_diagonal(dists2, 0.0)
+  
+  return np.sqrt(dists2)
+  
+
 def align_coord_pair(coords_a, coords_b, dist_scale=1.0):
   """
   Align two coord arrays.
   Returns the transformed version of coords_a and coords_b.
-  Returns the model and particle RMSD.
   """
   
-  n = len(coords_a)
-  weights = np.ones(n, float) # All particles intially weighted equally
+  coords_a, coords_b = align_coord_batch(coords_a, coords_b[None,:], dist_scale)
+    
+  return coords_a[0], coords_b[0]
   
-  # Move both coords arrays to origin, original inputs are preserved
-  coords_a = center_coords(coords_a, weights)
-  coords_b = center_coords(coords_b, weights)
   
-  # Align B to A and get RMDs of transformed coords
-  coords_b1 = svd_rotate(coords_a, coords_b, weights)
-  rmsd_1, particle_rmsds_1 = calc_rmsds(coords_a, [coords_b1], weights)
-
-  # Align mirror B to A and get RMDs of transformed coords
-  coords_b2 = svd_rotate(coords_a, -coords_b, weights)
-  rmsd_2, particle_rmsds_2 = calc_rmsds(coords_a, [coords_b2], weights)
-
-  if rmsd_1[0] < rmsd_2[0]:
-    coords_b = coords_b1
-    particle_rmsds = particle_rmsds_1
-    
-  else: # Mirror is best
-    coords_b = coords_b2
-    particle_rmsds = particle_rmsds_2
+def align_coord_batch(coords_a, coord_models, dist_scale=1.0):
+  """
+  Align each of a stack of coord models to coords_a, as for separate align_coord_pair calls.
+  Returns a stack of transformed versions of coords_a, one per model, and the transformed models.
+  """
+  
+  coord_models = np.asarray(coord_models, float)
+  
+  # Move all coords arrays to origin, original inputs are preserved
+  coords_a = center_coords(coords_a)
+  coords_b = center_coord_models(coord_models)
+  
+  # Align models, and their mirror images, to A and get RMDs of transformed coords
+  coords_b1 = svd_rotate_models(coords_a, coords_b)
+  deltas = coords_b1 - coords_a
+  dists2_1 = (deltas*deltas).sum(axis=2)
+  
+  coords_b2 = svd_rotate_models(coords_a, -coords_b)
+  deltas = coords_b2 - coords_a
+  dists2_2 = (deltas*deltas).sum(axis=2)
+  
+  mirror = dists2_2.sum(axis=1) <= dists2_1.sum(axis=1) # Mirror is best
+  coords_b = np.where(mirror[:,None,None], coords_b2, coords_b1)
+  particle_rmsds = np.sqrt(np.where(mirror[:,None], dists2_2, dists2_1))
+  coords_a = np.broadcast_to(coords_a, coords_b.shape)
         
   # Refine alignment with exponential weights that deminish as RMSD increases
   if dist_scale:
-    med_rmsd = np.median(particle_rmsds) # Gives a degree of scale invariance
+    med_rmsd = np.median(particle_rmsds, axis=1)[:,None] # Gives a degree of scale invariance
     weight_scale = particle_rmsds / dist_scale
     weights_exp = np.exp(-weight_scale*weight_scale*med_rmsd)
 
-    coords_a = center_coords(coords_a, weights_exp)
-    coords_b = center_coords(coords_b, weights_exp)
-    coords_b = svd_rotate(coords_a, coords_b, weights_exp)
-  
-
+    coords_a = center_coord_models(coords_a, weights_exp)
+    coords_b = center_coord_models(coords_b, weights_exp)
+    coords_b = svd_rotate_models(coords_a, coords_b, weights_exp)
     
   return coords_a, coords_b
   
@@ -669,7 +810,7 @@ def align_coord_models(coord_models, n_iter=1, dist_scale=True):
   Returns aligned coords models, RMSD of each model and RMSD of each particle relative to mean.
   """
 
-  coord_models = np.array(coord_models)
+  coord_models = np.array(coord_models, float)
   n_models, n_coords = coord_models.shape[:2]
       
   if dist_scale is True:
@@ -677,13 +818,11 @@ def align_coord_models(coord_models, n_iter=1, dist_scale=True):
   else:
     init_dist_scale = dist_scale
   
-  # Align to first model arbitrarily
-  ref_coords = coords_a = coord_models[0]
-  for i, coords in enumerate(coord_models[1:], 1):
-    coords_a, coords_b = align_coord_pair(ref_coords, coords, init_dist_scale)
-    coord_models[i] = coords_b
-    
-  coord_models[0] = coords_a # First model has been centred
+  # Align to first model arbitrarily; all models are aligned together in each batch
+  if n_models > 1:
+    coords_a, coords_b = align_coord_batch(coord_models[0], coord_models[1:], init_dist_scale)
+    coord_models[1:] = coords_b
+    coord_models[0] = coords_a[-1] # First model has been centred
 
   # Align all coord models to closest to mean (i.e. a real model)
   # given initial mean could be wonky if first model was poor
@@ -694,31 +833,21 @@ def align_coord_models(coord_models, n_iter=1, dist_scale=True):
     dist_scale = np.percentile(particle_rmsds, [99.0])[0]
     
   j = np.array(model_rmsds).argmin()
-  ref_coords = coord_models[j]
+  others = np.arange(n_models) != j
   
-  for i, coords in enumerate(coord_models):
-    if i != j:
-      coords_a, coords_b = align_coord_pair(ref_coords, coords, dist_scale)
-      coord_models[i] = coords_b
+  if n_models > 1:
+    coords_a, coords_b = align_coord_batch(coord_models[j], coord_models[others], dist_scale)
+    coord_models[others] = coords_b
   
   # Align all coord models to mean and converge iteratively
   for j in range(n_iter):
-    ref_coords = coord_models.mean(axis=0)
-    for i, coords in enumerate(coord_models):
-      coords_a, coords_b = align_coord_pair(ref_coords, coords, dist_scale)
-      coord_models[i] = coords_b
+    coords_a, coord_models = align_coord_batch(coord_models.mean(axis=0), coord_models, dist_scale)
       
   # Final mean for final RMSDs
 
   model_mean_rmsds, particle_rmsds = calc_rmsds(coord_models.mean(axis=0), coord_models)
   
-  model_rmsds = np.zeros((n_models, n_models))
-
-  for i in range(n_models-1):
-    for j in range(i+1, n_models):
-       rmsds, null = calc_rmsds(coord_models[i], [coord_models[j]])
-       model_rmsds[i,j] = rmsds[0]
-       model_rmsds[j,i] = rmsds[0]
+  model_rmsds = calc_rmsd_matrix(coord_models)
   
   return coord_models, model_rmsds, model_mean_rmsds, particle_rmsds
 
@@ -4,19 +4,77 @@ from collections import defaultdict
 from nuc_tools import io
 from nuc_tools import util
 
-def load_data_track(file_path):
+MAX_CHROMO_RUNS = 256 # Chunks with more separate runs of chromosome rows are sorted first
+
+def _parse_data_track_lines(lines, line_nums, have_anno, have_val, have_strand):
   """
-  Renamed version using special compound dtype
+  Parse a chunk of BED lines column-wise, without making Python objects for each row.
+  Returns the chromosome names and a DATA_TRACK_TYPE array of the rows.
+  """
+  
+  cols = [('chromo', 'U64'), ('pos1', 'i8'), ('pos2', 'i8')]
+  
+  if have_anno:
+    cols.append(('label', 'S32'))
+  
+  if have_val:
+    cols.append(('value', 'f8'))
+    
+  if have_strand:
+    cols.append(('strand', 'U1'))
+    
+  try:
+    data = np.loadtxt(lines, dtype=cols, comments=None, ndmin=1, usecols=range(len(cols)))
+  except ValueError: # Rows with different numbers of fields; only the first are used
+    data = [tuple(line.split()[:len(cols)]) for line in lines]
+    data = np.array(data, dtype=[(name, 'U64') for name, dtype in cols]).astype(cols)
+  
+  track = np.empty(len(data), util.DATA_TRACK_TYPE)
+  track['pos1'] = data['pos1']
+  track['pos2'] = data['pos2']
+  
+  if have_anno:
+    track['label'] = data['label']
+  else:
+    track['label'] = line_nums.astype('S32')
+
+  if have_val:
+    track['value'] = data['value']
+  else:
+    track['value'] = 1.0
+  
+  if have_strand:
+    track['strand'] = data['strand'] != '-'
+  else:
+    track['strand'] = True
+    
+  track['orig_value'] = track['value']
+  
+  return data['chromo'], track
+  
+  
+def load_data_track(file_path, cache=None):
+  """
+  Renamed version using special compound dtype.
+  The file is parsed in chunks of lines. By default, any current binary .ntrk cache of the
+  parsed track is memory-mapped, but none is written. If cache is set, a cache is also written
+  on first load, where the directory is writable. If cache is False, the text is always parsed.
   """
+  
+  if cache is not False:
+    data_dicts = io.load_data_track_cache(file_path)
+    
+    if data_dicts:
+      return data_dicts['']
 
-  data_dict = defaultdict(set)
+  data_dict = defaultdict(list)
   
   with io.open_file(file_path, partial=True) as file_obj:
-    file_pos = 0
+    n_header = 0
     line = file_obj.readline()
     
     while line.startswith('browser') or line.startswith('track'):
-      file_pos = file_obj.tell() # before a non-header line
+      n_header += 1 # Lines before a non-header line
       line = file_obj.readline()    
     
     while line[0] == '#':
@@ -28,35 +86,50 @@ def load_data_track(file_path):
     have_strand = n_fields > 5
       
   with io.open_file(file_path) as file_obj:
-    file_obj.seek(file_pos)
+    for j in range(n_header): # Gzipped input may be a pipe, so can't seek
+      file_obj.readline()
     
-    for i, line in enumerate(file_obj):
-      if line[0] == '#':
+    i = 0
+    
+    for lines in io.iter_line_chunks(file_obj):
+      line_nums = np.arange(i, i+len(lines))
+      i += len(lines)
+      
+      # Line numbers are labels if none are present
+      keep = [k for k, line in enumerate(lines) if line[0] != '#']
+      
+      if len(keep) < len(lines):
+        lines = [lines[k] for k in keep]
+        line_nums = line_nums[keep]
+      
+      if not lines:
         continue
-        
-      data = line.split()
-      chromo = data[0]
-      start = int(data[1])
-      end = int(data[2])
-           
-      if have_anno:
-        label = data[3]
-      else:
-        label = '%d' % i
       
-      if have_val:
-        value = float(data[4])
-      else:
-        value = 1.0
-                  
-      if have_strand:
-        strand = 0 if data[5] == '-' else 1
-      else:
-        strand = 1
-            
-      data_dict[chromo].add((start, end, strand, value, value, label))
+      chromos, track = _parse_data_track_lines(lines, line_nums, have_anno, have_val, have_strand)
+      
+      # Runs of rows for the same chromosome; usually few as BED files are normally sorted
+      bounds = np.flatnonzero(chromos[1:] != chromos[:-1]) + 1
+      
+      if len(bounds) > MAX_CHROMO_RUNS:
+        order = np.argsort(chromos, kind='stable')
+        chromos = chromos[order]
+        track = track[order]
+        bounds = np.flatnonzero(chromos[1:] != chromos[:-1]) + 1
+      
+      starts = [0] + bounds.tolist()
+      ends = bounds.tolist() + [len(track)]
+      
+      for a, b in zip(starts, ends):
+        data_dict[str(chromos[a])].append(track[a:b])
+  
+  data_dict = {chromo:np.concatenate(data_dict[chromo]) for chromo in data_dict}
+  data_dict = util.finalise_data_track(data_dict)
+  
+  if cache and io.can_write_cache(io.get_track_cache_path(file_path)):
+    io.save_data_track_cache(file_path, {'':data_dict})
 
-  return util.finalise_data_track(data_dict)
+  return data_dict
+  
   
 def save_data_track(file_path, data_dict, scale=1.0, as_float=False):
   """
@@ -1,7 +1,16 @@
-import re
+import os, re
 import numpy as np
 
+from collections import OrderedDict
+try:
+  from collections.abc import Mapping
+except ImportError: # Python 2
+  from collections import Mapping
+
 FASTA_SEQ_LINE = re.compile('(\S{59})(\S)')
+FASTA_LINE_LEN = 60
+FASTA_INDEX_EXT = '.fai'
+FASTA_BLOCK_BYTES = 2**24 # Size of file blocks read when scanning or bulk loading sequences
 
 def fasta_item(name, seq, end=''):
 
@@ -34,63 +43,434 @@ def compact_dna_seq(seq):
   return seq_array
 """
 
-def read_fasta(path_or_io, as_dict=True, full_heads=False,
-               max_seqs=None, as_array=False):
+def write_fasta_seq(file_obj, name, seq, line_len=FASTA_LINE_LEN):
+  """
+  Write one named sequence, given as bytes or a uint8 array, to a binary file object in upper case,
+  as fasta_item() but without making intermediate strings of long, e.g. chromosome, sequences.
+  """
+  
+  seq = np.frombuffer(bytes(seq).upper(), np.uint8)
+  n = len(seq)
+  m = n - (n % line_len)
+  
+  lines = np.empty((m // line_len, line_len+1), np.uint8)
+  lines[:,:line_len] = seq[:m].reshape(-1, line_len)
+  lines[:,line_len] = ord('\n')
+  
+  file_obj.write(('>%s\n' % name).encode('ascii'))
+  file_obj.write(lines.data)
+  
+  if m < n:
+    file_obj.write(seq[m:].tobytes() + b'\n')
 
-  named_seqs = []
-  append = named_seqs.append
+
+def iter_fasta(path_or_io, full_heads=False, as_array=False):
+  """
+  Generator for (name, sequence) pairs from a FASTA file or stream, one at a time, so that only
+  one sequence need be held in memory. Sequences are upper case strings, or uint8 arrays if
+  as_array is set.
+  """
+  
   name = None
   seq = []
   join = ''.join
   
-  if isinstance(path_or_io, (str, unicode)):
-    io_stream = open(path_or_io, 'rU', 2**6)
+  if isinstance(path_or_io, str):
+    io_stream = open(path_or_io, 'r', 2**16)
     close_file = True
   else:
     io_stream = path_or_io    
     close_file = False
-    
-  for line in io_stream:
-    line = line.rstrip()
+  
+  try:
+    for line in io_stream:
+      line = line.rstrip()
  
-    if not line:
-      continue
+      if not line:
+        continue
  
-    if line[0] == '>':
-      if name:
-        seq = join(seq)
-      
-        if as_array:
-          seq = np.fromstring(seq, np.uint8)
+      if line[0] == '>':
+        if name:
+          seq = join(seq)
         
-        append((name, seq))
+          if as_array:
+            seq = np.frombuffer(bytearray(seq, 'ascii'), np.uint8)
+          
+          yield name, seq
+ 
+        seq = []
+        if full_heads:
+          name = line[1:]
+        else:
+          name = line[1:].split()[0]  
+          
+      else:
+        seq.append(line.upper())
+ 
+    if name:
+      seq = join(seq)
+      if as_array:
+        seq = np.frombuffer(bytearray(seq, 'ascii'), np.uint8)
         
-        if max_seqs and len(named_seqs) == max_seqs:
-          name = None
+      yield name, seq
+  
+  finally:
+    if close_file:
+      io_stream.close()
+
+
+def read_fasta(path_or_io, as_dict=True, full_heads=False,
+               max_seqs=None, as_array=False):
+
+  named_seqs = []
+  
+  for name, seq in iter_fasta(path_or_io, full_heads, as_array):
+    named_seqs.append((name, seq))
+    
+    if max_seqs and len(named_seqs) == max_seqs:
+      break
+  
+  if as_dict:
+    return dict(named_seqs)
+  
+  else:
+    return named_seqs
+
+
+# #  Indexed FASTA access  # #
+
+def get_index_path(fasta_path):
+  
+  return fasta_path + FASTA_INDEX_EXT
+  
+  
+def _add_index_lines(record, lengths, widths):
+  """
+  Accumulate the sequence lines of a FASTA record, given the numbers of bases and bytes per line,
+  checking that all but the last lines have the same length, as required for indexing.
+  """
+  
+  name, n_bases, line_bases, line_width, ended = record
+  
+  if not len(lengths):
+    return record
+  
+  if line_bases is None:
+    line_bases = int(lengths[0])
+    line_width = int(widths[0])
+  
+  is_short = (lengths != line_bases) | (widths != line_width) # Only valid at the end
+  
+  if ended and np.any(lengths > 0):
+    raise ValueError('FASTA record "%s" has irregular line lengths and cannot be indexed' % name)
+  
+  if np.any(is_short):
+    k = int(np.argmax(is_short))
+    
+    if (lengths[k] > line_bases) or np.any(lengths[k+1:] > 0):
+      raise ValueError('FASTA record "%s" has irregular line lengths and cannot be indexed' % name)
+  
+    ended = True
+  
+  return name, n_bases + int(lengths.sum()), line_bases, line_width, ended
+  
+
+def make_fasta_index(fasta_path, block_size=FASTA_BLOCK_BYTES):
+  """
+  Scan an uncompressed FASTA file, in large blocks, for an index of its sequence records, as for
+  samtools faidx. Returns an OrderedDict of name : (length, byte offset, bases per line,
+  bytes per line). Raises ValueError if a record's lines are not of regular length.
+  """
+  
+  index = OrderedDict()
+  record = None
+  offset = 0 # Of current block
+  
+  def close_record(record):
+    if record:
+      name, n_bases, line_bases, line_width, ended = record
+      
+      if name in index:
+        raise ValueError('FASTA file %s has duplicate sequence name "%s"' % (fasta_path, name))
+      
+      index[name] = (n_bases, seq_offsets[name], line_bases or 0, line_width or 0)
+  
+  seq_offsets = {}
+  
+  with open(fasta_path, 'rb') as file_obj:
+    rem = b''
+    
+    while True:
+      block = file_obj.read(block_size)
+      
+      if not block:
+        if not rem:
           break
+      
+        block = b'\n' # Terminate any final line
+        
+      buff = np.frombuffer(rem + block, np.uint8)
+      ends = np.flatnonzero(buff == 10)
+      
+      if not len(ends):
+        rem = buff.tobytes()
+        continue
+      
+      starts = np.empty(len(ends), np.int64)
+      starts[0] = 0
+      starts[1:] = ends[:-1] + 1
+      
+      widths = ends - starts + 1
+      lengths = widths - 1
+      lengths[lengths > 0] -= buff[ends[lengths > 0]-1] == 13 # Carriage returns
+      is_head = buff[starts] == 62 # '>'
+      
+      heads = np.flatnonzero(is_head)
+      prev = 0
+      
+      for k in heads:
+        if record:
+          record = _add_index_lines(record, lengths[prev:k], widths[prev:k])
+          
+        close_record(record)
+        line = buff[starts[k]+1:ends[k]].tobytes().decode('ascii', 'replace').split()
+        name = line[0] if line else ''
+        seq_offsets[name] = offset + int(ends[k]) + 1
+        record = (name, 0, None, None, False)
+        prev = k+1
+
+      if record:
+        record = _add_index_lines(record, lengths[prev:], widths[prev:])
+        
+      offset += int(ends[-1]) + 1
+      rem = buff[ends[-1]+1:].tobytes()
+  
+  close_record(record)
+  
+  return index
+  
 
-      seq  = []
-      if full_heads:
-        name = line[1:]
+def write_fasta_index(index_path, index):
+  
+  with open(index_path, 'w') as file_obj:
+    for name in index:
+      file_obj.write('%s\t%d\t%d\t%d\t%d\n' % ((name,) + tuple(index[name])))
+
+
+def read_fasta_index(fasta_path, index_path=None):
+  """
+  Read the .fai index of a FASTA file, making and saving it if it is absent or older than the
+  FASTA file. Returns an OrderedDict as make_fasta_index().
+  """
+  
+  from nuc_tools import util
+  
+  if not index_path:
+    index_path = get_index_path(fasta_path)
+  
+  if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(fasta_path):
+    index = OrderedDict()
+    
+    with open(index_path) as file_obj:
+      for line in file_obj:
+        name, length, offset, line_bases, line_width = line.split('\t')[:5]
+        index[name] = (int(length), int(offset), int(line_bases), int(line_width))
+    
+    return index
+  
+  util.info('Indexing FASTA file %s' % fasta_path)
+  index = make_fasta_index(fasta_path)
+  
+  try:
+    write_fasta_index(index_path, index)
+  except (IOError, OSError) as err:
+    util.warn('Could not write FASTA index %s: %s' % (index_path, err))
+  
+  return index
+
+
+class FastaSeq(object):
+  """
+  Memory-mapped view of one sequence in an indexed FASTA file, which reads nothing until used.
+  Slicing and indexing give uint8 arrays of the bases only, with line ends removed as required;
+  ranges within one line are read-only views of the file. The sequence is in the case of the
+  file, unless upper is set, whereupon copies are made.
+  """
+  
+  def __init__(self, mmap, length, offset, line_bases, line_width, upper=False):
+    
+    self.length = length
+    self.line_bases = line_bases or 1
+    self.line_gap = line_width - line_bases
+    self.upper = upper
+    self._data = mmap[offset:offset + self._get_offset(length)] if length else mmap[:0]
+  
+  
+  def _get_offset(self, pos):
+    
+    return pos + (pos // self.line_bases) * self.line_gap
+  
+  
+  def __len__(self):
+    
+    return self.length
+  
+  
+  def __getitem__(self, key):
+    
+    if isinstance(key, slice):
+      start, end, step = key.indices(self.length)
+      
+      if (step == 1) and (end > start):
+        start_offset = self._get_offset(start)
+        end_offset = self._get_offset(end-1) + 1
+        
+        if start_offset + end - start == end_offset: # Within a line
+          data = self._data[start_offset:end_offset]
+        else:
+          data = self._data[self._get_offset(np.arange(start, end))]
+      
       else:
-        name = line[1:].split()[0]  
+        data = self._data[self._get_offset(np.arange(start, end, step))]
+    
+    elif isinstance(key, (int, np.integer)):
+      if key < 0:
+        key += self.length
+      
+      if not (0 <= key < self.length):
+        raise IndexError('Sequence position %d out of range' % key)
         
+      data = self._data[self._get_offset(np.array([key]))]
+    
     else:
-      seq.append(line.upper())
+      key = np.asarray(key)
+      data = self._data[self._get_offset(np.where(key < 0, key + self.length, key))]
+    
+    data = np.asarray(data)
+    
+    if self.upper:
+      data = np.where((data > 96) & (data < 123), data - 32, data).astype(np.uint8)
+    
+    if isinstance(key, (int, np.integer)):
+      return data[0]
+    
+    return data
+  
+  
+  def __array__(self, dtype=None, copy=None):
+    
+    data = self[:]
+    
+    if dtype is not None:
+      data = data.astype(dtype)
+    
+    return data
+    
 
-  if name:
-    seq = join(seq)
-    if as_array:
-      seq = np.fromstring(seq, np.uint8)
+class IndexedFasta(Mapping):
+  """
+  Dictionary-like random access to the sequences of an uncompressed FASTA file via its .fai
+  index, which is made if needed. Items are FastaSeq views of the memory-mapped file, so only
+  the parts of sequences that are used are read. Whole sequences are best loaded with read_seq().
+  """
+  
+  def __init__(self, fasta_path, upper=False, index_path=None):
+    
+    self.fasta_path = fasta_path
+    self.upper = upper
+    self.index = read_fasta_index(fasta_path, index_path)
+    
+    if os.path.getsize(fasta_path):
+      self._mmap = np.memmap(fasta_path, np.uint8, mode='r')
+    else:
+      self._mmap = np.zeros(0, np.uint8)
+  
+  
+  def __getitem__(self, name):
+    
+    return FastaSeq(self._mmap, *self.index[name], upper=self.upper)
+  
+  
+  def __iter__(self):
+    
+    return iter(self.index)
+  
+  
+  def __len__(self):
+    
+    return len(self.index)
+  
+  
+  def get_length(self, name):
+    
+    return self.index[name][0]
+    
+  
+  def read_seq(self, name, block_size=FASTA_BLOCK_BYTES):
+    """
+    Read a whole sequence, in large blocks of whole lines, into a new, writable uint8 array
+    """
+    
+    length, offset, line_bases, line_width = self.index[name]
+    seq = np.empty(length, np.uint8)
+    
+    if not length:
+      return seq
+    
+    n_lines = max(1, block_size // line_width) # Per block
+    n_full = length // line_bases
+    
+    with open(self.fasta_path, 'rb') as file_obj:
+      file_obj.seek(offset)
       
-    append((name, seq))    
+      for i in range(0, n_full, n_lines):
+        j = min(n_full, i+n_lines)
+        block = bytearray((j-i) * line_width) # Final line end may be absent
+        file_obj.readinto(block)
+        
+        if self.upper:
+          block = block.upper()
+        
+        lines = np.frombuffer(block, np.uint8).reshape(j-i, line_width)
+        seq[i*line_bases:j*line_bases].reshape(j-i, line_bases)[...] = lines[:,:line_bases]
+      
+      n_rem = length - n_full * line_bases
+      
+      if n_rem:
+        block = file_obj.read(n_rem)
+        
+        if self.upper:
+          block = block.upper()
+          
+        seq[-n_rem:] = np.frombuffer(block, np.uint8)
+    
+    return seq
   
-  if close_file:
-    io_stream.close()
   
-  if as_dict:
-    return dict(named_seqs)
+def iter_fasta_arrays(fasta_path, min_len=0):
+  """
+  Generator for (name, sequence) pairs from a FASTA file, where sequences are upper case, writable
+  uint8 arrays, loaded one at a time. Uncompressed files are read in bulk via their .fai index,
+  and sequences shorter than min_len are skipped without being read. Other files are parsed.
+  """
   
-  else:
-    return named_seqs  
+  from nuc_tools import io, util
+  
+  if os.path.splitext(fasta_path)[1].lower() not in io.GZIP_EXTENSIONS:
+    try:
+      seq_dict = IndexedFasta(fasta_path, upper=True)
+      
+    except ValueError as err:
+      util.warn('%s; reading without index' % err)
     
+    else:
+      for name in seq_dict:
+        if seq_dict.get_length(name) >= min_len:
+          yield name, seq_dict.read_seq(name)
+      
+      return
+  
+  with io.open_file(fasta_path) as file_obj:
+    for name, seq in iter_fasta(file_obj, as_array=True):
+      if len(seq) >= min_len:
+        yield name, seq
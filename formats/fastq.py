@@ -1,10 +1,13 @@
 import os
+import numpy as np
 
+from numpy.lib.stride_tricks import sliding_window_view
 from nuc_tools import io, util
 
 # #   Globals  # #
 
 FASTQ_READ_CHUNK = 1048576
+FASTQ_BATCH_BYTES = 2**24 # Approximate size of clipping tasks
 
 
 # #  FASTQ  format  # #
@@ -139,3 +142,239 @@ def pair_files(fastq_paths, pair_tags=('r_1','r_2'), err_msg='Could not pair FAS
   return fastq_paths_r1, fastq_paths_r2
 
 
+
+
+# #  Read clipping  # #
+
+def _get_record_ends(block):
+  
+  return np.flatnonzero(np.frombuffer(block, np.uint8) == ord('\n'))[3::4]
+  
+
+def read_batches(file_paths, batch_bytes=FASTQ_BATCH_BYTES):
+  """
+  Generator for batches of reads from one or more FASTQ files, e.g. read pairs, read in step.
+  Yields a tuple containing a block of bytes, for whole four-line records, for each file.
+  The size of each batch is set by reading batch_bytes from the first file. Any lines before
+  the first record, i.e. starting with "@", are skipped.
+  """
+  
+  file_objs = [io.open_file(file_path, 'rb') for file_path in file_paths]
+  buffers = []
+  
+  for file_obj in file_objs:
+    line = file_obj.readline()
+    
+    while line and not line.startswith(b'@'):
+      line = file_obj.readline()
+    
+    buffers.append(line)
+  
+  try:
+    while True:
+      data = file_objs[0].read(batch_bytes)
+      buffers[0] += data
+      n_rec = len(_get_record_ends(buffers[0])) if data else None # None : read all remaining
+      blocks = []
+      
+      for i, file_obj in enumerate(file_objs):
+        rec_ends = _get_record_ends(buffers[i])
+        
+        while i and ((n_rec is None) or (len(rec_ends) < n_rec)):
+          data = file_obj.read(batch_bytes)
+          
+          if not data:
+            break
+          
+          buffers[i] += data
+          rec_ends = _get_record_ends(buffers[i])
+        
+        if (n_rec is None) or (len(rec_ends) < n_rec):
+          cut = len(buffers[i])
+        elif n_rec:
+          cut = rec_ends[n_rec-1] + 1
+        else:
+          cut = 0
+        
+        blocks.append(buffers[i][:cut])
+        buffers[i] = buffers[i][cut:]
+      
+      if any(blocks):
+        yield tuple(blocks)
+      
+      if n_rec is None:
+        break
+  
+  finally:
+    for file_obj in file_objs:
+      file_obj.close()
+
+
+def _gather_segments(src, starts, lengths):
+  """
+  Concatenate segments of an array, given start positions and lengths, in order
+  """
+  
+  starts = starts.ravel()
+  lengths = lengths.ravel()
+  ends = np.cumsum(lengths)
+  
+  if not len(ends):
+    return src[:0]
+  
+  idx = np.arange(ends[-1])
+  idx += np.repeat(starts - ends + lengths, lengths)
+  
+  return src[idx]
+
+
+def _clip_block(block, min_qual_ord, adapt_seqs, min_len, min_overlap):
+  """
+  Clip the reads of a FASTQ block, as bytes; first removing trailing Ns and then low quality
+  bases from the end and start, before truncating at the first adapter match, if any.
+  Returns the clipped FASTQ as a byte array, the lengths of its records and the read counts. 
+  """
+  
+  if not block.endswith(b'\n'):
+    block += b'\n'
+  
+  line_ends = np.flatnonzero(np.frombuffer(block, np.uint8) == ord('\n'))
+  n_missing = -len(line_ends) % 4
+  
+  if n_missing: # Truncated record
+    block += b'\n' * n_missing
+    line_ends = np.append(line_ends, np.arange(len(block)-n_missing, len(block)))
+  
+  data = np.frombuffer(block, np.uint8)
+  line_starts = np.append(0, line_ends[:-1]+1)
+  line_ends -= (data[line_ends-1] == ord('\r')) & (line_ends > line_starts)
+  
+  seq_starts = line_starts[1::4]
+  seq_lens = line_ends[1::4] - seq_starts
+  qual_starts = line_starts[3::4]
+  qual_lens = line_ends[3::4] - qual_starts
+  n = len(seq_starts)
+  
+  starts = np.zeros(n, np.int64)
+  ends = seq_lens.copy()
+  
+  # Quality clip; only reads with a trailing N or a low quality end are clipped 
+  
+  idx = (seq_lens > 0) & (data[seq_starts+seq_lens-1] == ord('N'))
+  idx |= (qual_lens > 0) & (data[qual_starts+qual_lens-1] < min_qual_ord)
+  idx |= (qual_lens > 0) & (data[qual_starts] < min_qual_ord)
+  idx = np.flatnonzero(idx)
+  n_qclip = len(idx)
+  
+  if n_qclip:
+    max_len = max(seq_lens[idx].max(), qual_lens[idx].max())
+    pos = np.arange(max_len)
+    windows = sliding_window_view(np.append(data, np.zeros(max_len, np.uint8)), max_len)
+    
+    good = (pos < seq_lens[idx,None]) & (windows[seq_starts[idx]] != ord('N'))
+    sub_ends = np.where(good.any(axis=1), max_len - good[:,::-1].argmax(axis=1), 0)
+    
+    good = (pos < sub_ends[:,None]) & (pos < qual_lens[idx,None]) & (windows[qual_starts[idx]] >= min_qual_ord)
+    is_good = good.any(axis=1)
+    ends[idx] = np.where(is_good, max_len - good[:,::-1].argmax(axis=1), 0)
+    starts[idx] = np.where(is_good, good.argmax(axis=1), 0)
+  
+  # Adapter clip; at the first occurrence of an adapter start within each clipped read
+  
+  is_adapt = np.zeros(n, bool)
+  
+  for adapt_seq in adapt_seqs:
+    if not isinstance(adapt_seq, bytes):
+      adapt_seq = adapt_seq.encode('ascii')
+    
+    seek = adapt_seq[:min_overlap]
+    hits = []
+    i = block.find(seek)
+    
+    while i >= 0:
+      hits.append(i)
+      i = block.find(seek, i+1)
+    
+    hits = np.array(hits, np.int64)
+    idx = np.searchsorted(seq_starts, hits, side='right') - 1
+    
+    valid = idx >= 0
+    hits = hits[valid]
+    idx = idx[valid]
+    valid = (hits >= seq_starts[idx] + starts[idx]) & (hits+len(seek) <= seq_starts[idx] + ends[idx])
+    idx, first = np.unique(idx[valid], return_index=True) # Hits are sorted
+    hits = hits[valid][first]
+    
+    valid = ~is_adapt[idx]
+    idx = idx[valid]
+    hits = hits[valid]
+    
+    # Read must continue as part of the adapter
+    limits = np.minimum(hits+len(adapt_seq), seq_starts[idx] + ends[idx])
+    valid = np.array([block[a:b] in adapt_seq for a, b in zip(hits, limits)], bool)
+    idx = idx[valid]
+    
+    ends[idx] = hits[valid] - seq_starts[idx]
+    is_adapt[idx] = True
+  
+  read_lens = ends - starts
+  counts = np.array([n, n_qclip, np.count_nonzero(is_adapt),
+                     np.count_nonzero(read_lens < min_len), read_lens.sum()], np.int64)
+  
+  # Output is the input without the clipped ranges of sequence and quality lines
+  
+  rec_starts = line_starts[0::4]
+  rec_lens = np.diff(np.append(rec_starts, len(block)))
+  rec_lens -= seq_lens - read_lens
+  rec_lens -= np.maximum(qual_lens - read_lens, 0)
+  
+  idx = np.flatnonzero(read_lens < seq_lens)
+  
+  if len(idx):
+    qual_ends = np.minimum(qual_starts[idx] + ends[idx], qual_starts[idx] + qual_lens[idx])
+    
+    # Clipped ranges are ordered and do not overlap; keep the alternate runs between them
+    clip_starts = np.stack([seq_starts[idx], seq_starts[idx] + ends[idx],
+                            qual_starts[idx], qual_ends], axis=1).ravel()
+    clip_ends = np.stack([seq_starts[idx] + starts[idx], seq_starts[idx] + seq_lens[idx],
+                          qual_starts[idx] + starts[idx], qual_starts[idx] + qual_lens[idx]], axis=1).ravel()
+    
+    edges = np.stack([clip_starts, clip_ends], axis=1).ravel()
+    run_lens = np.diff(np.concatenate([[0], edges, [len(data)]]))
+    keep = np.zeros(len(run_lens), bool)
+    keep[0::2] = True
+    
+    data = data[np.repeat(keep, run_lens)]
+  
+  return data, rec_lens, counts
+
+
+def clip_read_blocks(blocks, min_qual_ord, adapt_seqs=(), min_len=0, min_overlap=7):
+  """
+  Clip reads at poor quality base calls and adapter sequences, for a tuple of FASTQ blocks,
+  from read_batches(). Any paired blocks are interleaved, one record from each in turn.
+  Quality clipping applies to base calls with quality bytes less than min_qual_ord. Adapter
+  matches are sought from the first min_overlap bases of each adapter sequence.
+  Returns the clipped FASTQ as bytes and an array of read counts for each block: total,
+  quality clipped, adapter clipped, shorter than min_len and summed read lengths.
+  """
+  
+  outs, rec_lens, counts = zip(*[_clip_block(block, min_qual_ord, adapt_seqs, min_len, min_overlap)
+                                 for block in blocks])
+  
+  if len(blocks) == 1:
+    fastq_data = outs[0]
+  
+  else:
+    n = min(len(x) for x in rec_lens)
+    rec_offs = []
+    offset = 0
+    
+    for lens in rec_lens:
+      rec_offs.append(np.cumsum(lens[:n]) - lens[:n] + offset)
+      offset += lens.sum()
+    
+    fastq_data = _gather_segments(np.concatenate(outs), np.stack(rec_offs, axis=1),
+                                  np.stack([x[:n] for x in rec_lens], axis=1))
+  
+  return fastq_data.tobytes(), np.array(counts)
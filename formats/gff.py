@@ -17,9 +17,25 @@ def get_feature_count(file_path):
   return features
   
 
-def load_data_track(file_path, features=None):
+def load_data_track(file_path, features=None, cache=None):
   # Should work with GFF and GTF
   # returns several data dicts, one for each type of feature ( all features if feature=None)
+  # By default any current binary .ntrk cache is memory-mapped, but none is written. If cache
+  # is set, all features are parsed and written to a cache on first load, where the directory
+  # is writable. If cache is False, the text is always parsed.
+  
+  if cache is not False:
+    data_dicts = io.load_data_track_cache(file_path)
+    
+    if (data_dicts is None) and cache and io.can_write_cache(io.get_track_cache_path(file_path)):
+      data_dicts = load_data_track(file_path, cache=False)
+      io.save_data_track_cache(file_path, data_dicts)
+    
+    if data_dicts is not None:
+      if features:
+        data_dicts = {feat:data_dicts[feat] for feat in data_dicts if feat in features}
+    
+      return data_dicts
   
   sep1 = ';' # v3
   sep2 = '='
@@ -74,7 +90,7 @@ def load_data_track(file_path, features=None):
         continue
       
       if feat not in data_dicts:
-        data_dicts[feat] = defaultdict(set)
+        data_dicts[feat] = defaultdict(list)
       
       if n > 8 and sep1:
         attribs = [x for x in data[8].split(sep1) if x]
@@ -92,19 +108,18 @@ def load_data_track(file_path, features=None):
         val = score/1000.0
  
       strand = 0 if strand == '-' else 1
-      data_dicts[feat][chromo].add((int(start), int(end), strand, score, val, label[:32]))
+      data_dicts[feat][chromo].append((int(start), int(end), strand, score, val, label[:32]))
   
   for feat, data_dict in data_dicts.items():
     for chromo in sorted(data_dict):
       if chromo in chromo_map:
         chrom_name = 'chr' + chromo_map[chromo]
         
-        if chrom_name not in data_dict:
-          data_dict[chrom_name] = set()
-        
-        data_dict[chrom_name] |= data_dict[chromo]
+        data_dict[chrom_name] += data_dict[chromo]
       
   for feat, data_dict in data_dicts.items():
+    # Rows are made unique when finalised
+    data_dict = {chromo:np.array(data_dict[chromo], dtype=util.DATA_TRACK_TYPE) for chromo in data_dict}
     data_dicts[feat] = util.finalise_data_track(data_dict)
      
   return data_dicts
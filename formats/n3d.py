@@ -1,6 +1,12 @@
 import numpy as np
 import math
 
+# #   Globals  # #
+
+N3DB_EXT = '.n3db'
+N3DB_VERSION = 1
+
+
 def get_chromo_limits(n3d_paths):
   """
   Get the sequence limits and bin size of particles for chromosomes
@@ -118,12 +124,136 @@ def get_bin_size(file_path):
   return bin_size
   
 
-def load_n3d_coords(file_path):
+def _read_n3d(file_path):
+  """
+  Parse an N3D format file, reading the particle lines of each chromosome block into NumPy in one go
+  """
+  
+  import core.nuc_io as io
+
+  seq_pos_dict = {}
+  coords_dict = {}
+  
+  with io.open_file(file_path) as file_obj:
+    lines = [line for line in file_obj.read().splitlines() if line.strip() and line.split(None, 1)[0] != '#']
+  
+  msg = 'Data size in file %s does not match Position + Models * Positions * 3'
+  n_lines = len(lines)
+  i = 0
+  
+  while i < n_lines:
+    data = lines[i].split()
+    i += 1
+    
+    if len(data) != 3:
+      if coords_dict:
+        raise Exception(msg % file_path)
+      else:
+        raise Exception('Missing chromosome record in file %s' % file_path)
+ 
+    chromo, n_coords, n_models = data
+    
+    if chromo in coords_dict:
+      raise Exception('Duplicate chromosome "%s" records in file %s' % (chromo, file_path))
+    
+    n_coords = int(n_coords)
+    n_models = int(n_models)
+    check = (n_models * 3) + 1
+    block = lines[i:i+n_coords]
+    i += n_coords
+    
+    if len(block) != n_coords:
+      raise Exception(msg % file_path)
+    
+    if n_coords:
+      try:
+        data = np.loadtxt(block, dtype=float, ndmin=2)
+      except ValueError: # Ragged lines or non-numeric data
+        raise Exception(msg % file_path)
+    
+    else:
+      data = np.empty((0, check), float)
+    
+    if data.shape[1] != check:
+      raise Exception(msg % file_path)
+    
+    seq_pos_dict[chromo] = data[:,0].astype(int)
+    coords_dict[chromo] = data[:,1:].reshape(n_coords, n_models, 3).transpose(1, 0, 2).copy()
+ 
+  return seq_pos_dict, coords_dict
+
+
+def get_cache_path(file_path):
+  """Path of the binary cache file for an N3D file"""
+  
+  import core.nuc_io as io
+  
+  return io.get_cache_path(file_path, N3DB_EXT)
+
+
+def build_cache(file_path, cache_path=None):
+  """
+  Parse an N3D format file and write its particle positions and coordinates to a binary .n3db cache file.
+  Returns the cache path, or None if the cache could not be written.
+  """
+  
+  import core.nuc_io as io
+  
+  if not cache_path:
+    cache_path = get_cache_path(file_path)
+  
+  seq_pos_dict, coords_dict = _read_n3d(file_path)
+  chromos = list(seq_pos_dict) # Preserves file order
+  arrays = {}
+  
+  for i, chromo in enumerate(chromos):
+    arrays['seq_pos_%d' % i] = seq_pos_dict[chromo]
+    arrays['coords_%d' % i] = coords_dict[chromo]
+  
+  header = {'version':N3DB_VERSION,
+            'chromosomes':chromos}
+  
+  if io.save_array_cache(cache_path, header, arrays, file_path):
+    return cache_path
+
+
+def load_cache(file_path, cache_path=None):
+  """
+  Load the binary cache for an N3D file, if present and current, returning dictionaries of
+  memory-mapped particle sequence positions and coordinates. Returns None otherwise.
+  """
+  
+  import core.nuc_io as io
+  
+  if not cache_path:
+    cache_path = get_cache_path(file_path)
+  
+  cache_data = io.load_array_cache(cache_path, file_path)
+  
+  if cache_data:
+    header, arrays = cache_data
+    
+    if header.get('version') == N3DB_VERSION:
+      seq_pos_dict = {}
+      coords_dict = {}
+      
+      for i, chromo in enumerate(header['chromosomes']):
+        seq_pos_dict[chromo] = arrays['seq_pos_%d' % i]
+        coords_dict[chromo] = arrays['coords_%d' % i]
+      
+      return seq_pos_dict, coords_dict
+  
+
+def load_n3d_coords(file_path, cache=None):
   """
   Load genome structure coordinates and particle sequence positions from an N3D format file.
   
   Args: 
       file_path: str ; Location of N3D (text) format file
+      cache: bool ; By default, the arrays are memory-mapped from any current binary .n3db
+                    file, but none is written. If set, a .n3db file is also written on first
+                    load, where the directory is writable. If False, the N3D file is always
+                    parsed
 
   Returns:
       dict {str:ndarray(n_coords, int)}                  ; {chromo: seq_pos_array}
@@ -131,59 +261,20 @@ def load_n3d_coords(file_path):
   
   """  
   
+  import core.nuc_util as util
   import core.nuc_io as io
-
-  seq_pos_dict = {}
-  coords_dict = {}  
   
-  with io.open_file(file_path) as file_obj:
-    chromo = None
- 
-    for line in file_obj:
- 
-      data = line.split()
-      n_items = len(data)
- 
-      if not n_items:
-        continue
- 
-      elif data[0] == '#':
-        continue
- 
-      elif n_items == 3:
-        chromo, n_coords, n_models = data
-        
-        #if chromo.lower()[:3] == 'chr':
-        #  chromo = chromo[3:]
-        
-        if chromo in coords_dict:
-          raise Exception('Duplicate chromosome "%s" records in file %s' % (chromo, file_path))
-        
-        n_coords = int(n_coords)
-        n_models = int(n_models)
- 
-        chromo_seq_pos = np.empty(n_coords, int)
-        chromo_coords = np.empty((n_models, n_coords, 3), float)
- 
-        coords_dict[chromo]  = chromo_coords
-        seq_pos_dict[chromo] = chromo_seq_pos
- 
-        check = (n_models * 3) + 1
-        i = 0
- 
-      elif not chromo:
-        raise Exception('Missing chromosome record in file %s' % file_path)
- 
-      elif n_items != check:
-        msg = 'Data size in file %s does not match Position + Models * Positions * 3'
-        raise Exception(msg % file_path)
- 
-      else:
-        chromo_seq_pos[i] = int(data[0])
- 
-        coord = [float(x) for x in data[1:]]
-        coord = np.array(coord).reshape(n_models, 3)
-        chromo_coords[:,i] = coord
-        i += 1
- 
-  return seq_pos_dict, coords_dict
+  if cache is not False:
+    cache_path = get_cache_path(file_path)
+    cache_data = load_cache(file_path, cache_path)
+    
+    if cache and not cache_data and io.can_write_cache(cache_path):
+      util.info('Building binary cache for %s' % file_path)
+      
+      if build_cache(file_path, cache_path):
+        cache_data = load_cache(file_path, cache_path)
+    
+    if cache_data:
+      return cache_data
+  
+  return _read_n3d(file_path)
@@ -6,104 +6,400 @@ from collections import defaultdict
 #NCC_FORMAT       = '%s %d %d %d %d %s %s %d %d %d %d %s %d %d %d\n'
 # See https://github.com/tjs23/nuc_processing/wiki/NCC-data-format
 
-# #   Nuc Formats  # # 
+NCC_NUM_COLS = 15
+READ_BLOCK_SIZE = 2**20 # Bytes of NCC text parsed at a time; small enough to stay in cache
+MIN_TOKEN_PAD = 24
+NCCB_EXT = '.nccb'
+NCCB_VERSION = 1
+CONTACT_COLS = ['pos_a', 'pos_b', 'num_obs', 'pair_id', 'ambig_code']
+
+# #   Block parsing  # #
+
+def _iter_line_blocks(file_obj, block_size=READ_BLOCK_SIZE):
+  """Yield large blocks of bytes from an open file, each ending with a whole line"""
+  
+  file_obj = getattr(file_obj, 'buffer', file_obj) # Binary stream underneath text wrapper
+  remainder = b''
+  
+  while True:
+    data = file_obj.read(block_size)
+    
+    if not data:
+      break
+    
+    data = remainder + data
+    i = data.rfind(b'\n') + 1
+    
+    if i:
+      remainder = data[i:]
+      yield data[:i]
+      
+    else:
+      remainder = data
+  
+  if remainder.strip():
+    yield remainder + b'\n'
+
+
+def _tokenize(data):
+  """
+  Locate whitespace-separated tokens in a block of bytes. Returns a padded uint8 buffer,
+  so fixed-width windows around any token are valid, and the token start and end indices.
+  """
+  
+  buf = np.frombuffer(data, np.uint8)
+  seps = np.flatnonzero(buf <= 32)
+  starts = np.empty(len(seps)+1, np.int64)
+  ends = np.empty(len(seps)+1, np.int64)
+  starts[0] = 0
+  starts[1:] = seps + 1
+  ends[:-1] = seps
+  ends[-1] = len(buf)
+  
+  keep = ends > starts # Runs of separators give empty tokens
+  
+  if not keep.all():
+    starts = starts[keep]
+    ends = ends[keep]
+  
+  width = int((ends-starts).max()) if len(starts) else 0
+  pad = max(MIN_TOKEN_PAD, 8 * ((width+7)//8))
+  
+  padded = np.full(len(buf) + 2*pad, 32, np.uint8)
+  padded[pad:-pad] = buf
+  
+  return padded, starts+pad, ends+pad, pad
 
-def load_file(file_path, pair_key=True, trans=True, offset=0, dtype=int, n_max=None):
-  """Load chromosome and contact data from NCC format file, as output from NucProcess"""
+
+def _parse_ints(windows, starts, ends):
+  """Parse decimal integer tokens using right-aligned character windows"""
+  
+  negative = windows[starts, 0] == ord('-')
+  starts = starts + negative
+  lens = ends-starts
+  w = int(lens.max())
+  digits = windows[ends-w, :w].astype(np.float64) - 48.0
+  digits[np.arange(w) < (w-lens)[:,None]] = 0.0 # Preceding characters
+
+  if (digits < 0.0).any() or (digits > 9.0).any():
+    raise ValueError('Non-numeric value in NCC integer column')
+  
+  values = np.dot(digits, 10.0 ** np.arange(w-1, -1, -1)).astype(np.int64)
+  values[negative] *= -1
+  
+  return values
+
+
+def _encode_names(windows, starts, ends):
+  """
+  Get integer codes for name tokens, without making Python strings for each.
+  Returns the sorted unique names and an index into these for each token.
+  """
+  
+  lens = ends-starts
+  n_words = (int(lens.max()) + 7) // 8
+  words = np.ascontiguousarray(windows[starts, :8*n_words]).view(np.uint64)
+  
+  for j in range(n_words): # Zero bytes beyond token end, little endian
+    n_bytes = np.clip(lens - 8*j, 0, 8).astype(np.uint64) * np.uint64(8)
+    mask = np.where(n_bytes < 64, (np.uint64(1) << (n_bytes % np.uint64(64))) - np.uint64(1), np.uint64(0xFFFFFFFFFFFFFFFF))
+    words[:,j] &= mask
+  
+  hash_key = words[:,0].copy()
+  
+  for j in range(1, n_words):
+    hash_key = (hash_key * np.uint64(1000003)) ^ words[:,j]
+  
+  hash_key, first, idx = np.unique(hash_key, return_index=True, return_inverse=True)
+  idx = idx.ravel()
+  
+  if (n_words > 1) and not (words == words[first][idx]).all(): # Hash collision; very unlikely
+    words, first, idx = np.unique(words, axis=0, return_index=True, return_inverse=True)
+    idx = idx.ravel()
+  
+  names = [words[i].tobytes().rstrip(b'\0').decode('utf-8') for i in first]
+  order = np.argsort(names)
+  ranks = np.empty(len(names), np.int64)
+  ranks[order] = np.arange(len(names))
+  
+  return [names[i] for i in order], ranks[idx]
+
+
+def read_ncc_blocks(file_path, pos_cols=(1, 2), block_size=READ_BLOCK_SIZE):
+  """
+  Parse an NCC format file in large blocks of lines, yielding typed NumPy columns for each:
+  (chromos, chr_a, chr_b, pos_a, pos_b, ambig_codes, pair_ids, inactive)
+  Chromosome codes index the sorted chromosome names of the block, so comparing codes is
+  equivalent to comparing names. The pos_cols give the (zero-based) start and end columns
+  from which the contact positions are taken, according to strand.
+  """
   
   from core import nuc_io as io
   
-  with io.open_file(file_path) as file_obj:
+  k = NCC_NUM_COLS
+  c1, c2 = pos_cols
   
-    # Observations are treated individually in single-cell Hi-C,
-    # i.e. no binning, so num_obs always 1 for each contact
-    num_obs = 1
- 
-    contact_dict = {}
-    inactive_min = defaultdict(int)
-    inactive_max = defaultdict(int)
-    n = 0
-    ambig_group = 0
-    
-    for line in file_obj:
-      chr_a, f_start_a, f_end_a, start_a, end_a, strand_a, \
-      chr_b, f_start_b, f_end_b, start_b, end_b, strand_b, \
-      ambig_code, pair_id, swap_pair = line.split()
-      
-      if int(float(ambig_code)) > 0:
-        ambig_group += 1 # Count even if inactive; keep consistent group numbering
+  with io.open_file(file_path) as file_obj:
+    for data in _iter_line_blocks(file_obj, block_size):
+      buf, starts, ends, pad = _tokenize(data)
       
-      if (chr_a != chr_b) and not trans:
+      if not len(starts):
         continue
+      
+      if len(starts) % k:
+        raise Exception('NCC file %s is malformed; not all lines have %d columns' % (file_path, k))
+      
+      starts = starts.reshape(-1, k)
+      ends = ends.reshape(-1, k)
+      n = len(starts)
+      windows = np.lib.stride_tricks.as_strided(buf, shape=(len(buf)-pad+1, pad), strides=(1, 1))
+      
+      chromos, chr_codes = _encode_names(windows, np.concatenate([starts[:,0], starts[:,6]]),
+                                         np.concatenate([ends[:,0], ends[:,6]]))
+      
+      strand_a = buf[starts[:,5]] == ord('+')
+      strand_b = buf[starts[:,11]] == ord('+')
+      
+      pos_a = _parse_ints(windows, np.where(strand_a, starts[:,c1], starts[:,c2]),
+                          np.where(strand_a, ends[:,c1], ends[:,c2]))
+      pos_b = _parse_ints(windows, np.where(strand_b, starts[:,c1+6], starts[:,c2+6]),
+                          np.where(strand_b, ends[:,c1+6], ends[:,c2+6]))
+      
+      # Current ambiguity codes have a '.1' suffix, or '.0' if inactive
+      amb_ends = ends[:,12]
+      is_point = buf[amb_ends-2] == ord('.')
+      inactive = is_point & (buf[amb_ends-1] == ord('0'))
+      ambig_codes = _parse_ints(windows, starts[:,12], amb_ends - 2 * is_point)
+      pair_ids = _parse_ints(windows, starts[:,13], ends[:,13])
+      
+      yield chromos, chr_codes[:n], chr_codes[n:], pos_a, pos_b, ambig_codes, pair_ids, inactive
 
-      pos_a = int(f_start_a if strand_a == '+' else f_end_a)
-      pos_b = int(f_start_b if strand_b == '+' else f_end_b)
-        
-      if ambig_code.endswith('.0'): # Inactive
-        inactive_min[chr_a] = min(pos_a, inactive_min[chr_a] or 1e12)
-        inactive_min[chr_b] = min(pos_b, inactive_min[chr_b] or 1e12)
-        inactive_max[chr_a] = max(pos_a, inactive_max[chr_a])
-        inactive_max[chr_b] = max(pos_b, inactive_max[chr_b])
-        continue
-        
-      if chr_a > chr_b:
-        chr_a, chr_b = chr_b, chr_a
-        pos_a, pos_b = pos_b, pos_a
 
-      key = (chr_a, chr_b)
-      if key not in contact_dict:
-        contact_dict[key] = []
-         
-      contact_dict[key].append((pos_a, pos_b, num_obs, int(pair_id)))
-      n += 1
+def _update_limits(limits, chromos, chr_codes, positions):
+  
+  for code in np.unique(chr_codes):
+    seq_pos = positions[chr_codes == code]
+    chromo = chromos[code]
+    
+    if chromo in limits:
+      prev_min, prev_max = limits[chromo]
+      limits[chromo] = [min(prev_min, int(seq_pos.min())), max(prev_max, int(seq_pos.max()))]
+    else:
+      limits[chromo] = [int(seq_pos.min()), int(seq_pos.max())]
 
-  if n_max and (n > n_max):
-    critical('Too many contacts in ncc file (> %d), this code is meant for single cell data' % n_max)
 
-  chromo_limits = {}
+def _read_contact_table(file_path):
+  """
+  Read all active contacts from an NCC file into a single table of CONTACT_COLS rows,
+  which are contiguous for each chromosome pair. Also returns a list of
+  (chr_a, chr_b, start_row, num_rows) for the pairs and the position limits
+  of inactive contacts, both overall and for cis contacts only.
+  """
+  
+  contact_blocks = defaultdict(list)
+  inactive_limits = {}
+  cis_inactive_limits = {}
+  n_cols = len(CONTACT_COLS)
+  
+  for chromos, chr_a, chr_b, pos_a, pos_b, ambig_codes, pair_ids, inactive in read_ncc_blocks(file_path):
+    if inactive.any():
+      _update_limits(inactive_limits, chromos, chr_a[inactive], pos_a[inactive])
+      _update_limits(inactive_limits, chromos, chr_b[inactive], pos_b[inactive])
+      
+      cis = inactive & (chr_a == chr_b)
+      _update_limits(cis_inactive_limits, chromos, chr_a[cis], pos_a[cis])
+      _update_limits(cis_inactive_limits, chromos, chr_b[cis], pos_b[cis])
+      
+      active = ~inactive
+      chr_a, chr_b, pos_a, pos_b, ambig_codes, pair_ids = [x[active] for x in (chr_a, chr_b, pos_a, pos_b, ambig_codes, pair_ids)]
     
-  for key in contact_dict:
-    chr_a, chr_b = key
+    swap = chr_a > chr_b
+    chr_a, chr_b = np.where(swap, chr_b, chr_a), np.where(swap, chr_a, chr_b)
+    pos_a, pos_b = np.where(swap, pos_b, pos_a), np.where(swap, pos_a, pos_b)
     
-    contacts = np.array(contact_dict[key], dtype=dtype).T
+    # Group by chromosome pair, keeping file order within each
+    pair_codes = chr_a * len(chromos) + chr_b
+    order = np.argsort(pair_codes, kind='stable')
+    pair_codes, starts = np.unique(pair_codes[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    
+    for s, e in zip(starts, ends):
+      idx = order[s:e]
+      block = np.empty((e-s, n_cols), np.int64)
+      block[:,0] = pos_a[idx]
+      block[:,1] = pos_b[idx]
+      block[:,2] = 1 # Single observations in NCC data
+      block[:,3] = pair_ids[idx]
+      block[:,4] = ambig_codes[idx]
       
-    seq_pos_a = contacts[0]
-    seq_pos_b = contacts[1]
+      key = (chromos[chr_a[idx[0]]], chromos[chr_b[idx[0]]])
+      contact_blocks[key].append(block)
+  
+  n_rows = sum([len(x) for blocks in contact_blocks.values() for x in blocks])
+  table = np.empty((n_rows, n_cols), np.int64)
+  pairs = []
+  i = 0
+  
+  for key in sorted(contact_blocks):
+    chr_a, chr_b = key
+    pairs.append((chr_a, chr_b, i, sum([len(x) for x in contact_blocks[key]])))
+    
+    for block in contact_blocks.pop(key): # Free memory as we go
+      table[i:i+len(block)] = block
+      i += len(block)
+  
+  return table, pairs, inactive_limits, cis_inactive_limits
+
+
+def _get_pair_limits(table, pairs):
+  
+  pair_limits = []
+  
+  for chr_a, chr_b, start, count in pairs:
+    rows = table[start:start+count]
+    pair_limits.append([int(rows[:,0].min()), int(rows[:,0].max()),
+                        int(rows[:,1].min()), int(rows[:,1].max())])
+  
+  return pair_limits
+  
+
+def get_cache_path(file_path):
+  """Path of the binary, columnar cache file for an NCC file"""
+  
+  from core import nuc_io as io
+  
+  return io.get_cache_path(file_path, NCCB_EXT)
+
+
+def build_cache(file_path, cache_path=None):
+  """
+  Parse an NCC format file and write its contacts to a binary .nccb cache file.
+  Returns the cache path, or None if the cache could not be written.
+  """
+  
+  from core import nuc_io as io
+  
+  if not cache_path:
+    cache_path = get_cache_path(file_path)
     
-    min_a = min(seq_pos_a)
-    max_a = max(seq_pos_a)
-    min_b = min(seq_pos_b)
-    max_b = max(seq_pos_b)
+  table, pairs, inactive_limits, cis_inactive_limits = _read_contact_table(file_path)
+  
+  header = {'version':NCCB_VERSION,
+            'columns':CONTACT_COLS,
+            'pairs':pairs,
+            'pair_limits':_get_pair_limits(table, pairs),
+            'inactive_limits':inactive_limits,
+            'cis_inactive_limits':cis_inactive_limits}
+  
+  if io.save_array_cache(cache_path, header, {'contacts':table}, file_path):
+    return cache_path
+
+
+def load_cache(file_path, cache_path=None):
+  """
+  Load the binary cache for an NCC file, if present and current, returning the
+  header dict and the memory-mapped contact table. Returns None otherwise.
+  """
+  
+  from core import nuc_io as io
+  
+  if not cache_path:
+    cache_path = get_cache_path(file_path)
+  
+  cache_data = io.load_array_cache(cache_path, file_path)
+  
+  if cache_data:
+    header, arrays = cache_data
+    
+    if header.get('version') == NCCB_VERSION:
+      return header, arrays['contacts']
+
+
+# #   Nuc Formats  # # 
+
+def load_file(file_path, pair_key=True, trans=True, offset=0, dtype=int, n_max=None, cache=None):
+  """
+  Load chromosome and contact data from NCC format file, as output from NucProcess.
+  Contacts for each chromosome pair are an array of (pos_a, pos_b, num_obs, pair_id) rows.
+  By default, the contact arrays are memory-mapped views of any current binary .nccb cache,
+  e.g. as made by the ncc_cache tool, but no cache is written. If cache is set, a cache is
+  also written on first load, where the directory is writable. If cache is False, the NCC
+  text is always parsed.
+  """
+  
+  from core import nuc_util as util
+  from core import nuc_io as io
+  
+  cache_data = None
+  
+  if cache is not False:
+    cache_data = load_cache(file_path)
+    cache_path = get_cache_path(file_path)
+    
+    if cache and not cache_data and io.can_write_cache(cache_path):
+      util.info('Building binary cache for %s' % file_path)
       
-    if chr_a in chromo_limits:
-      prev_min, prev_max = chromo_limits[chr_a]
-      chromo_limits[chr_a] = [min(prev_min, min_a), max(prev_max, max_a)]
-    else:
-      chromo_limits[chr_a] = [min_a, max_a]
+      if build_cache(file_path, cache_path):
+        cache_data = load_cache(file_path, cache_path)
+  
+  if cache_data:
+    header, table = cache_data
+  
+  else: # Not cached or cache could not be written
+    table, pairs, inactive_limits, cis_inactive_limits = _read_contact_table(file_path)
+    header = {'pairs':pairs,
+              'pair_limits':_get_pair_limits(table, pairs),
+              'inactive_limits':inactive_limits,
+              'cis_inactive_limits':cis_inactive_limits}
+  
+  pairs = header['pairs']
+  pair_limits = header['pair_limits']
+  contact_dict = {}
+  chromo_limits = {}
+  n = 0
+  
+  for (chr_a, chr_b, start, count), (min_a, max_a, min_b, max_b) in zip(pairs, pair_limits):
+    if (chr_a != chr_b) and not trans:
+      continue
     
-    if chr_b in chromo_limits:
-      prev_min, prev_max = chromo_limits[chr_b]
-      chromo_limits[chr_b] = [min(prev_min, min_b), max(prev_max, max_b)]
-    else:
-      chromo_limits[chr_b] = [min_b, max_b]
+    contacts = table[start:start+count,:4] # Views for native int
+    
+    if contacts.dtype != np.dtype(dtype):
+      contacts = contacts.astype(dtype)
+    
+    contact_dict[(chr_a, chr_b)] = contacts
+    n += count
+    
+    for chromo, p_min, p_max in ((chr_a, min_a, max_a), (chr_b, min_b, max_b)):
+      if chromo in chromo_limits:
+        prev_min, prev_max = chromo_limits[chromo]
+        chromo_limits[chromo] = [min(prev_min, p_min), max(prev_max, p_max)]
+      else:
+        chromo_limits[chromo] = [p_min, p_max]
+
+  if n_max and (n > n_max):
+    util.critical('Too many contacts in ncc file (> %d), this code is meant for single cell data' % n_max)
 
   if not pair_key:
-    pairs = sorted(contact_dict)
-    
-    for pair in pairs:
+    for pair in sorted(contact_dict):
       chr_a, chr_b = pair
+      
       if chr_a not in contact_dict:
         contact_dict[chr_a] = {}
-        contact_dict[chr_a][chr_b] = contact_dict[pair]
-      
-      del contact_dict[pair]        
+        
+      contact_dict[chr_a][chr_b] = contact_dict.pop(pair)
   
   # Find limits for chromos with no active contacts
-  for chr_a in inactive_min:
-    if chr_a not in chromo_limits:
-      chromo_limits[chr_a] = [inactive_min[chr_a], inactive_max[chr_a]]
+  if trans:
+    inactive_limits = header['inactive_limits']
+  else:
+    inactive_limits = header['cis_inactive_limits']
+  
+  for chromo in inactive_limits:
+    if chromo not in chromo_limits:
+      chromo_limits[chromo] = list(inactive_limits[chromo])
         
-  chromosomes = sorted(contact_dict)      
+  chromosomes = sorted(chromo_limits)
         
   return chromosomes, chromo_limits, contact_dict
 
@@ -1,69 +1,271 @@
 import math
 import numpy as np
+from collections import OrderedDict
+try:
+  from collections.abc import MutableMapping
+except ImportError: # Python 2
+  from collections import MutableMapping
 from scipy import sparse
 
 CHR_KEY_SEP = ' '
+LEVEL_KEY_SEP = ':'
+LEVELS_KEY = 'levels'
+MAX_RESIDENT_BYTES = 2**30 # Default memory limit for lazily loaded contact matrices
+
+def get_level_key(key, bin_size, base_bin_size):
+  """
+  Archive key for a given resolution level, bin size in bp, of a multi-resolution NPZ file.
+  The finest, base level uses plain keys so that such files are readable as single-resolution.
+  """
+  
+  if bin_size == base_bin_size:
+    return key
+  
+  return '%d%s%s' % (bin_size, LEVEL_KEY_SEP, key)
+
+
+def _get_bin_sizes(file_dict):
+  
+  if LEVELS_KEY in file_dict:
+    return [int(x*1e3) for x in file_dict[LEVELS_KEY]]
+  
+  bin_size, min_bins = file_dict['params']
+  
+  return [int(bin_size*1e3)]
+  
+  
+def _get_level_keys(file_dict, bin_size, base_bin_size):
+  """
+  Pairs of (key, archive key) for the contact matrices and chromosome offsets of one resolution level
+  """
+  
+  level_keys = []
+  
+  for file_key in sorted(file_dict):
+    if file_key in ('params', LEVELS_KEY):
+      continue
+    
+    level, sep, key = file_key.partition(LEVEL_KEY_SEP)
+    
+    if sep and level.isdigit():
+      level = int(level)
+    else:
+      level, key = base_bin_size, file_key
+    
+    if level == bin_size:
+      level_keys.append((key, file_key))
+  
+  return level_keys
+  
+
+def get_bin_sizes(file_path):
+  """
+  Bin sizes, in bp, of the resolution levels stored in an NPZ contact file, finest first
+  """
+  
+  return _get_bin_sizes(np.load(file_path, allow_pickle=True))
+  
+  
+def select_bin_size(avail_bin_sizes, bin_sizes):
+  """
+  Choose the coarsest available bin size that is no larger than any of the requested bin sizes,
+  preferring those that exactly divide all requests, so that downsampling is a simple summation.
+  """
+  
+  if not isinstance(bin_sizes, (list, tuple)):
+    bin_sizes = [bin_sizes]
+  
+  max_size = min(bin_sizes)
+  valid = [x for x in avail_bin_sizes if x <= max_size] or [min(avail_bin_sizes)]
+  exact = [x for x in valid if all(y % x == 0 for y in bin_sizes)]
+  
+  return max(exact or valid)
+  
 
 def get_chromosomes(file_path):
   
   chromos = set()
   
   file_dict = np.load(file_path, allow_pickle=True)
- 
-  for key in sorted(file_dict):
-    if key != 'params':
-      if CHR_KEY_SEP in key:
-        chr_a, chr_b = key.split(CHR_KEY_SEP)
-        chromos.add(chr_a)
-        chromos.add(chr_b)
+  base_bin_size = _get_bin_sizes(file_dict)[0]
+  
+  for key, file_key in _get_level_keys(file_dict, base_bin_size, base_bin_size):
+    if CHR_KEY_SEP in key:
+      chr_a, chr_b = key.split(CHR_KEY_SEP)
+      chromos.add(chr_a)
+      chromos.add(chr_b)
   
   return chromos
   
   
-def load_npz_contacts(file_path, trans=True, store_sparse=False, display_counts=False):
+def _read_matrix(file_dict, file_key, is_cis, store_sparse=False):
+  
+  mat = file_dict[file_key][()]
+  
+  if not store_sparse:
+     mat = mat.toarray()
+  
+  if is_cis:
+    a, b = mat.shape
+    
+    if a != b:
+      a = min(a,b)
+      mat = mat[:a,:a]
+    
+    cols = np.arange(a-1)
+    rows = cols-1
+
+    if not np.all(mat[rows, cols] == mat[cols, rows]): # Not symmetric
+      mat += mat.T
+  
+  return mat
+
+
+def _get_nbytes(mat):
+  
+  if sparse.issparse(mat):
+    mat = mat.tocoo()
+    return mat.data.nbytes + mat.row.nbytes + mat.col.nbytes
+  
+  return mat.nbytes
+    
+  
+class LazyContactStore(MutableMapping):
+  """
+  Dictionary-like container of the chromosome pair contact matrices in an NPZ archive.
+  A matrix is only decompressed when first accessed and, once the resident matrices exceed
+  max_bytes, the least recently used are dropped, to be re-read if they are needed again.
+  Such matrices are read-only, so that in-place changes fail rather than being lost when the
+  matrix is dropped; changed copies should be stored back. Matrices that are set by the caller
+  are kept until deleted and don't count toward max_bytes, so code which replaces every matrix,
+  e.g. normalize_contacts(), should use eagerly loaded contacts instead.
+  """
+  
+  def __init__(self, file_dict, pair_keys, store_sparse=False, max_bytes=MAX_RESIDENT_BYTES):
+    
+    self._file_dict = file_dict
+    self._pair_keys = dict(pair_keys) # Chromosome pair : archive key
+    self._store_sparse = store_sparse
+    self._max_bytes = max_bytes
+    self._pairs = OrderedDict.fromkeys(self._pair_keys)
+    self._resident = OrderedDict()
+    self._resident_bytes = 0
+    self._stored = {}
+  
+  
+  def __getitem__(self, pair):
+    
+    if pair in self._stored:
+      return self._stored[pair]
+    
+    if pair in self._resident:
+      mat = self._resident[pair] = self._resident.pop(pair) # Most recently used last
+      return mat
+    
+    if pair not in self._pair_keys:
+      raise KeyError(pair)
+    
+    mat = _read_matrix(self._file_dict, self._pair_keys[pair], pair[0] == pair[1], self._store_sparse)
+    
+    if sparse.issparse(mat):
+      mat.data.flags.writeable = False
+    else:
+      mat.flags.writeable = False
+    
+    self._resident[pair] = mat
+    self._resident_bytes += _get_nbytes(mat)
+    
+    while (self._resident_bytes > self._max_bytes) and (len(self._resident) > 1):
+      old_pair, old_mat = self._resident.popitem(last=False)
+      self._resident_bytes -= _get_nbytes(old_mat)
+    
+    return mat
+  
+  
+  def __setitem__(self, pair, mat):
+    
+    self._discard(pair)
+    self._stored[pair] = mat
+    self._pairs[pair] = None
+  
+  
+  def __delitem__(self, pair):
+    
+    if pair not in self._pairs:
+      raise KeyError(pair)
+    
+    self._discard(pair)
+    self._pair_keys.pop(pair, None)
+    del self._pairs[pair]
+  
+  
+  def _discard(self, pair):
+    
+    if pair in self._resident:
+      self._resident_bytes -= _get_nbytes(self._resident.pop(pair))
+    
+    self._stored.pop(pair, None)
+  
+  
+  def __contains__(self, pair):
+    
+    return pair in self._pairs
+  
+  
+  def __iter__(self):
+    
+    return iter(list(self._pairs))
+  
+  
+  def __len__(self):
+    
+    return len(self._pairs)
+  
+  
+def load_npz_contacts(file_path, trans=True, store_sparse=False, display_counts=False, bin_size=None,
+                      lazy=False, max_bytes=MAX_RESIDENT_BYTES):
+  """
+  Load binned contact matrices from an NPZ file. For multi-resolution files, the optional bin_size,
+  in bp, or list of bin sizes selects the coarsest stored level that satisfies the request;
+  otherwise the finest level is loaded. If lazy is set, the returned contacts are a LazyContactStore,
+  which only reads the matrices that are accessed and limits their resident memory to max_bytes.
+  """
   
   file_dict = np.load(file_path, allow_pickle=True)
   
   chromo_limits = {}
   contacts = {}
-  bin_size, min_bins = file_dict['params']
-  bin_size = int(bin_size*1e3)
+  avail_bin_sizes = _get_bin_sizes(file_dict)
+  
+  if bin_size:
+    bin_size = select_bin_size(avail_bin_sizes, bin_size)
+  else:
+    bin_size = avail_bin_sizes[0]
   
   chromo_hists = {}
   cis_chromo_hists = {}
+  pair_keys = {}
   
-  for key in sorted(file_dict):
-    if key != 'params':
-      if CHR_KEY_SEP in key:
-        chr_a, chr_b = key.split(CHR_KEY_SEP)
-        
-        if (chr_a == chr_b) or trans:
-          mat = file_dict[key][()]
-          
-          if not store_sparse:
-             mat = mat.toarray()
-          
-          if chr_a == chr_b:
-            a, b = mat.shape
-            
-            if a != b:
-              a = min(a,b)
-              mat = mat[:a,:a]
-            
-            cols = np.arange(a-1)
-            rows = cols-1
-
-            if not np.all(mat[rows, cols] == mat[cols, rows]): # Not symmetric
-              mat += mat.T
-          
-          contacts[(chr_a, chr_b)] = mat  
-   
-      else:
-        offset, count = file_dict[key]
-        chromo_limits[key] = offset * bin_size, (offset + count) * bin_size
-        chromo_hists[key] = np.zeros(count)
-        cis_chromo_hists[key] = np.zeros(count)
+  for key, file_key in _get_level_keys(file_dict, bin_size, avail_bin_sizes[0]):
+    if CHR_KEY_SEP in key:
+      chr_a, chr_b = key.split(CHR_KEY_SEP)
+      
+      if (chr_a == chr_b) or trans:
+        pair_keys[(chr_a, chr_b)] = file_key
+ 
+    else:
+      offset, count = file_dict[file_key]
+      chromo_limits[key] = offset * bin_size, (offset + count) * bin_size
+      chromo_hists[key] = np.zeros(count)
+      cis_chromo_hists[key] = np.zeros(count)
   
+  if lazy:
+    contacts = LazyContactStore(file_dict, pair_keys, store_sparse, max_bytes)
+  
+  else:
+    for pair, file_key in pair_keys.items():
+      contacts[pair] = _read_matrix(file_dict, file_key, pair[0] == pair[1], store_sparse)
+
   if display_counts:
     # A simple 1D overview of count densities
  
@@ -58,6 +58,13 @@ def get_bam_chromo_sizes(bam_file_path):
 
   # Looks in header of BAM file to get chromosome/contig names and their lengths  
   
+  return [(ref_name, seq_len) for ref_name, seq_len, n_mapped in get_bam_chromo_counts(bam_file_path)]
+
+
+def get_bam_chromo_counts(bam_file_path):
+
+  # Looks in the index of a BAM file to get chromosome/contig names, their lengths and numbers of mapped reads
+  
   if not os.path.exists(bam_file_path + '.bai'):
     sort_path = os.path.splitext(bam_file_path)[0] + '_sort.bam'
     
@@ -96,7 +103,7 @@ def get_bam_chromo_sizes(bam_file_path):
       seq_len = int(seq_len)
       
       if seq_len:
-        chromos_sizes.append((ref_name, seq_len))
+        chromos_sizes.append((ref_name, seq_len, int(n_mapped)))
   
   
   return chromos_sizes
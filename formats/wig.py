@@ -36,13 +36,67 @@ def _get_param_dict(line):
   return param_dict
   
 
-def load_data_track(file_path):
+def _parse_section_lines(lines, is_fixed, pos, step, span):
+  """
+  Parse the value lines of a fixedStep or variableStep section, or a chunk of one, column-wise.
+  Lines without the expected number of fields are skipped. Returns a DATA_TRACK_TYPE array and
+  the next fixedStep position.
+  """
   
-  data_dict = defaultdict(set)
+  n_fields = 1 if is_fixed else 2
+  
+  try:
+    data = np.loadtxt(lines, dtype=float, comments=None, ndmin=2)
+  except ValueError: # Mixed lines
+    lines = [line for line in lines if len(line.split()) == n_fields]
+    data = np.loadtxt(lines, dtype=float, comments=None, ndmin=2) if lines else np.zeros((0, n_fields))
+  
+  if data.shape[1] != n_fields:
+    data = np.zeros((0, n_fields))
+  
+  n = len(data)
+  
+  if is_fixed:
+    starts = pos + step * np.arange(n)
+    vals = data[:,0]
+    pos += step * n
+  
+  else:
+    starts = data[:,0].astype(np.int64)
+    vals = data[:,1]
+  
+  track = np.empty(n, util.DATA_TRACK_TYPE)
+  track['pos1'] = starts
+  track['pos2'] = starts + span
+  track['strand'] = True
+  track['value'] = vals
+  track['orig_value'] = vals
+  track['label'] = b''
+  
+  return track, pos
+  
+
+def load_data_track(file_path, cache=None):
+  """
+  Load a WIG format file as DATA_TRACK_TYPE arrays for each chromosome. Value lines are parsed
+  in chunks. By default, any current binary .ntrk cache of the parsed track is memory-mapped,
+  but none is written. If cache is set, a cache is also written on first load, where the
+  directory is writable. If cache is False, the text is always parsed.
+  """
+  
+  if cache is not False:
+    data_dicts = io.load_data_track_cache(file_path)
+    
+    if data_dicts:
+      return data_dicts['']
+  
+  data_dict = defaultdict(list)
     
   with io.open_file(file_path) as file_obj:
  
     is_fixed = False
+    chromo = None
+    pos = 0
     span = 1
     step = 1
     
@@ -51,41 +105,39 @@ def load_data_track(file_path):
     if not def_line.startswith('track '):
       file_obj.seek(0)
     
-    for line in file_obj:
+    for chunk in io.iter_line_chunks(file_obj):
+      lines = []
       
-      if line.startswith('variableStep'):
-        is_fixed = False
+      for line in chunk + [None]: # Section lines are parsed together, up to the next declaration
+        if line and not (line.startswith('variableStep') or line.startswith('fixedStep')):
+          lines.append(line)
+          continue
+        
+        if lines and chromo:
+          track, pos = _parse_section_lines(lines, is_fixed, pos, step, span)
+          data_dict[chromo].append(track)
+        
+        lines = []
+        
+        if line is None:
+          break
+        
         param_dict = dict((pair.split('=') for pair in line.split()[1:]))
         chromo = param_dict['chrom']
         span = int(param_dict.get('span', 1))
- 
-      elif line.startswith('fixedStep'):
-        is_fixed = True
-        param_dict =dict((pair.split('=') for pair in line.split()[1:]))
-        chromo = param_dict['chrom']
-        pos = int(param_dict['start'])
-        step = int(param_dict['step'])
-        span = int(param_dict.get('span', 1))
- 
-      else:
-        data = line.split()
- 
-        if is_fixed:
-          if len(data) != 1:
-            continue
- 
-          val = float(data[0])
-          data_dict[chromo].add((pos, pos+span, 1, val, val, ''))
-          pos += step
- 
+        
+        if line.startswith('fixedStep'):
+          is_fixed = True
+          pos = int(param_dict['start'])
+          step = int(param_dict['step'])
+        
         else:
-          if len(data) != 2:
-            continue
- 
-          pos, val = data
-          pos = int(pos)
-          val = float(val)
-          data_dict[chromo].add((pos, pos+span, 1, val, val, ''))
-         
-  return util.finalise_data_track(data_dict)
-
+          is_fixed = False
+  
+  data_dict = {chromo:np.concatenate(data_dict[chromo]) for chromo in data_dict}
+  data_dict = util.finalise_data_track(data_dict)
+  
+  if cache and io.can_write_cache(io.get_track_cache_path(file_path)):
+    io.save_data_track_cache(file_path, {'':data_dict})
+  
+  return data_dict
@@ -20,6 +20,7 @@ TOOLS = {'adapt': 'tools.nuc_adapt',
          'contact_pair_points': 'tools.contact_pair_points',
          'ncc_filter': 'tools.ncc_filter',
          'ncc_bin': 'tools.ncc_bin',
+         'ncc_cache': 'tools.ncc_cache',
          'ncc_update': 'tools.ncc_update',
          'chip-seq_process': 'tools.chip-seq_process',
          'sequence_properties': 'tools.sequence_properties',
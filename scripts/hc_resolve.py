@@ -383,6 +383,27 @@ def remove_isolated_unambig(in_ncc_path, out_ncc_path, threshold=0.01, sep_thres
   plt.show()     
   """
   
+  # Local density of homolog trans contacts: those in the same bin and those nearby in adjacent bins
+  
+  from core import nuc_contacts
+  
+  homolog_points = defaultdict(list)
+  
+  for key in all_bins:
+    chr_a, chr_b, bin_a, bin_b = key
+    
+    if (chr_a != chr_b) and (chr_a.split('.')[0] == chr_b.split('.')[0]):
+      homolog_points[(chr_a, chr_b)] += [x[:2] for x in all_bins[key]]
+  
+  dens_counts = {}
+  
+  for chr_a, chr_b in homolog_points:
+    points = np.array(homolog_points[chr_a, chr_b]).reshape(-1, 2)
+    counts = nuc_contacts.count_neighbours(points[:,0], points[:,1], sep_threshold)
+    
+    for (pos_a, pos_b), count in zip(points.tolist(), counts.tolist()):
+      dens_counts[(chr_a, chr_b, pos_a, pos_b)] = count
+  
   for ag in ag_data:
     pairs = ag_data[ag]
     n_pairs = len(pairs)
@@ -392,30 +413,7 @@ def remove_isolated_unambig(in_ncc_path, out_ncc_path, threshold=0.01, sep_thres
       chr_a, chr_b, bin_a, bin_b = key
  
       if (chr_a != chr_b) and (key in bin_counts): # Homolog trans only
-        count = bin_counts[key]
-        
-        if count < upper_dens_thresh:
-          for a in range(bin_a-1, bin_a+2):
-            for b in range(bin_b-1, bin_b+2):
-              if a == bin_a and b == bin_b:
-                continue
- 
-              key2 =  (chr_a, chr_b, a, b)
- 
-              for pos1, pos2, ag1 in all_bins.get(key2, []):
-                if (abs(pos1-pos_a) < sep_threshold) and (abs(pos2-pos_b) < sep_threshold):
-                  count += 1
- 
-                  if count > upper_dens_thresh:
-                    break
-              
-              else:
-                continue
-              break
-            
-            else:
-              continue
-            break  
+        count = dens_counts[(chr_a, chr_b, pos_a, pos_b)]
               
         if (count < upper_dens_thresh) and (n_pairs > 1): # ONly keep ambiguous holologous trans
           keep.append(j)
@@ -26,7 +26,7 @@ sam_paths = [glob.glob('/data2/test_HybridES0418_001_nuc_processing_files/test_H
 for genome_path, sam_files in zip(genome_paths, sam_paths):
   util.info('Reading genome build FASTA')
 
-  seq_dict = fasta.read_fasta(io.open_file(genome_path), as_array=True)
+  seq_dict = dict(fasta.iter_fasta_arrays(genome_path))
   util.info('Collating')
   digits = set('0123456789')
   
@@ -1,4 +1,5 @@
 import sys, os
+import numpy as np
 from collections import defaultdict
 
 PROG_NAME = 'chip_seq'
@@ -28,6 +29,10 @@ MIN_ADAPT_OVERLAP = 7
 
 DEFAULT_MAX_SEP = 500
 
+SAMPLE_MIN_CPU = 4 # Minimum CPU cores for each concurrently processed sample
+
+STAGE_LOG_FILE = 'chip_seq_stages.tsv'
+
 def _check_index_file(file_path, sub_files=('.1', '.2', '.3', '.4', '.rev.1', '.rev.2')):
 
   from nuc_tools import io, util
@@ -53,92 +58,234 @@ def _check_index_file(file_path, sub_files=('.1', '.2', '.3', '.4', '.rev.1', '.
 
 
 def clip_reads(in_fastq_file, out_fastq_file, qual_scheme, min_qual=DEFAULT_MIN_QUAL,
-               adapt_seqs=None, min_len=MIN_READ_LEN):
+               adapt_seqs=None, min_len=MIN_READ_LEN, num_cpu=1):
   """
   Clips reads at poor quality base calls and adapter sequences.
-  Discards very short reads. 
+  Counts very short reads. Reads are clipped in large batches, in parallel if num_cpu > 1.
+  The input may be a list of paired FASTQ files, whose reads are output interleaved.
+  The output may be a FASTQ file path, gzipped if it has a .gz extension, or an open binary
+  file object, e.g. the stdin of an aligner.
   """
-  from nuc_tools import util, io
+  from nuc_tools import util, io, parallel
+  from formats import fastq
   
-  util.info('Clipping FASTQ file %s, producing %s' % (in_fastq_file, out_fastq_file))
+  if isinstance(in_fastq_file, str):
+    in_fastq_files = [in_fastq_file]
+  else:
+    in_fastq_files = list(in_fastq_file)
+  
+  if isinstance(out_fastq_file, str):
+    out_name = out_fastq_file
+    out_file_obj = io.open_file(out_fastq_file, 'wb')
+  else:
+    out_name = 'output stream'
+    out_file_obj = out_fastq_file
+  
+  util.info('Clipping FASTQ file %s, producing %s' % (', '.join(in_fastq_files), out_name))
   
   adapt_seqs = adapt_seqs or []
+  min_qual_ord = QUAL_ZERO_ORDS[qual_scheme] + min_qual
+  counts = np.zeros((len(in_fastq_files), 5), np.int64)
+  
+  common_args = (min_qual_ord, adapt_seqs, min_len, MIN_ADAPT_OVERLAP)
+  batches = fastq.read_batches(in_fastq_files)
   
-  n_reads = 0
-  n_qclip = 0
-  n_short = 0
-  n_adapt = 0
-  mean_len = 0
+  try:
+    for fastq_data, batch_counts in parallel.stream(fastq.clip_read_blocks, batches, common_args, num_cpu=num_cpu):
+      out_file_obj.write(fastq_data)
+      counts += batch_counts
+ 
+  finally:
+    batches.close()
+    
+    if out_file_obj is not out_fastq_file:
+      out_file_obj.close()
   
-  zero_ord = QUAL_ZERO_ORDS[qual_scheme]
+  stats = []
   
-  # gzip agnostic input
-  with io.open_file(in_fastq_file) as in_file_obj, open(out_fastq_file, 'w', FILE_BUFFER) as out_file_obj:
-    readline = in_file_obj.readline
-    write = out_file_obj.write
+  for in_fastq, (n_reads, n_qclip, n_adapt, n_short, mean_len) in zip(in_fastq_files, counts):
+    mean_len /= float(max(1, n_reads-n_short))
     
-    line1 = readline()
-    while line1[0] != '@':
-      line1 = readline()
-
-    while line1:
-      n_reads += 1
-      line2 = readline()[:-1]
-      line3 = readline()
-      line4 = readline()[:-1]
+    util.info(' .. %s' % in_fastq)
+    util.info(' .. num input reads: %d' % n_reads,)
+    util.info(' .. quality clipped: %d' % n_qclip)
+    util.info(' .. adapter clipped: %d' % n_adapt)
+    util.info(' .. too short: %d' % n_short)
+    util.info(' .. mean length: %.2f' % mean_len)
+    stats.append((n_reads, n_qclip, n_adapt, n_short, mean_len))
+  
+  if len(set(counts[:,0])) > 1:
+    util.warn('Paired FASTQ files contain different numbers of reads; unpaired reads were ignored')
+  
+  if isinstance(in_fastq_file, str):
+    return stats[0]
+  
+  return stats
+
+
+def run_stages(stages, stage_log, label, feed=None, out_path=None):
+  """
+  Run a chain of external command stages, each a (name, cmd_args) pair, connected by pipes so that
+  each stage reads the output of the previous one. The optional feed is a (name, function,
+  num_bytes) tuple for a first stage in this process, where the function writes binary data to the
+  first command and num_bytes is the size of the data it reads. The output of the last command may
+  be written to out_path. Appends the wall time, CPU time and storage I/O of each stage to stage_log.
+  """
+  from nuc_tools import util
+  import subprocess, time
+  
+  procs = []
+  start_times = []
+  stdin = subprocess.PIPE if feed else None
+  out_file_obj = open(out_path, 'wb') if out_path else None
+  
+  try:
+    for i, (name, cmd_args) in enumerate(stages):
+      stdout = out_file_obj if i == len(stages)-1 else subprocess.PIPE
+      start_times.append(time.time())
+      proc = util.call(cmd_args, stdin=stdin, stdout=stdout, wait=False)
       
-      # Quality clip
-      q = 0
-      while line2 and line2[-1] == 'N':
-        q = 1
-        line2 = line2[:-1]
-        line4 = line4[:-1]
-
-      while line4 and (ord(line4[-1]) - zero_ord) < min_qual:
-        q = 1
-        line2 = line2[:-1]
-        line4 = line4[:-1]
-
-      while line4 and (ord(line4[0]) - zero_ord) < min_qual:
-        q = 1
-        line2 = line2[1:]
-        line4 = line4[1:]
-
-      n_qclip += q
+      if procs:
+        procs[-1].stdout.close() # Only read by the next stage
       
-      # Adapter clip
-      for adapt_seq in adapt_seqs:
-        if adapt_seq[:MIN_ADAPT_OVERLAP] in line2:
-          i = line2.index(adapt_seq[:MIN_ADAPT_OVERLAP])
- 
-          if line2[i:i+len(adapt_seq)] in adapt_seq:
-            line2 = line2[:i]
-            line4 = line4[:i]
-            n_adapt += 1
-            break
+      procs.append(proc)
+      stdin = proc.stdout
+    
+    if feed:
+      name, func, num_bytes = feed
+      t0 = time.time()
+      
+      try:
+        func(procs[0].stdin)
+        procs[0].stdin.close()
+        
+      except BrokenPipeError: # Command failure is reported below
+        pass
       
-      n = len(line2)
+      stage_log.append((label, name, time.time()-t0, None, num_bytes, None))
+    
+  finally:
+    if out_file_obj:
+      out_file_obj.close()
+  
+  failed = None
+  
+  for (name, cmd_args), proc, t0 in zip(stages, procs, start_times):
+    pid, status, usage = os.wait4(proc.pid, 0)
+    
+    if os.WIFSIGNALED(status):
+      proc.returncode = -os.WTERMSIG(status)
+    else:
+      proc.returncode = os.WEXITSTATUS(status)
+    
+    stage_log.append((label, name, time.time()-t0, usage.ru_utime + usage.ru_stime,
+                      usage.ru_inblock * 512, usage.ru_oublock * 512))
+    
+    if proc.returncode and not failed:
+      failed = name, proc.returncode
+  
+  if failed:
+    util.critical('Stage "%s" for %s failed with exit code %d' % (failed[0], label, failed[1]))
+
+
+def write_stage_log(stage_log, file_path):
+  """
+  Report and write a tab-separated file of the wall time, CPU time and storage I/O of processing stages
+  """
+  from nuc_tools import util
+  
+  util.info('Processing stages: wall time, CPU time, data read and written')
+  
+  with open(file_path, 'w') as file_obj:
+    file_obj.write('#sample\tstage\twall_s\tcpu_s\tread_bytes\twrite_bytes\n')
+    
+    for label, name, wall, cpu, n_read, n_write in stage_log:
+      row = [label, name, '%.2f' % wall] 
+      row += ['NA' if x is None else '%.2f' % x for x in (cpu,)]
+      row += ['NA' if x is None else '%d' % x for x in (n_read, n_write)]
+      file_obj.write('\t'.join(row) + '\n')
+      
+      msg = ' .. %s %s: %.1f s' % (label, name, wall)
+      if cpu is not None:
+        msg += ', CPU %.1f s' % cpu
+      if n_read is not None:
+        msg += ', read %.1f MB' % (n_read/1e6)
+      if n_write is not None:
+        msg += ', written %.1f MB' % (n_write/1e6)
       
-      if n < min_len: # Check size
-        n_short += 1
+      util.info(msg)
+  
+  util.info('Written stage log %s' % file_path)
 
-      mean_len += n
-      write('%s%s\n%s%s\n' % (line1, line2, line3, line4))
- 
-      #if max_reads_in and n_reads >= max_reads_in:
-      #  break
- 
-      line1 = readline()
+
+def align_reads(fastq_paths, clip_root, bam_path, map_args, samtools_exe, qual_scheme,
+                min_qual=DEFAULT_MIN_QUAL, adapt_seqs=None, num_cpu=1, keep_clipped=False,
+                filter_args=None, stage_log=None, label=None):
+  """
+  Clip single or paired-end FASTQ reads, map them with bowtie2 and make a sorted, indexed BAM file.
+  Clipping, mapping, optional samtools view filtering, with filter_args, and sorting run as one
+  pipeline, without intermediate files. By default clipped reads are piped directly into the
+  aligner, as interleaved pairs if paired-end. If keep_clipped is set, or clipped files are present
+  from an earlier run, the aligner reads gzipped clipped FASTQ files.
+  """
+  from nuc_tools import util, io
+  import time
+  
+  if stage_log is None:
+    stage_log = []
+  
+  if not label:
+    label = os.path.basename(clip_root)
   
-  mean_len /= float(n_reads-n_short)
+  clip_paths = [io.tag_file_name(clip_root, 'clip_%d' % (i+1), '.fastq.gz') for i in range(len(fastq_paths))]
+  num_bytes = sum([os.path.getsize(x) for x in fastq_paths])
+  
+  for i, clip_path in enumerate(clip_paths):
+    if not os.path.exists(clip_path) and os.path.exists(clip_path[:-3]): # Uncompressed, from older versions
+      clip_paths[i] = clip_path[:-3]
+  
+  if keep_clipped or all(os.path.exists(x) for x in clip_paths):
+    for in_fq, clip_path in zip(fastq_paths, clip_paths):
+      if not os.path.exists(clip_path):
+        t0 = time.time()
+        clip_reads(in_fq, clip_path, qual_scheme, min_qual, adapt_seqs, num_cpu=num_cpu)
+        stage_log.append((label, 'clip', time.time()-t0, None, os.path.getsize(in_fq), os.path.getsize(clip_path)))
+      
+    if len(fastq_paths) == 2:
+      cmd_args = map_args + ['-1', clip_paths[0], '-2', clip_paths[1]]
+    else:
+      cmd_args = map_args + ['-U', clip_paths[0]]
+    
+    feed = None
+  
+  else:
+    if len(fastq_paths) == 2:
+      cmd_args = map_args + ['--interleaved', '-']
+    else:
+      cmd_args = map_args + ['-U', '-']
 
-  util.info(' .. num input reads: %d' % n_reads,)
-  util.info(' .. quality clipped: %d' % n_qclip)
-  util.info(' .. adapter clipped: %d' % n_adapt)
-  util.info(' .. too short: %d' % n_short)
-  util.info(' .. mean length: %.2f' % mean_len)
+    feed = ('clip', lambda file_obj: clip_reads(fastq_paths, file_obj, qual_scheme, min_qual, adapt_seqs, num_cpu=num_cpu), num_bytes)
   
-  return n_reads, n_qclip, n_adapt, n_short, mean_len
+  cmd_args.append(BOWTIE2_QUAL_SCHEMES[qual_scheme])
+  stages = [('bowtie2', cmd_args)] # SAM to stdout
+  
+  if filter_args:
+    stages.append(('samtools view', [samtools_exe, 'view', '-u'] + filter_args + ['-']))
+  
+  bam_path_temp = io.tag_file_name(bam_path, util.TEMP_ID, '.bam')
+  stages.append(('samtools sort', [samtools_exe, 'sort', '-o', bam_path_temp, '-']))
+  
+  util.info('Mapping, filtering and sorting reads for %s' % label)
+  try:
+    run_stages(stages, stage_log, label, feed)
+    os.rename(bam_path_temp, bam_path)
+  
+  finally:
+    if os.path.exists(bam_path_temp): # Failed
+      os.unlink(bam_path_temp)
+
+  util.info('Indexing BAM file %s' % bam_path)
+  run_stages([('samtools index', [samtools_exe, 'index', bam_path])], stage_log, label)
 
 
 def read_chromo_names(file_path):
@@ -177,13 +324,140 @@ def read_chromo_names(file_path):
   return name_dict
   
   
+def process_sample(sample_name, fastq_paths, path_root, peak_dir, map_args, samtools_exe, macs2_exe,
+                   qual_scheme, min_qual, adapt_seqs, num_cpu, keep_clipped, control_bam_path,
+                   control_job, chromo_name_dict, frag_size=None, keep_macs=False, full_out=False,
+                   stage_log=None):
+  """
+  Make a clean BAM file of mapped reads, unless already present, for one ChIP sample and call its
+  broad and narrow peaks, once any control reads, from control_job, have been mapped.
+  """
+  from nuc_tools import util, io, formats
+  import shutil
+  
+  nfq = len(fastq_paths)
+  clean_bam_file_path = io.tag_file_name(path_root, 'clean', '.bam')
+  
+  if stage_log is None:
+    stage_log = []
+  
+  if not os.path.exists(clean_bam_file_path):
+    if nfq == 2:
+      util.info('Mapping ChIP paired-end FASTQ reads to genome index for %s' % sample_name)
+      f_flag = '3' # Extra paired check in samtools filtering
+ 
+    else:
+      util.info('Mapping ChIP single-end FASTQ reads to genome index for %s' % sample_name)
+      #f_flag = '2'
+      f_flag = None
+ 
+    # Remove unmapped and low quality read alignments
+    # -f : must have these bits ; 2 = properly aligned, accounting for any pairs, 1 = part of a read pair
+    # -F : must not have these bits ; 4 = unmapped
+    # -q : quality
+ 
+    filter_args = ['-F','4','-q','30']
+    if f_flag:
+      filter_args.extend(['-f', f_flag])
+    
+    align_reads(fastq_paths, path_root, clean_bam_file_path, map_args, samtools_exe, qual_scheme,
+                min_qual, adapt_seqs, num_cpu, keep_clipped, filter_args, stage_log, sample_name)
+  
+  if control_job:
+    control_job.result() # Control alignments are needed for peak calling
+  
+  from formats import sam
+  chromo_sizes = formats.sam.get_bam_chromo_sizes(clean_bam_file_path)
+  
+  contigs, sizes = zip(*chromo_sizes)
+  
+  genome_size = '%.2e' % sum(sizes)
+  
+  # MACS2
+  
+  peak_out_dir = os.path.join(peak_dir, 'macs2_peaks_%s_%s' % (sample_name, util.get_rand_string(5)))
+  io.makedirs(peak_out_dir, exist_ok=True)
+  
+  broad_name = sample_name + '_b'
+  narrow_name = sample_name + '_n'
+  
+  broad_bed_in = os.path.join(peak_out_dir,'%s_peaks.broadPeak' % broad_name)
+  narrow_bed_in = os.path.join(peak_out_dir,'%s_peaks.narrowPeak' % narrow_name)
+  
+  broad_bed_out = io.tag_file_name(path_root, 'broad', '.bed')
+  narrow_bed_out = io.tag_file_name(path_root, 'narrow', '.bed')
+  
+  if not os.path.exists(narrow_bed_out):
+    if nfq == 2:
+      fmt = 'BAMPE'
+      
+      if frag_size:
+        util.warn('DNA fragment size specification (-fs) ignored for paired end reads' )
+        frag_size = None
+      
+    else:
+      fmt = 'BAM'
+
+    buffer_size = max(int(1e4), max(sizes)/1000)
+
+    common_args = [macs2_exe, 'callpeak',
+                   '-t', clean_bam_file_path,
+                   '--buffer-size', str(buffer_size), # Need to reduce when large number of contigs/chromos
+                   '-f', fmt,
+                   '-g', genome_size]
+
+    if control_bam_path:
+      common_args += ['-c', control_bam_path]
+    
+    if frag_size:
+      common_args += ['--nomodel', '--extsize', str(frag_size)]
+    
+    cmd_args = common_args + ['-n', broad_name, '-B', '-q', '0.05', '--broad', '--outdir', peak_out_dir]
+    util.info('Calling broad peaks for %s' % sample_name)
+    run_stages([('macs2 broad', cmd_args)], stage_log, sample_name)
+
+    cmd_args =  common_args + ['-n', narrow_name, '-B', '-q', '0.01', '--outdir', peak_out_dir]
+    util.info('Calling narrow peaks for %s' % sample_name)
+    run_stages([('macs2 narrow', cmd_args)], stage_log, sample_name)
+
+    # Collate and rename outputs
+
+    for bed_in, bed_out in ((broad_bed_in, broad_bed_out),
+                            (narrow_bed_in, narrow_bed_out)):
+
+      with io.open_file(bed_in) as in_file_obj, open(bed_out, 'w', FILE_BUFFER) as out_file_obj:
+        write = out_file_obj.write
+        join = '\t'.join
+
+        for line in in_file_obj:
+          data = line.split()
+          contig = data[0]
+          chromo = chromo_name_dict.get(contig, contig)
+
+          if len(chromo) < 3:
+            chromo = 'chr' + chromo
+
+          data[0] = chromo
+          if not full_out:
+            data = data[:5]
+
+          write(join(data) + '\n')
+
+      util.info('Written BED file %s' % bed_out)
+
+    if not keep_macs:
+      util.info('Cleanup MACS2 files, removing %s' % peak_out_dir)
+      shutil.rmtree(peak_out_dir)
+
+
 def chip_seq_process(fastq_path_groups, sample_names, genome_index, out_dir=None, control_fastq_paths=None,
                      control_name=None, control_bam_path=None, chromo_names_path=None, align_exe=None,
                      qual_scheme=None, min_qual=DEFAULT_MIN_QUAL, max_sep=DEFAULT_MAX_SEP,
-                     adapt_seqs=None, num_cpu=None, keep_macs=False, full_out=False, frag_size=None):
+                     adapt_seqs=None, num_cpu=None, keep_macs=False, full_out=False, frag_size=None,
+                     keep_clipped=False):
 
   from nuc_tools import util, io, formats, parallel
-  import shutil
+  from concurrent.futures import ThreadPoolExecutor
   
   if not (0 <= min_qual <= 40):
     util.critical('Miniumum FASTQ quality score must be in the range 0-40 (%d specified).' % min_qual)
@@ -280,221 +554,64 @@ def chip_seq_process(fastq_path_groups, sample_names, genome_index, out_dir=None
   if not num_cpu:
     num_cpu = parallel.MAX_CORES
   
+  # Samples, and any control, are processed concurrently if there are enough CPU cores
+  
+  num_jobs = len(fastq_path_groups) + (1 if control_fastq_paths else 0)
+  num_parallel = max(1, min(num_jobs, num_cpu // SAMPLE_MIN_CPU))
+  job_cpu = max(1, num_cpu // num_parallel)
+  
   map_args = [align_exe, '-D', '20', '-R', '3', '-N', '0',  '-L', '20',  '-i', 'S,1,0.5', # similar to very-sensitive
               '-x', genome_index, # '-k', '2',
               '--reorder', # '--score-min', 'L,-0.6,-0.6',
-              '-p', str(num_cpu),
+              '-p', str(job_cpu),
               '-X', str(max_sep)]  
   
-  if control_fastq_paths:
-    path_root = os.path.join(out_dir, control_name)
-    
-    if not control_bam_path:
-      control_bam_path = path_root + '.bam'
-    
-    control_sam_path = path_root + '.sam'
-   
-    if len(control_fastq_paths) == 2:
-      fastq_1, fastq_2 = control_fastq_paths
-      
-      control_fastq_1 = io.tag_file_name(path_root, 'clip_1', '.fastq')
-      control_fastq_2 = io.tag_file_name(path_root, 'clip_2', '.fastq')      
-      
-      if not os.path.exists(control_fastq_1):
-        clip_reads(fastq_1, control_fastq_1, qual_scheme, min_qual, adapt_seqs)
-
-      if not os.path.exists(control_fastq_2):
-        clip_reads(fastq_2, control_fastq_2, qual_scheme, min_qual, adapt_seqs)
-    
-      util.info('Mapping control paired-end FASTQ reads to genome index %s' % genome_index)
-      
-      cmd_args = map_args + ['-1', control_fastq_1, '-2', control_fastq_2, '-S', control_sam_path]
-      f_flag = '3' 
-    else:
-      fastq_1 = control_fastq_paths[0]
-      
-      control_fastq_1 = io.tag_file_name(path_root, 'clip_1', '.fastq')
-      
-      if not os.path.exists(control_fastq_1):
-        clip_reads(fastq_1, control_fastq_1, qual_scheme, min_qual, adapt_seqs)
-      
-      util.info('Mapping control single-end FASTQ reads to genome index %s' % genome_index)
-      
-      cmd_args = map_args + ['-U', control_fastq_1, '-S', control_sam_path]
-      #f_flag = '2'
-      f_flag = None
-      
-    cmd_args.append(BOWTIE2_QUAL_SCHEMES[qual_scheme])
-    util.call(cmd_args)
-
-    util.info("Converting SAM file output into sorted BAM")
-  
-    cmd_args = [samtools_exe, 'sort', '-O', 'bam', # '-@', str(num_cpu), # option only avail in newer samtools
-                '-o', control_bam_path,  control_sam_path] 
-    util.call(cmd_args)
-    
-    os.unlink(control_sam_path)    
-                 
-  elif control_bam_path:
-    #io.check_regular_file(control_bam_path, critical=True)     
-    io.check_regular_file(control_bam_path)
-    #fastq_1 = control_bam_path[:-4] + '.fq'
-  
-  
-  g = 0
-  for sample_name, fastq_paths in zip(sample_names, fastq_path_groups):
-    path_root = os.path.join(out_dir, sample_name)
-    
-    g += 1
+  for g, fastq_paths in enumerate(fastq_path_groups, 1):
     nfq = len(fastq_paths)
     
     if not 0 < nfq < 3:
       util.critical('One or two FASTQ files must be specified for group %d. Found: %d' % (g, nfq))
+  
+  parallel.start_pool(job_cpu) # Read clipping workers must not inherit pipes between stages
+  stage_log = []
+  jobs = []
+  
+  with ThreadPoolExecutor(num_parallel) as executor:
+    if control_fastq_paths:
+      path_root = os.path.join(out_dir, control_name)
     
-    clean_bam_file_path = io.tag_file_name(path_root, 'clean', '.bam')
-    
-    if not os.path.exists(clean_bam_file_path):
-      sam_file_path_temp  = io.tag_file_name(path_root, util.TEMP_ID, '.sam')
-      bam_file_path_temp  = io.tag_file_name(path_root, util.TEMP_ID, '.bam')
+      if not control_bam_path:
+        control_bam_path = path_root + '.bam'
       
-      # extract gzipped and clip FASTQ
-      clip_fastq_paths = []
-      for i, in_fq in enumerate(fastq_paths):
-        clip_fastq_path = io.tag_file_name(path_root, 'clip_%d' % (i+1), '.fastq')
-        clip_fastq_paths.append(clip_fastq_path)
-        clip_reads(in_fq, clip_fastq_path, qual_scheme, min_qual, adapt_seqs)
-
- 
-      if nfq == 2:
-        util.info('Mapping ChIP paired-end FASTQ reads to genome index %s' % genome_index)
-        cmd_args = map_args + ['-1', clip_fastq_paths[0], '-2', clip_fastq_paths[1], '-S', sam_file_path_temp]
-        f_flag = '3' # Extra paired check in samtools filtering
- 
-      else:
-        util.info('Mapping ChIP single-end FASTQ reads to genome index %s' % genome_index)
-        cmd_args = map_args + ['-U', clip_fastq_paths[0], '-S', sam_file_path_temp]
-        #f_flag = '2'
-        f_flag = None
- 
-      cmd_args.append(BOWTIE2_QUAL_SCHEMES[qual_scheme])
-      util.call(cmd_args)
- 
-      util.info("Converting SAM file output into sorted BAM")
- 
-      cmd_args = [samtools_exe, 'sort', # '-O', 'bam', # option only avail in newer samtools
-                  '-o', bam_file_path_temp,  sam_file_path_temp]
-      util.call(cmd_args)
- 
-      os.unlink(sam_file_path_temp)
- 
-      util.info('Removing unmapped and low quality read alignments')
- 
-      # -f : must have these bits ; 2 = properly aligned, accounting for any pairs, 1 = part of a read pair
-      # -F : must not have these bits ; 4 = unmapped
-      # -q : quality
- 
-      #cmd_args = [samtools_exe,'view','-b','-f',f_flag,'-F','4','-q','30', bam_file_path_temp]
-      cmd_args = [samtools_exe,'view','-b', '-F','4','-q','30']
-      if f_flag:
-        cmd_args.extend(['-f', f_flag])
-      cmd_args.append(bam_file_path_temp)
- 
-      with open(clean_bam_file_path, 'wb') as file_obj:
-        util.call(cmd_args, stdout=file_obj)
- 
-      os.unlink(bam_file_path_temp)
- 
-      util.info('Indexing BAM file')
- 
-      cmd_args = [samtools_exe, 'index', clean_bam_file_path]
-      util.call(cmd_args)
-    
-    from formats import sam
-    chromo_sizes = formats.sam.get_bam_chromo_sizes(clean_bam_file_path)
+      util.info('Mapping control FASTQ reads to genome index %s' % genome_index)
+      control_job = executor.submit(align_reads, control_fastq_paths, path_root, control_bam_path, map_args,
+                                    samtools_exe, qual_scheme, min_qual, adapt_seqs, job_cpu, keep_clipped,
+                                    stage_log=stage_log, label=control_name)
+      jobs.append(control_job)
     
-    contigs, sizes = zip(*chromo_sizes)
-    
-    genome_size = '%.2e' % sum(sizes)
-    
-    # MACS2
-    
-    
-    peak_out_dir = os.path.join(os.path.dirname(treatment_fastq_1), 'macs2_peaks_%s_%s' % (sample_name, util.get_rand_string(5)))
-    io.makedirs(peak_out_dir, exist_ok=True)
+    else:
+      control_job = None
     
-    broad_name = sample_name + '_b'
-    narrow_name = sample_name + '_n'
+    peak_dir = os.path.dirname(treatment_fastq_1)
     
-    broad_bed_in = os.path.join(peak_out_dir,'%s_peaks.broadPeak' % broad_name)
-    narrow_bed_in = os.path.join(peak_out_dir,'%s_peaks.narrowPeak' % narrow_name)
+    for sample_name, fastq_paths in zip(sample_names, fastq_path_groups):
+      path_root = os.path.join(out_dir, sample_name)
+      jobs.append(executor.submit(process_sample, sample_name, fastq_paths, path_root, peak_dir, map_args,
+                                  samtools_exe, macs2_exe, qual_scheme, min_qual, adapt_seqs, job_cpu,
+                                  keep_clipped, control_bam_path, control_job, chromo_name_dict,
+                                  frag_size, keep_macs, full_out, stage_log))
     
-    broad_bed_out = io.tag_file_name(path_root, 'broad', '.bed')
-    narrow_bed_out = io.tag_file_name(path_root, 'narrow', '.bed')
+    try:
+      for job in jobs:
+        job.result()
     
-    if not os.path.exists(narrow_bed_out):
-      if nfq == 2:
-        fmt = 'BAMPE'
-        
-        if frag_size:
-          util.warn('DNA fragment size specification (-fs) ignored for paired end reads' )
-          frag_size = None
-        
-      else:
-        fmt = 'BAM'
- 
-      buffer_size = max(int(1e4), max(sizes)/1000)
- 
-      common_args = [macs2_exe, 'callpeak',
-                     '-t', clean_bam_file_path,
-                     '--buffer-size', str(buffer_size), # Need to reduce when large number of contigs/chromos
-                     '-f', fmt,
-                     '-g', genome_size]
- 
-      if control_bam_path:
-        common_args += ['-c', control_bam_path]
+    except BaseException:
+      for job in jobs:
+        job.cancel()
       
-      if frag_size:
-        common_args += ['--nomodel', '--extsize', str(frag_size)]
-      
-      cmd_args = common_args + ['-n', broad_name, '-B', '-q', '0.05', '--broad', '--outdir', peak_out_dir]
-      util.info('Calling broad peaks')
-      util.call(cmd_args)
- 
-      cmd_args =  common_args + ['-n', narrow_name, '-B', '-q', '0.01', '--outdir', peak_out_dir]
-      util.info('Calling narrow peaks')
-      util.call(cmd_args)
-
-      # Collate and rename outputs
- 
-      #broad_bed_out = io.tag_file_name(fastq_1, 'broad', '.bed')
-      #narrow_bed_out = io.tag_file_name(fastq_1, 'narrow', '.bed')
- 
-      for bed_in, bed_out in ((broad_bed_in, broad_bed_out),
-                              (narrow_bed_in, narrow_bed_out)):
- 
-        with io.open_file(bed_in) as in_file_obj, open(bed_out, 'w', FILE_BUFFER) as out_file_obj:
-          write = out_file_obj.write
-          join = '\t'.join
- 
-          for line in in_file_obj:
-            data = line.split()
-            contig = data[0]
-            chromo = chromo_name_dict.get(contig, contig)
- 
-            if len(chromo) < 3:
-              chromo = 'chr' + chromo
- 
-            data[0] = chromo
-            if not full_out:
-              data = data[:5]
- 
-            write(join(data) + '\n')
- 
-        util.info('Written BED file %s' % bed_out)
- 
-      if not keep_macs:
-        util.info('Cleanup MACS2 files, removing %s' % peak_out_dir)
-        shutil.rmtree(peak_out_dir)
+      raise
+  
+  write_stage_log(stage_log, os.path.join(out_dir, STAGE_LOG_FILE))
   
   # Ad sample/file_tag names
     
@@ -574,6 +691,10 @@ def main(argv=None):
   arg_parse.add_argument('-k', '--keep-macs', default=False, action='store_true', dest='k',
                          help='Keep all MACS2 peak-calling output files.')
 
+  arg_parse.add_argument('-kc', '--keep-clipped', default=False, action='store_true', dest='kc',
+                         help='Write quality and adapter clipped reads to gzipped FASTQ files, which are kept,' \
+                              ' rather than piping them directly into the aligner.')
+
   arg_parse.add_argument('-qm', '--qual-min', default=DEFAULT_MIN_QUAL, metavar='MIN_QUALITY', type=int, dest='qm',
                          help='Minimum acceptable FASTQ quality score in range 0-40 for' \
                               ' clipping ends of reads. Default: %d' % DEFAULT_MIN_QUAL)
@@ -586,7 +707,9 @@ def main(argv=None):
                               ' for if not specified.')
 
   arg_parse.add_argument('-n', '--num-cpu', default=0, metavar='CPU_COUNT', dest='n',
-                         type=int, help='Number of CPU cores to use in parallel for genome mapping. Defaults to all available.')
+                         type=int, help='Number of CPU cores to use in parallel for read clipping and genome mapping.' \
+                              ' Samples are processed concurrently if there are at least %d cores for each.' \
+                              ' Defaults to all available.' % SAMPLE_MIN_CPU)
 
   default_ad_seq = ADAPTER_SEQS[DEFAULT_ADAPTER]
   ad_prests = ', '.join(['%s:%s' % (k, v) for k, v in ADAPTER_SEQS.items()])
@@ -642,6 +765,7 @@ def main(argv=None):
   min_qual = args['cn']
   full_out = args['fo']
   keep_macs = args['k']
+  keep_clipped = args['kc']
   min_qual = args['qm']
   max_sep = args['m']
   frag_size = args['fs']
@@ -653,7 +777,7 @@ def main(argv=None):
                    genome_index, out_dir, control_fastqs,
                    control_name, control_bam, chromo_names, align_exe,
                    qual_scheme, min_qual, max_sep, adapt_seqs, num_cpu,
-                   keep_macs, full_out, frag_size)
+                   keep_macs, full_out, frag_size, keep_clipped)
    
 if __name__ == '__main__':
 
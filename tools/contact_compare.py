@@ -17,167 +17,21 @@ import warnings
 warnings.filterwarnings("ignore")
 
 def normalize_contacts(contact_dict, chromo_limits, bin_size, new_chromo_limits=None,
-                       new_bin_size=None, compare_trans=False, clip=0.1, store_sparse=True):
+                       new_bin_size=None, compare_trans=False, clip=0.1, store_sparse=True,
+                       balance=False):
   """
-  For now dict is changed in-place to keep memory use down.
+  For now dict is changed in-place to keep memory use down. Uses sparse matrices throughout;
+  see core.nuc_contacts.normalize_contacts. Set balance for iterative correction (ICE).
   """
-  from nuc_tools import util, io
-  
-  if not new_bin_size:
-    new_bin_size = bin_size
-  
-  if not new_chromo_limits:
-    new_chromo_limits = chromo_limits
-  
-  chromo_sizes = {}
-  contact_scale = {}
-  chromo_offsets = {}
-  
-  chromos = sorted(new_chromo_limits) # contact dict pair keys will always be in alphabetic order
-
-  for chr_a in chromos:
-    s, e = chromo_limits[chr_a]
-    off = int(s/bin_size) # Offset in the original data
-    chromo_offsets[chr_a] = off
-    
-    s2, e2 = new_chromo_limits[chr_a] # Range in new data
-    num_bins = int(math.ceil(e2/bin_size)) 
-    contact_scale[chr_a] = np.zeros(num_bins, float) # Always start from zero
-    chromo_sizes[chr_a] = num_bins
-     
-  # Get row sums over whole map
-  
-  util.info(' .. fetch scalings', line_return=True)
-  pairs = []
-  
-  for k, chr_a in enumerate(chromos):
-    for chr_b in chromos[k:]:
-      pair = (chr_a, chr_b)
-      orig_mat = contact_dict.get(pair)
-      
-      if orig_mat is None:
-        continue
+  from core import nuc_contacts
   
-      if hasattr(orig_mat, 'toarray'):
-        orig_mat = orig_mat.toarray()
-          
-      a, b = orig_mat.shape
-      pairs.append(pair)
-      off_a = chromo_offsets[chr_a]
-      off_b = chromo_offsets[chr_b]
-      
-      n = min(off_a+a, len(contact_scale[chr_a])) # Matrix can exceed the new chromo limits
-      m = min(off_b+b, len(contact_scale[chr_b]))
-      
-      contact_scale[chr_a][off_a:n] += orig_mat[:n-off_a].sum(axis=1)
-      contact_scale[chr_b][off_b:m] += orig_mat[:,:m-off_b].sum(axis=0)
-  
-  # Make reciprocal and remove void regions
-        
-  for chr_a in contact_scale:
-    scale = contact_scale[chr_a]
-    med = np.median(scale)
-    
-    too_small = scale < (clip*med)
-    too_large = scale > (med/clip)
-
-    scale[scale == 0] = 1.0
-    scale = 1.0/scale
- 
-    scale[too_small] = 0.0
-    scale[too_large] = 0.0
-    
-    #nz = scale.nonzero()[0]
-    #scale *= len(nz)/scale[nz].sum()
-    
-    contact_scale[chr_a] = scale
-  
-  for chr_a, chr_b in pairs: # Sorted and available
-    is_cis = chr_a == chr_b
-    
-    if (not compare_trans) and (not is_cis):
-      del contact_dict[(chr_a, chr_b)]
-      continue
-    
-    util.info(' .. {} {}   '.format(chr_a, chr_b), line_return=True)
-    mat = contact_dict[(chr_a, chr_b)]
-    
-    if hasattr(mat, 'toarray'):
-      mat = mat.toarray()
-    
-    mat = mat.astype(np.float32)
-    
-    a, b = mat.shape
-    off_a = chromo_offsets[chr_a]
-    lim_a = chromo_sizes[chr_a]
-    off_b = chromo_offsets[chr_b]
-    lim_b = chromo_sizes[chr_b]
-    
-    after_a = max(0, (lim_a-a-off_a))
-    after_b = max(0, (lim_b-b-off_b))
-    
-    if off_a or off_b or after_a or after_b:
-      # all pairs use full range from zero
-      mat = np.pad(mat, [(off_a,after_a), (off_b,after_b)], 'constant') # will ensure square cis (it needn't be when only storing upper matrix)
-      a, b = mat.shape
-    
-    if a > lim_a:
-      a = lim_a
-      mat = mat[:a]
-
-    if b > lim_b:
-      b = lim_b
-      mat = mat[:,:b]
-    
-    if is_cis:
-      mat -= np.diag(np.diag(mat))
-      cols = np.arange(a-1)
-      rows = cols-1
-      
-      sub_diag_a = mat[rows, cols]
-      sub_diag_b = mat[cols, rows]
-      
-      # check for symmetry
-      
-      if np.all(sub_diag_a == sub_diag_b):
-        contact_scale[chr_a] *= 2 # Everything was counted twice : divide by double the amount
-      else:
-        mat += mat.T
-     
-    scale_a = contact_scale[chr_a].astype(np.float32)
-    scale_b = contact_scale[chr_b].astype(np.float32)
-        
-    mat *= np.sqrt(np.outer(scale_a, scale_b))
-    
-    nnz = len(scale_a.nonzero()[0]) * len(scale_b.nonzero()[0])
-    
-    msum = mat.sum()
-    
-    if not msum:
-      continue
-    
-    mat *= nnz/msum # The counts scale with the chromosome sizes
-    
-    if new_bin_size > bin_size: # i.e. do nothing if smaller or equal (smaller is not valid)
-      ratio = bin_size / float(new_bin_size)
-      p = int(math.ceil(a * ratio))
-      q = int(math.ceil(b * ratio))
-      mat = util.downsample_matrix(mat, (p, q))
-       
-    if store_sparse:
-      if is_cis:
-        mat = sparse.csr_matrix(mat)
-      else:
-        mat = sparse.coo_matrix(mat)
-    
-    contact_dict[(chr_a, chr_b)] = mat
-  
-  util.info(' .. normalised {} chromosomes/pairs'.format(len(pairs)), line_return=True)
+  nuc_contacts.normalize_contacts(contact_dict, chromo_limits, bin_size, new_chromo_limits,
+                                  new_bin_size, compare_trans, clip, store_sparse, balance)
 
   
 def contact_compare(in_path_a, in_path_b, pdf_path=None, npz_path=None, bin_size=None,
                     compare_trans=False, min_contig_size=None, d_max=None,
-                    use_corr=False, bed_path=None, diag_width=None, screen_gfx=False): 
+                    use_corr=False, bed_path=None, diag_width=None, screen_gfx=False, balance=False): 
     
   from nuc_tools import util, io
   from formats import npz, bed 
@@ -286,8 +140,8 @@ def contact_compare(in_path_a, in_path_b, pdf_path=None, npz_path=None, bin_size
     chromo_limits[key[0]] = (0, max(e1, e2))
   
   # Vanilla normalisation for now. Enforces comparable matrix sizes.
-  normalize_contacts(contacts_a, chromo_limits_a, orig_bin_size, chromo_limits, bin_size, compare_trans=compare_trans)
-  normalize_contacts(contacts_b, chromo_limits_b, orig_bin_size, chromo_limits, bin_size, compare_trans=compare_trans)  
+  normalize_contacts(contacts_a, chromo_limits_a, orig_bin_size, chromo_limits, bin_size, compare_trans=compare_trans, balance=balance)
+  normalize_contacts(contacts_b, chromo_limits_b, orig_bin_size, chromo_limits, bin_size, compare_trans=compare_trans, balance=balance)  
     
   if bed_path:
     bed_region_dict = {}
@@ -537,6 +391,10 @@ def main(argv=None):
   arg_parse.add_argument('-bed', metavar='OUT_BED_FILE', default=None,
                          help='Save differences (summed for each chromosome position) as a BED format file.')
 
+  arg_parse.add_argument('-ice', default=False, action='store_true',
+                         help='Normalise contacts using iterative correction (matrix balancing), so that all ' \
+                              'chromosome positions have the same total, rather than the default single step scaling.')
+
   args = vars(arg_parse.parse_args(argv))
 
   in_path_a, in_path_b = args['i']
@@ -550,6 +408,7 @@ def main(argv=None):
   use_corr = args['corr']
   bed_path = args['bed']
   diag_width = args['diag']
+  balance = args['ice']
   
   if not d_max:
     if use_corr:
@@ -574,7 +433,7 @@ def main(argv=None):
 
   contact_compare(in_path_a, in_path_b, pdf_path, npz_path, bin_size,
                   comp_trans, min_contig_size, d_max, use_corr, bed_path,
-                  diag_width, screen_gfx)
+                  diag_width, screen_gfx, balance)
   
 
 if __name__ == "__main__":
@@ -14,6 +14,7 @@ DEFAULT_BIN_SIZE = 25.0
 def contact_density(contact_path, out_path_root=None, bin_size=DEFAULT_BIN_SIZE, seq_sep_thresholds=SEQ_SEP_THRESHOLDS):
 
   from nuc_tools import util, io
+  from core import nuc_contacts
   from formats import ncc, npz, bed
     
   if  out_path_root:
@@ -27,10 +28,10 @@ def contact_density(contact_path, out_path_root=None, bin_size=DEFAULT_BIN_SIZE,
     file_bin_size = None
     bin_size = int(bin_size * 1e3)
     util.info('  .. loading')
-    chromosomes, chromo_limits, contacts = ncc.load_file(in_path, trans=True, dtype=np.int32)
+    chromosomes, chromo_limits, contacts = ncc.load_file(contact_path, trans=True, dtype=np.int32)
     
   else:
-    file_bin_size, chromo_limits, contacts = npz.load_npz_contacts(contact_path, trans=True)
+    file_bin_size, chromo_limits, contacts = npz.load_npz_contacts(contact_path, trans=True, store_sparse=True, lazy=True)
     bin_size = file_bin_size
     chromosomes = chromo_limits.keys()
   
@@ -71,6 +72,8 @@ def contact_density(contact_path, out_path_root=None, bin_size=DEFAULT_BIN_SIZE,
     
   track_tags.append('trans')  
   
+  n_classes = len(SEQ_SEP_THRESHOLDS) + 1
+  
   for chr_a, chr_b in contacts:
     chromo_pair= (chr_a, chr_b)
     n_a = len(data_tracks[0][chr_a])
@@ -78,68 +81,51 @@ def contact_density(contact_path, out_path_root=None, bin_size=DEFAULT_BIN_SIZE,
     
     if file_bin_size:
       matrix = contacts[chromo_pair]
+      off_a = int(chromo_limits[chr_a][0]/bin_size)
+      off_b = int(chromo_limits[chr_b][0]/bin_size)
+      end_a = off_a + matrix.shape[0]
+      end_b = off_b + matrix.shape[1]
       
       if chr_a == chr_b: # cis
-        n = len(matrix)
-        data_idx = 0
- 
-        for d in range(0, n): # diagonal line
-          m = n-d
-          rows = np.array(range(m))
-          cols = rows + d
-          idx = (rows, cols)
-          seq_sep = d * file_bin_size
-       
-          if d and (seq_sep >= SEQ_SEP_THRESHOLDS[data_idx]) and ((d-1) * file_bin_size < SEQ_SEP_THRESHOLDS[data_idx]):
-            data_idx += 1
-          
-          data_dict = data_tracks[data_idx]
-          data_dict[chr_a][:m] += matrix[idx] # rows
-          data_dict[chr_a][d:] += matrix[idx] # cols
+        rows, cols, counts = nuc_contacts.get_diagonal_band(matrix)
+        seps = (cols - rows) * file_bin_size
+        class_counts = nuc_contacts.get_sep_class_counts(rows, cols, counts, seps, SEQ_SEP_THRESHOLDS, matrix.shape[0])
+        
+        for i in range(n_classes):
+          data_tracks[i][chr_a][off_a:end_a] += class_counts[i]
         
         # all cis
         data_dict = data_tracks[-2]
-        data_dict[chr_a] += matrix.sum(axis=1)
-        data_dict[chr_b] += matrix.sum(axis=0)        
         
       else: # trans
         data_dict = data_tracks[-1]
-        data_dict[chr_a] += matrix.sum(axis=1)
-        data_dict[chr_b] += matrix.sum(axis=0)
+      
+      data_dict[chr_a][off_a:end_a] += np.asarray(matrix.sum(axis=1)).ravel()
+      data_dict[chr_b][off_b:end_b] += np.asarray(matrix.sum(axis=0)).ravel()
      
     else:
       contact_array = contacts[chromo_pair]
       seq_pos_a = contact_array[:,0]
       seq_pos_b = contact_array[:,1]
-      chromo_counts = contact_array[:,2]
-      seps = abs(seq_pos_a-seq_pos_b)
       
       bins_a = (seq_pos_a/bin_size).astype(int)
       bins_b = (seq_pos_b/bin_size).astype(int)
       
       if chr_a == chr_b:
-        for i, (th_max, th_min) in enumerate(thr_max_min): # Short/long range seq separation limits
-          if th_max and th_min:
-            idx = seps < th_max & seps >= th_min
-          elif th_max:
-            idx = seps < th_max
-          elif th_min:
-            idx = seps >= th_min
-          else:
-            idx = seps > 0
-          
-          bin_counts_a, null = np.histogram(bins_a[idx], bins=n_a, range=(0,n_a))
-          bin_counts_b, null = np.histogram(bins_b[idx], bins=n_b, range=(0,n_b))
-          data_dict = data_tracks[i]
-          data_dict[chr_a] += bin_counts_a
-          data_dict[chr_a] += bin_counts_b
+        seps = abs(seq_pos_a-seq_pos_b)
+        class_counts = nuc_contacts.get_sep_class_counts(bins_a, bins_b, None, seps, SEQ_SEP_THRESHOLDS, n_a)
+        
+        for i in range(n_classes):
+          data_tracks[i][chr_a] += class_counts[i]
+        
+        idx = seps > 0 # all cis
+        data_tracks[-2][chr_a] += np.bincount(bins_a[idx], minlength=n_a)
+        data_tracks[-2][chr_a] += np.bincount(bins_b[idx], minlength=n_a)
         
       else:
-        bin_counts_a, null = np.histogram(bins_a, bins=n_a, range=(0,n_a))
-        bin_counts_b, null = np.histogram(bins_b, bins=n_b, range=(0,n_b))
         data_dict = data_tracks[-1]
-        data_dict[chr_a][bins_a] += bin_counts_a
-        data_dict[chr_b][bins_a] += bin_counts_b
+        data_dict[chr_a] += np.bincount(bins_a, minlength=n_a)
+        data_dict[chr_b] += np.bincount(bins_b, minlength=n_b)
   
   for i, data_dict in enumerate(data_tracks):
     out_file_path = '{}_{}.bed'.format(out_path_root, track_tags[i])
@@ -24,22 +24,10 @@ DEFAULT_BOOTSTRAP_SAMPLES = 1000
 
 def get_obs_vs_exp(obs, clip=10):
 
-  from contact_map import get_cis_expectation
+  from core import nuc_contacts
 
-  obs -= np.diag(np.diag(obs))
-  expt = get_cis_expectation(obs)
+  return nuc_contacts.get_obs_vs_exp(obs, clip)
 
-  prod = expt * obs
-
-  nz = prod != 0.0
- 
-  log_ratio = obs.copy()
-  log_ratio[nz] /= expt[nz]
-  log_ratio[nz] = np.log(log_ratio[nz])
-  log_ratio = np.clip(log_ratio, -clip, clip)
-  
-  
-  return log_ratio
   
 def contact_enrichment(region_path, contact_paths, pdf_path, bin_size=DEFAULT_BIN_SIZE, labels=None,
                        num_bootstrap=DEFAULT_BOOTSTRAP_SAMPLES, num_null=DEFAULT_NULL_SAMPLES):
@@ -16,11 +16,11 @@ FILE_TAG = 'hi-c_insulation'
   
 def contact_insulation(region_path, contact_paths, pdf_path, bin_size=DEFAULT_BIN_SIZE, labels=None,
                        max_sep=DEFAULT_KB_MAX_SEQ_SEP, use_starts=True, use_ends=True, screen_gfx=False,
-                       write_bed=False):
+                       write_bed=False, write_track=False):
 
   from nuc_tools import util, io
+  from core import nuc_contacts
   from formats import bed, ncc, npz  
-  from contact_compare import normalize_contacts
   
   max_sep *= 1000
   bin_size *= 1000
@@ -63,20 +63,20 @@ def contact_insulation(region_path, contact_paths, pdf_path, bin_size=DEFAULT_BI
         
     else:
        is_ncc = False
-       bin_size, chromo_limits, contacts = npz.load_npz_contacts(in_path, trans=False)
-       normalize_contacts(contacts, chromo_limits, bin_size, store_sparse=False)
+       bin_size, chromo_limits, contacts = npz.load_npz_contacts(in_path, trans=False, store_sparse=True)
+       nuc_contacts.normalize_contacts(contacts, chromo_limits, bin_size, store_sparse=True)
     
     chromos = util.sort_chromosomes([x[0] for x in contacts])
     ratios = []
     out_region_dict = {}
     out_value_dict = {}
+    track_dict = {}
     
     for chr_a in chromos:
       chromo_pair = (chr_a, chr_a)
-      regions = region_dict[chr_a]
-      chromo_ratios = []
+      regions = region_dict.get(chr_a, ())
       
-      if not len(regions):
+      if not (len(regions) or write_track):
         continue
               
       if not is_ncc:
@@ -84,17 +84,20 @@ def contact_insulation(region_path, contact_paths, pdf_path, bin_size=DEFAULT_BI
       else:
         start, end = chromo_limits[chr_a]     
              
-      mat = contacts[chromo_pair].astype(float)
-      msum = mat.sum()
+      mat = contacts[chromo_pair]
       
-      if not msum:
+      if not mat.sum():
         continue
       
-      mat /= 1e7 * msum
       n = mat.shape[0]
-      
       dbin = int(max_sep/bin_size)
       
+      if write_track:
+        track_dict[chr_a] = util.hist_to_data_track(nuc_contacts.get_insulation(mat, dbin), bin_size)
+      
+      if not len(regions):
+        continue
+      
       if use_starts and use_ends:
         boundaries = regions.ravel()
 
@@ -110,44 +113,22 @@ def contact_insulation(region_path, contact_paths, pdf_path, bin_size=DEFAULT_BI
       for i, pos in enumerate(boundaries):
         if (pos - prev_pos) < MIN_BOUNDARY_SEP:
           continue
-      
-        bin_0 = (pos-start)/bin_size
-        bin_a = max(0, bin_0-dbin)
-        bin_b = min(n-1, bin_0+dbin)
-        
-        sub_mat = mat[bin_a:bin_b+1,bin_a:bin_b+1]
-        mid = bin_0-bin_a # Index of boundary bin in sub-array
-        idx = np.indices(sub_mat.shape)
-        rows, cols = idx
-        
-        prev = sub_mat[(rows <= mid) & (cols <= mid)]
-        next = sub_mat[(rows >= mid) & (cols >= mid)]
         
-        idx_u = (rows <= mid) & (cols >= mid) & (cols-rows <= dbin)
-        idx_l = (cols <= mid) & (rows >= mid) & (rows-cols <= dbin)
-        inter = sub_mat[idx_u | idx_l]
-
-        if len(inter) and len(prev) and len(next):
-          im = inter.mean()
-          
-          if im:
-            ratio = max(prev.mean(), next.mean())/im
-          else:
-            ratio = 0.0
-            
-          chromo_ratios.append(ratio)
+        if 0 <= pos-start < n * bin_size: # Boundary bin is within the matrix
           valid.append(i)
         
         prev_pos = pos
       
-      ratios += chromo_ratios
+      bins = (boundaries[valid]-start) // bin_size
+      chromo_ratios = nuc_contacts.get_insulation(mat, dbin, bins)
+      ratios.append(chromo_ratios)
       
       if write_bed:
         pos = boundaries[valid]
         out_region_dict[chr_a] = np.array([pos,pos+1]).T
-        out_value_dict[chr_a] = np.array(chromo_ratios)
+        out_value_dict[chr_a] = chromo_ratios
         
-    ratios = np.array(ratios)
+    ratios = np.concatenate(ratios) if ratios else np.zeros(0)
     all_ratios.append(np.log10(1.0 + ratios))
     
     if write_bed:
@@ -155,6 +136,11 @@ def contact_insulation(region_path, contact_paths, pdf_path, bin_size=DEFAULT_BI
       bed.save_bed_data_track(bed_path, out_region_dict, out_value_dict, as_float=True)
       util.info('Written {}'.format(bed_path))
     
+    if write_track:
+      track_path = '%s_%s_track.bed' % (os.path.splitext(in_path)[0], FILE_TAG)
+      bed.save_data_track(track_path, track_dict, as_float=True)
+      util.info('Written {}'.format(track_path))
+    
   from colorsys import hsv_to_rgb
   
   if screen_gfx:
@@ -231,6 +217,9 @@ def main(argv=None):
   arg_parse.add_argument('-b', '--write-bed', action='store_true', dest="b",
                          help='Write out insulation scores for each input contat file as a BED format file.')
 
+  arg_parse.add_argument('-t', '--write-track', action='store_true', dest="t",
+                         help='Write out a genome-wide insulation score track, at every bin, for each input contact file as a BED format file.')
+
   arg_parse.add_argument('-g', '--gfx', default=False, action='store_true', dest="g",
                          help='Display graphics on-screen using matplotlib and do not automatically save output.')
 
@@ -270,6 +259,7 @@ def main(argv=None):
   max_sep = args['m']
   screen_gfx = args['g']
   write_bed = args['b']
+  write_track = args['t']
   
   #num_bootstrap = args['nb']
   #num_null = args['nn']
@@ -282,7 +272,7 @@ def main(argv=None):
     pdf_path = None
      
   contact_insulation(region_path, contact_paths, pdf_path, bin_size,
-                     labels, max_sep, use_starts, use_ends, screen_gfx, write_bed)
+                     labels, max_sep, use_starts, use_ends, screen_gfx, write_bed, write_track)
   
 
 if __name__ == "__main__":
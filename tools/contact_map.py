@@ -31,140 +31,17 @@ import warnings
 warnings.filterwarnings("ignore")
 
 def normalize_contacts(contact_dict, chromo_limits, bin_size, new_chromo_limits=None,
-                       new_bin_size=None, compare_trans=False, clip=0.1, store_sparse=True):
+                       new_bin_size=None, compare_trans=False, clip=0.1, store_sparse=True,
+                       balance=False):
   """
-  For now dict is changed in-place to keep memory use down.
+  For now dict is changed in-place to keep memory use down. Uses sparse matrices throughout;
+  see core.nuc_contacts.normalize_contacts. Set balance for iterative correction (ICE).
   """
-  from nuc_tools import util, io
-  
-  if not new_bin_size:
-    new_bin_size = bin_size
-  
-  if not new_chromo_limits:
-    new_chromo_limits = chromo_limits
-  
-  chromo_sizes = {}
-  contact_scale = {}
-  chromo_offsets = {}
-  
-  chromos = sorted(new_chromo_limits) # contact dict pair keys will always be in alphabetic order
-
-  for chr_a in chromos:
-    s, e = chromo_limits[chr_a]
-    off = int(s/bin_size) # Offset in the original data
-    chromo_offsets[chr_a] = off
-    
-    s, e = new_chromo_limits[chr_a] # Range in new data
-    num_bins = int(math.ceil(e/bin_size)) 
-    contact_scale[chr_a] = np.zeros(num_bins, float) # Always start from zero
-    chromo_sizes[chr_a] = num_bins
-     
-  # Get row sums over whole map
-  
-  util.info(' .. fetch scalings', line_return=True)
-  pairs = []
-  
-  for k, chr_a in enumerate(chromos):
-    for chr_b in chromos[k:]:
-      pair = (chr_a, chr_b)
-      orig_mat = contact_dict.get(pair)
-      
-      if orig_mat is None:
-        continue
-  
-      if hasattr(orig_mat, 'toarray'):
-        orig_mat = orig_mat.toarray()
-          
-      a, b = orig_mat.shape
-      pairs.append(pair)
-      off_a = chromo_offsets[chr_a]
-      off_b = chromo_offsets[chr_b]
-     
-      contact_scale[chr_a][off_a:off_a+a] += orig_mat.sum(axis=1)
-      contact_scale[chr_b][off_b:off_b+b] += orig_mat.sum(axis=0)
-  
-  # Make reciprocal and remove void regions
-        
-  for chr_a in contact_scale:
-    scale = contact_scale[chr_a]
-    med = np.median(scale)
-    
-    too_small = scale < (clip*med)
-    too_large = scale > (med/clip)
-    
-    scale[scale == 0] = 1.0
-    scale = 1.0/scale
- 
-    scale[too_small] = 0.0
-    scale[too_large] = 0.0
-    
-    contact_scale[chr_a] = scale    
+  from core import nuc_contacts
   
-  for chr_a, chr_b in pairs: # Sorted and avliable
-    is_cis = chr_a == chr_b
-    
-    if (not compare_trans) and (not is_cis):
-      del contact_dict[(chr_a, chr_b)]
-      continue
-    
-    util.info(' .. {} {}   '.format(chr_a, chr_b), line_return=True)
-    mat = contact_dict[(chr_a, chr_b)]
-    
-    if hasattr(mat, 'toarray'):
-      mat = mat.toarray()
-    
-    mat = mat.astype(np.float32)
-    a, b = mat.shape
-    off_a = chromo_offsets[chr_a]
-    lim_a = chromo_sizes[chr_a]
-    off_b = chromo_offsets[chr_b]
-    lim_b = chromo_sizes[chr_b]
-    
-    if off_a or off_b or (lim_a-a-off_a) or (lim_b-b-off_b):
-      # all pairs use full range from zero
-      mat = np.pad(mat, [(off_a,lim_a-a-off_a), (off_b,lim_b-b-off_b)], 'constant') # will ensure square cis (it needn't be when only storing upper matrix)
-      a, b = mat.shape
+  nuc_contacts.normalize_contacts(contact_dict, chromo_limits, bin_size, new_chromo_limits,
+                                  new_bin_size, compare_trans, clip, store_sparse, balance)
 
-    if is_cis:
-      mat -= np.diag(np.diag(mat))
-      
-      for i in range(1,a):
-        if mat[i,i-1]: # Check data is present below the diagonal
-          contact_scale[chr_a] *= 2 # Everything was counted twice : divide by double the amount
-          break
-      
-      else:
-        mat += mat.T
-        
-    scale_a = contact_scale[chr_a].astype(np.float32)
-    scale_b = contact_scale[chr_b].astype(np.float32)
-    
-    mat *= np.sqrt(np.outer(scale_a, scale_b))
-    
-    nnz = np.sqrt(len(scale_a.nonzero()[0]) * len(scale_b.nonzero()[0]))
-    
-    msum = mat.sum()
-    
-    if not msum:
-      continue
-    
-    mat *= nnz/msum # The counts scale with the chromosome sizes
-    
-    if new_bin_size > bin_size: # i.e. do nothing if smaller or equal (smaller is not valid)
-      ratio = bin_size / float(new_bin_size)
-      p = int(math.ceil(a * ratio))
-      q = int(math.ceil(b * ratio))
-      mat = util.downsample_matrix(mat, (p, q))
-       
-    if store_sparse:
-      if is_cis:
-        mat = sparse.csr_matrix(mat)
-      else:
-        mat = sparse.coo_matrix(mat)
-    
-    contact_dict[(chr_a, chr_b)] = mat
-  
-  util.info(' .. normalised {} chromosomes/pairs'.format(len(pairs)), line_return=True)
 
 
 def _downsample_matrix(in_array, new_shape, pad=False):
@@ -215,125 +92,65 @@ def _get_chromo_offsets(bin_size, chromos, chromo_limits):
 
 
 def get_obs_vs_exp(obs, clip=10):
+  """
+  Log observed/expected contacts of a cis matrix; see core.nuc_contacts.get_obs_vs_exp
+  """
 
-  obs -= np.diag(np.diag(obs))
-  expt = get_cis_expectation(obs)
-
-  prod = expt * obs
+  from core import nuc_contacts
 
-  nz = prod != 0.0
- 
-  log_ratio = obs.copy()
-  log_ratio[nz] /= expt[nz]
-  log_ratio[nz] = np.log(log_ratio[nz])
-  log_ratio = np.clip(log_ratio, -clip, clip)
-    
-  return log_ratio
+  return nuc_contacts.get_obs_vs_exp(obs, clip)
   
   
 def get_cis_expectation(obs):
 
-  n = len(obs)
-  sobs = obs.sum()
-  sep_dict = defaultdict(list) 
- 
-  for d in range(1, n):
-    idx1 = np.array(range(n-d))
-    idx2 = idx1 + d
-    idx = (idx1, idx2)
-    sep_dict[d] = obs[idx]
- 
-  sep_sig = np.zeros(n, float)
- 
-  for i in range(n):
-    if i in sep_dict:
-      sep_sig[i] = np.mean(sep_dict[i])
-
-  expt = np.zeros((n, n), float)
-
-  for i in range(n):
-    expt[i,:i] = sep_sig[:i][::-1]
-    expt[i,i:] = sep_sig[:n-i]
+  from core import nuc_contacts
   
-  vals = obs.sum(axis=0).astype(float)
-  vals /= vals.sum() or 1.0
- 
-  expt *= np.outer(vals, vals)
-  expt *= sobs/expt.sum()
-  
-  return expt
+  return nuc_contacts.get_cis_expectation(obs)
 
   
 def get_corr_mat(obs, clip=5.0):
 
-  obs -= np.diag(np.diag(obs))
-  expt = get_cis_expectation(obs)
+  from core import nuc_contacts
 
-  prod = expt * obs
-  nz = prod != 0.0
- 
-  log_ratio = obs.copy()
-  log_ratio[nz] /= expt[nz]
-  log_ratio[nz] = np.log(log_ratio[nz])
-  log_ratio = np.clip(log_ratio, -clip, clip)
+  log_ratio = nuc_contacts.get_obs_vs_exp(obs, clip)
  
   corr_mat = np.corrcoef(log_ratio)
-  corr_mat -= np.diag(np.diag(corr_mat))
-
-  corr_mat = np.nan_to_num(corr_mat)
+  del log_ratio
+  
+  np.fill_diagonal(corr_mat, 0.0)
+  np.nan_to_num(corr_mat, copy=False)
   
   return corr_mat
 
 
 def get_trans_corr_mat(obs_a, obs_b, obs_ab, clip=5.0):
   
+  from core import nuc_contacts
+  
   n = len(obs_a)
   m = len(obs_b)
   z = n+m
 
-  obs_a -= np.diag(np.diag(obs_a))
-  obs_b -= np.diag(np.diag(obs_b))
+  np.fill_diagonal(obs_a, 0)
+  np.fill_diagonal(obs_b, 0)
   mat = np.zeros((z, z))
   
-  # Add cis A
-  
-  expt = get_cis_expectation(obs_a)
-  nz = (expt * obs_a) != 0.0  
-  log_ratio = obs_a.copy()
-  log_ratio[nz] /= expt[nz]
-  
-  mat[:n,:n] = log_ratio
-  
-  # Add cis B
+  # Cis A and B; plain ratios
   
-  expt = get_cis_expectation(obs_b)
-  nz = (expt * obs_b) != 0.0  
-  log_ratio = obs_b.copy()
-  log_ratio[nz] /= expt[nz]
-  
-  mat[n:,n:] = log_ratio
+  mat[:n,:n] = nuc_contacts.get_obs_vs_exp(obs_a, clip=None, log=False)
+  mat[n:,n:] = nuc_contacts.get_obs_vs_exp(obs_b, clip=None, log=False)
   
   # Add trans
   
-  expt = np.full((n,m), obs_ab.mean())
-  sobs = obs_ab.sum()
-  
   vals_a = obs_a.sum(axis=0) + obs_ab.sum(axis=1)
   vals_b = obs_b.sum(axis=0) + obs_ab.sum(axis=0)
- 
-  expt *= np.outer(vals_a, vals_b)
-  expt *= sobs/expt.sum()
   
-  nz = (expt * obs_ab) != 0.0  
-  log_ratio = obs_ab.copy()
-  log_ratio[nz] /= expt[nz]
-  
-  mat[:n,n:] = log_ratio
-  mat[n:,:n] = log_ratio.T
+  mat[:n,n:] = nuc_contacts.get_trans_obs_vs_exp(obs_ab, vals_a, vals_b, log=False)
+  mat[n:,:n] = mat[:n,n:].T
   
   nz = mat.nonzero()
   mat[nz] = np.log(mat[nz])
-  mat = np.clip(mat, -clip, clip)
+  np.clip(mat, -clip, clip, out=mat)
   
   corr_mat = np.corrcoef(mat)
     
@@ -464,6 +281,40 @@ def get_single_array_matrix(contact_matrix, limits_a, limits_b, is_cis, orig_bin
   return matrix
   
 
+def _get_ambig_groups(contacts):
+  """
+  Sorted ambiguity group IDs, from the last column of the contact arrays, and their sizes
+  """
+  
+  groups = [np.asarray(contacts[key])[:,3] for key in contacts if len(contacts[key])]
+  
+  if not groups:
+    return np.zeros(0, int), np.zeros(0, int)
+  
+  return np.unique(np.concatenate(groups), return_counts=True)
+  
+  
+def _is_ambig(groups, ambig_groups):
+  """
+  Whether each of an array of group IDs is for an ambiguous group, i.e. has more than one contact
+  """
+  
+  group_ids, group_sizes = ambig_groups
+  
+  if not len(group_ids):
+    return np.zeros(len(groups), bool)
+  
+  idx = np.searchsorted(group_ids, groups).clip(0, len(group_ids)-1)
+  
+  return (group_ids[idx] == groups) & (group_sizes[idx] > 1)
+  
+  
+def _add_list_contacts(matrix, ambig_matrix, rows, cols, counts, is_ambig):
+  
+  np.add.at(matrix, (rows[~is_ambig], cols[~is_ambig]), counts[~is_ambig])
+  np.add.at(ambig_matrix, (rows[is_ambig], cols[is_ambig]), counts[is_ambig])
+    
+    
 def get_single_list_matrix(contact_list, limits_a, limits_b, is_cis, bin_size, ambig_groups):
   
   n, m = _limits_to_shape(limits_a, limits_b, bin_size)
@@ -474,14 +325,11 @@ def get_single_list_matrix(contact_list, limits_a, limits_b, is_cis, bin_size, a
   start_a, end_a = limits_a
   start_b, end_b = limits_b
   
-  for p_a, p_b, nobs, ag in contact_list:
-    a = int((p_a-start_a)/bin_size)
-    b = int((p_b-start_b)/bin_size) 
-    
-    if ambig_groups[ag] > 1:
-      ambig_matrix[a,b] += nobs
-    else:
-      matrix[a,b] += nobs
+  p_a, p_b, nobs, ag = np.asarray(contact_list).reshape(-1, 4).T
+  a = ((p_a-start_a)/bin_size).astype(int)
+  b = ((p_b-start_b)/bin_size).astype(int)
+  
+  _add_list_contacts(matrix, ambig_matrix, a, b, nobs, _is_ambig(ag, ambig_groups))
   
   if is_cis:
     matrix += matrix.T
@@ -525,16 +373,14 @@ def get_region_list_matrix(contact_list, region, bin_size, ambig_groups):
   matrix = np.zeros((n, m), float)
   ambig_matrix = np.zeros((n, m), float)
   
-  for p_a, p_b, nobs, ag in contact_list:
-    if (start <= p_a <= end) and (start <= p_b <= end):
-      a = int((p_a-start)/bin_size)
-      b = int((p_b-start)/bin_size)
- 
-      if ambig_groups[ag] > 1:
-        ambig_matrix[a,b] += nobs
- 
-      else:
-        matrix[a,b] += nobs
+  p_a, p_b, nobs, ag = np.asarray(contact_list).reshape(-1, 4).T
+  idx = (start <= p_a) & (p_a <= end) & (start <= p_b) & (p_b <= end)
+  p_a, p_b, nobs, ag = p_a[idx], p_b[idx], nobs[idx], ag[idx]
+  
+  a = ((p_a-start)/bin_size).astype(int)
+  b = ((p_b-start)/bin_size).astype(int)
+  
+  _add_list_contacts(matrix, ambig_matrix, a, b, nobs, _is_ambig(ag, ambig_groups))
   
   matrix += matrix.T
   ambig_matrix += ambig_matrix.T
@@ -550,16 +396,11 @@ def get_contact_lists_matrix(contacts, bin_size, chromos, chromo_limits):
   matrix = np.zeros((n, n), float)
   ambig_matrix = np.zeros((n, n), float)
   
-  ambig_groups = defaultdict(int)
-    
-  for key in contacts:
-    for p_a, p_b, nobs, ag in contacts[key]:
-      ambig_groups[ag] += 1
-
+  ambig_groups = _get_ambig_groups(contacts) 
   trans_counts = {}
-  homolog_groups = set()
-  trans_groups = set()
-  cis_groups = set()
+  homolog_groups = []
+  trans_groups = []
+  cis_groups = []
   n_isol = 0
   n_pairs = 0
   
@@ -576,50 +417,39 @@ def get_contact_lists_matrix(contacts, bin_size, chromos, chromo_limits):
       if contact_list is None: # Nothing for this pair: common for single-cell Hi-C
         continue
       
-      ni = 0
-      isol = _get_isolated(contact_list)
       s_a, off_a, size_a = chromo_offsets[chr_a]
       s_b, off_b, size_b = chromo_offsets[chr_b]
-
-      for p_a, p_b, nobs, ag in contact_list:
-        if chr_a != chr_b:
-          if ('.' in chr_a) and ('.' in chr_b) and (chr_a.split('.')[0] == chr_b.split('.')[0]):
-            homolog_groups.add(ag)
-
-          else:
-            trans_groups.add(ag)
+      p_a, p_b, nobs, ag = np.asarray(contact_list).reshape(-1, 4).T
+      
+      if chr_a != chr_b:
+        if ('.' in chr_a) and ('.' in chr_b) and (chr_a.split('.')[0] == chr_b.split('.')[0]):
+          homolog_groups.append(ag)
 
         else:
-          cis_groups.add(ag)
+          trans_groups.append(ag)
 
-        a = off_a + int((p_a-s_a)/bin_size)
-        b = off_b + int((p_b-s_b)/bin_size)
-  
- 
-        if ambig_groups[ag] == 1:
-          matrix[a, b] += nobs
-          matrix[b, a] += nobs
-          n_pairs += 1
-          
-          if (p_a, p_b) in isol:
-            ni += 1
-  
-        else:
-          ambig_matrix[a, b] += nobs
-          ambig_matrix[b, a] += nobs
+      else:
+        cis_groups.append(ag)
+      
+      a = off_a + ((p_a-s_a)/bin_size).astype(int)
+      b = off_b + ((p_b-s_b)/bin_size).astype(int)
+      is_ambig = _is_ambig(ag, ambig_groups)
       
+      _add_list_contacts(matrix, ambig_matrix, a, b, nobs, is_ambig)
+      _add_list_contacts(matrix, ambig_matrix, b, a, nobs, is_ambig)
+      
+      n_pairs += len(ag) - np.count_nonzero(is_ambig)
+      ni = np.count_nonzero(_get_isolated(contact_list) & ~is_ambig)
       n_isol += ni
      
       if chr_a != chr_b:
         s1, e1 = chromo_limits[chr_a]
         s2, e2 = chromo_limits[chr_b]
         trans_counts[(chr_a, chr_b)] = (len(contact_list) - ni)/float((e1-s1) * (e2-s2))
-        
-  n_ambig = len([x for x in ambig_groups.values() if x > 1])
-  n_homolog = len(homolog_groups)
-  n_trans = len(trans_groups)
-  n_cis = len(cis_groups)
-  n_cont = len(ambig_groups)
+  
+  n_cont = len(ambig_groups[0])
+  n_ambig = np.count_nonzero(ambig_groups[1] > 1)
+  n_homolog, n_trans, n_cis = [len(np.unique(np.concatenate(x))) if x else 0 for x in (homolog_groups, trans_groups, cis_groups)]
   counts = (n_cont, n_cis, n_trans, n_homolog, n_ambig, n_pairs, n_isol)
   
   return counts, matrix, ambig_matrix, label_pos, chromo_offsets, trans_counts, ambig_groups
@@ -802,42 +632,15 @@ def _get_mito_fraction(contacts, bin_size, min_sep=1e2, sep_range=(10**6.5, 10**
 
 
 def _get_isolated(positions, threshold=int(2e6)):
+  """
+  Boolean array of which contacts have no others within the threshold distance in both positions
+  """
+  
+  from core import nuc_contacts
+  
+  positions = np.asarray(positions).reshape(-1, 4)
 
-  isolated = set()
-  bin_offsets = ((-1,-1), (-1,0), (-1,1), (0,-1), (0,1), (1,-1), (1,0), (1,1))
-
-  idx = defaultdict(list)
-
-  for i, (p_a, p_b, nobs, ag) in enumerate(positions):
-    idx[(p_a/threshold, p_b/threshold)].append(i)
-
-  for key in idx:
-    if len(idx[key]) == 1:
-      pA, pB, nobs, ag = positions[idx[key][0]]
-      b1, b2 = key
-
-      for j, k in bin_offsets:
-        key2 = (b1+j, b2+k)
-
-        if key2 in idx:
-          for i2 in idx[key2]:
-            pC, pD, nobs2, ag2 = positions[i2]
-
-            if abs(pC-pA) < threshold and abs(pD-pB) < threshold:
-              break
-
-            elif abs(pD-pA) < threshold and abs(pC-pB) < threshold:
-              break
-
-          else:
-            continue
-
-          break
-
-      else:
-        isolated.add((pA, pB))
-
-  return isolated
+  return nuc_contacts.get_isolated(positions[:,0], positions[:,1], threshold)
 
 
 def _is_detailed_data(data_track, step_size):
@@ -1567,6 +1370,24 @@ def contact_map(in_paths, out_path, bin_size=None, bin_size2=250.0, bin_size3=50
   else:
     util.info('Making PDF contact map for {}'.format(in_msg))
   
+  if bin_size:
+    bin_size = int(bin_size * 1e3)
+  else:
+    bin_size = DEFAULT_SC_MAIN_BIN_KB if is_single_cell else DEFAULT_MAIN_BIN_KB
+    bin_size *= 1e3
+  
+  if bin_size2:
+    bin_size2 = int(bin_size2 * 1e3)
+  else:
+    bin_size2 = DEFAULT_SC_CHR_BIN_KB if is_single_cell else DEFAULT_CIS_BIN_KB
+    bin_size2 *= 1e3
+
+  if bin_size3:
+    bin_size3 = int(bin_size3 * 1e3)
+  else:
+    bin_size3 = DEFAULT_SC_CHR_BIN_KB if is_single_cell else DEFAULT_TRANS_BIN_KB
+    bin_size3 *= 1e3
+  
   if io.is_ncc(in_path):
     file_bin_size = None
     util.info('Loading NCC format contact data')
@@ -1574,7 +1395,8 @@ def contact_map(in_paths, out_path, bin_size=None, bin_size2=250.0, bin_size3=50
     
   else:
     util.info('Loading NPZ format contact data')
-    file_bin_size, chromo_limits, contacts = npz.load_npz_contacts(in_path)
+    # Multi-resolution files give the coarsest level that suits all display bin sizes
+    file_bin_size, chromo_limits, contacts = npz.load_npz_contacts(in_path, bin_size=[bin_size, bin_size2, bin_size3], lazy=True)
       
     #normalize_contacts(contacts, chromo_limits, file_bin_size, store_sparse=False)
 
@@ -1585,7 +1407,7 @@ def contact_map(in_paths, out_path, bin_size=None, bin_size2=250.0, bin_size3=50
       chromosomes2, chromo_limits2, contacts2 = ncc.load_file(in_path2)
  
     else:
-      file_bin_size2, chromo_limits2, contacts2 = npz.load_npz_contacts(in_path2)
+      file_bin_size2, chromo_limits2, contacts2 = npz.load_npz_contacts(in_path2, bin_size=file_bin_size or [bin_size, bin_size2, bin_size3], lazy=True)
       
       if file_bin_size and (file_bin_size2 != file_bin_size):
         util.critical('Input contact datsets are binned at different resolutions')
@@ -1647,41 +1469,20 @@ def contact_map(in_paths, out_path, bin_size=None, bin_size2=250.0, bin_size3=50
     elif unknown:
       util.warn('Some selected chromosomes don\'t match the contact file: {}'.format(', '.join(unknown)))
     
-  if bin_size:
-    bin_size = int(bin_size * 1e3)
-    
-    if file_bin_size and (bin_size < file_bin_size):
-      bin_size = file_bin_size
-      msg = 'Smallest main display bin size limited to innate resolution of input data'
-      util.warn(msg)
-      
-  else:
-    bin_size = DEFAULT_SC_MAIN_BIN_KB if is_single_cell else DEFAULT_MAIN_BIN_KB
-    bin_size *= 1e3
-  
-  if bin_size2:
-    bin_size2 = int(bin_size2 * 1e3)
-    
-    if file_bin_size and (bin_size2 < file_bin_size):
-      bin_size2 = file_bin_size
-      msg = 'Smallest cis display bin size limited to innate resolution of input data'
-      util.warn(msg)
+  if file_bin_size and (bin_size < file_bin_size):
+    bin_size = file_bin_size
+    msg = 'Smallest main display bin size limited to innate resolution of input data'
+    util.warn(msg)
   
-  else:
-    bin_size2 = DEFAULT_SC_CHR_BIN_KB if is_single_cell else DEFAULT_CIS_BIN_KB
-    bin_size2 *= 1e3
+  if file_bin_size and (bin_size2 < file_bin_size):
+    bin_size2 = file_bin_size
+    msg = 'Smallest cis display bin size limited to innate resolution of input data'
+    util.warn(msg)
 
-  if bin_size3:
-    bin_size3 = int(bin_size3 * 1e3)
-    
-    if file_bin_size and (bin_size3 < file_bin_size):
-      bin_size3 = file_bin_size
-      msg = 'Smallest main display bin size limited to innate resolution of input data'
-      util.warn(msg)
-  
-  else:
-    bin_size3 = DEFAULT_SC_CHR_BIN_KB if is_single_cell else DEFAULT_TRANS_BIN_KB
-    bin_size3 *= 1e3
+  if file_bin_size and (bin_size3 < file_bin_size):
+    bin_size3 = file_bin_size
+    msg = 'Smallest main display bin size limited to innate resolution of input data'
+    util.warn(msg)
 
   """
   tot_size = 0
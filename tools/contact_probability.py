@@ -14,147 +14,135 @@ PLOT_CMAP = LinearSegmentedColormap.from_list(name='PLOT_CMAP', colors=['#00C0C0
 HIST_CMAP = LinearSegmentedColormap.from_list(name='HIST_CMAP', colors=['#FFFFFF','#0080FF','#FF0000', '#FFFF00'], N=255)   
 PDF_DPI = 200
 
-def load_seq_seps(contact_paths, labels, region_dict, bin_size):
+def _get_file_seq_seps(in_path, region_dict, bin_size, max_sep=None):
+  """
+  Sequence separations, with their weights and counts, of the cis contacts in one NCC or NPZ
+  file, overall and, if region_dict is given, split by whether contacts are within, overlap or
+  are outside the regions. Separations above max_sep, if given, are excluded.
+  """
 
   from nuc_tools import util, io
-  from formats import ncc, npz, bed
-  
-  seq_sep_data = []
-  
-  for i, in_path in enumerate(contact_paths):
-    util.info('Processing %s (%s)' % (in_path, labels[i]))
-    seq_seps = []
-    weights = []
-    counts = []
-    seq_seps_r = None
-    weights_r = None
-    
-    if region_dict:
-      seq_seps_r = [[], [], []]
-      weights_r = [[], [], []]
-    
-    if io.is_ncc(in_path):
-      file_bin_size = None
-      util.info('  .. loading')
-      chromosomes, chromo_limits, contacts = ncc.load_file(in_path, trans=False, dtype=np.int32)
-      chromosomes = util.sort_chromosomes(chromosomes)
-      
+  from core import nuc_contacts
+  from formats import ncc, npz
+
+  seq_seps = []
+  weights = []
+  counts = []
+  seq_seps_r = None
+  weights_r = None
+
+  if region_dict:
+    seq_seps_r = [[], [], []]
+    weights_r = [[], [], []]
+
+  if io.is_ncc(in_path):
+    file_bin_size = None
+    chromosomes, chromo_limits, contacts = ncc.load_file(in_path, trans=False, dtype=np.int32)
+
+  else:
+    file_bin_size, chromo_limits, contacts = npz.load_npz_contacts(in_path, trans=False, store_sparse=True, lazy=True)
+
+    if file_bin_size > bin_size:
+      util.critical('Binned resolution of file (%d kb) is greater than analysis bin size (%d kb)' % (file_bin_size/1e3, bin_size/1e3))
+
+    chromosomes = chromo_limits.keys()
+
+  chromosomes = util.sort_chromosomes(chromosomes)
+
+  for chr_a in chromosomes:
+    chromo_pair = chr_a, chr_a
+
+    if chromo_pair not in contacts:
+      continue
+
+    if file_bin_size:
+      matrix = contacts[chromo_pair]
+      n = matrix.shape[0]
+      max_diag = None if max_sep is None else int(max_sep // file_bin_size)
+      rows, cols, chromo_counts = nuc_contacts.get_diagonal_band(matrix, max_diag)
+
+      seps = (cols - rows) * file_bin_size
+      prob = chromo_counts * nuc_contacts.get_sep_weights(rows, cols, n) # - weights come from fraction of chromo and sum of counts
+      seq_pos_a = chromo_limits[chr_a][0] + rows * file_bin_size
+      seq_pos_b = chromo_limits[chr_a][0] + cols * file_bin_size
+
     else:
-      util.info('  .. loading')
-      file_bin_size, chromo_limits, contacts = npz.load_npz_contacts(in_path, trans=False)
-      
-      if file_bin_size > bin_size:
-        util.critical('Binned resolution of file (%d kb) is greater than analysis bin size (%d kb)' % (file_bin_size/1e3, bin_size/1e3))
-      
-      chromosomes = chromo_limits.keys()
-    
-    chromosomes = util.sort_chromosomes(chromosomes)
-    
-    for chr_a in chromosomes:
-      chromo_pair = chr_a, chr_a
-      
-      if chromo_pair not in contacts:
-        continue
-      
-      util.info('  .. %s' % chr_a, line_return=True)
-      
-      if file_bin_size:
-        matrix = contacts[chromo_pair]
-        n = len(matrix)
-        prob = []
-        seps = []
-        seq_pos_a = []
-        seq_pos_b = []
-        chromo_counts = []
-        
-        for d in range(0, n):
-          m = n-d
-          rows = np.array(range(m))
-          cols = rows + d
-          idx = (rows, cols)
- 
-          frac = n/float(m)
-          ss = np.full(m, d * file_bin_size)
-          ct = matrix[idx]
-          nz = ct.nonzero()
-          
-          if len(nz[0]):
-            ss = ss[nz]
-            ct = ct[nz]
-            chromo_counts.append(ct)
-            
-            pa = chromo_limits[chr_a][0] + rows * file_bin_size
-            pb = chromo_limits[chr_a][0] + cols * file_bin_size
-            
-            prob.append(ct*frac) # - weights come from fraction of chromo and sum of counts
-            seps.append(ss)
-            seq_pos_a.append(pa[nz])
-            seq_pos_b.append(pb[nz])
-        
-        chromo_counts = np.concatenate(chromo_counts)
-        seps = np.concatenate(seps)
-        prob = np.concatenate(prob)
-        seq_pos_a = np.concatenate(seq_pos_a)
-        seq_pos_b = np.concatenate(seq_pos_b)
-       
-      else:
-        contact_array = contacts[chromo_pair]
-        seq_pos_a = contact_array[:,0]
-        seq_pos_b = contact_array[:,1]
-        chromo_counts = contact_array[:,2]
-        
-        seps = abs(seq_pos_a-seq_pos_b)
-        indices = seps.nonzero()
-        seps = seps[indices]
-
-        p_start, p_end = chromo_limits[chr_a]
-        size = float(p_end-p_start+1)
-
-        prob = (size/(size-seps)) # From fraction of chromosome that could give rise to each separation
-        seps = seps
-       
-      if len(prob):
-        counts.append(chromo_counts)
-        seq_seps.append(seps)
-        weights.append(prob)
-        
-        if region_dict:
-          regions = region_dict[chr_a]
- 
-          if not len(regions):
-            continue
-         
-          rstarts = regions[:,0]
-          rends = regions[:,1]
-          rstarts = np.append(rstarts, [rends[-1]])
-          
-          e1 = np.searchsorted(rends, seq_pos_a) # Region indices for each contact
-          e2 = np.searchsorted(rends, seq_pos_b)
-          
-          # Are seq pos at or above the region starts corresponding to the region ends that they are immediately less than
-          in_regions_a = seq_pos_a >= rstarts[e1]
-          in_regions_b = seq_pos_b >= rstarts[e2]
-         
-          intra = in_regions_a & in_regions_b # Elements where both pos are in any region
-          inter = np.logical_xor(in_regions_a, in_regions_b) # Only one pos is in a region
-          extra = ~(intra | inter) # Neither pos in a region
-          
-          
-          for r, idx in enumerate((intra, inter, extra)):
-            w = prob[idx]
-            
-            if len(w):
-              seq_seps_r[r].append(seps[idx])
-              weights_r[r].append(w)
-    
-    counts = np.concatenate(counts)
-    seq_seps = np.concatenate(seq_seps)
-    weights = np.concatenate(weights)
-    
-    seq_sep_data.append((seq_seps, weights, seq_seps_r, weights_r, counts))
-    
-    util.info('  .. found {:,} values'.format(len(seq_seps)))
-    
+      contact_array = contacts[chromo_pair]
+      seq_pos_a = contact_array[:,0]
+      seq_pos_b = contact_array[:,1]
+      chromo_counts = contact_array[:,2]
+
+      seps = abs(seq_pos_a-seq_pos_b)
+      idx = seps > 0
+
+      if max_sep is not None:
+        idx &= seps <= max_sep
+
+      seps = seps[idx]
+      seq_pos_a = seq_pos_a[idx]
+      seq_pos_b = seq_pos_b[idx]
+      chromo_counts = chromo_counts[idx]
+
+      p_start, p_end = chromo_limits[chr_a]
+      size = float(p_end-p_start+1)
+
+      prob = (size/(size-seps)) # From fraction of chromosome that could give rise to each separation
+
+    if len(prob):
+      counts.append(chromo_counts)
+      seq_seps.append(seps)
+      weights.append(prob)
+
+      if region_dict:
+        regions = region_dict.get(chr_a, ())
+
+        if not len(regions):
+          continue
+
+        rstarts = regions[:,0]
+        rends = regions[:,1]
+        rstarts = np.append(rstarts, [rends[-1]])
+
+        e1 = np.searchsorted(rends, seq_pos_a) # Region indices for each contact
+        e2 = np.searchsorted(rends, seq_pos_b)
+
+        # Are seq pos at or above the region starts corresponding to the region ends that they are immediately less than
+        in_regions_a = seq_pos_a >= rstarts[e1]
+        in_regions_b = seq_pos_b >= rstarts[e2]
+
+        intra = in_regions_a & in_regions_b # Elements where both pos are in any region
+        inter = np.logical_xor(in_regions_a, in_regions_b) # Only one pos is in a region
+        extra = ~(intra | inter) # Neither pos in a region
+
+        for r, idx in enumerate((intra, inter, extra)):
+          w = prob[idx]
+
+          if len(w):
+            seq_seps_r[r].append(seps[idx])
+            weights_r[r].append(w)
+
+  counts = np.concatenate(counts)
+  seq_seps = np.concatenate(seq_seps)
+  weights = np.concatenate(weights)
+
+  return seq_seps, weights, seq_seps_r, weights_r, counts
+
+
+def load_seq_seps(contact_paths, labels, region_dict, bin_size, max_sep=None, num_cpu=None):
+
+  from nuc_tools import util, parallel
+
+  num_cpu = num_cpu or parallel.MAX_CORES
+  common_args = (region_dict, bin_size, max_sep)
+  seq_sep_data = []
+
+  util.info('Processing %d contact files' % len(contact_paths))
+
+  for i, data in enumerate(parallel.imap(_get_file_seq_seps, contact_paths, common_args,
+                                         num_cpu=num_cpu, chunk_size=1)):
+    util.info('  .. found {:,} values in {} ({})'.format(len(data[0]), contact_paths[i], labels[i]))
+    seq_sep_data.append(data)
+
   return seq_sep_data
   
   
@@ -375,7 +363,7 @@ def plot_count_distribs(seq_sep_data, labels, bin_size, pdf):
 
 
 def contact_probability(contact_paths, out_pdf_path=None, region_path=None, bin_size=DEFAULT_BIN_SIZE,
-                        labels=None, region_label=None, screen_gfx=False):
+                        labels=None, region_label=None, screen_gfx=False, max_sep=None, num_cpu=None):
 
   from nuc_tools import util, io
   from formats import ncc, npz, bed
@@ -414,10 +402,10 @@ def contact_probability(contact_paths, out_pdf_path=None, region_path=None, bin_
   else:
     pdf = PdfPages(out_pdf_path) 
     
-  seq_sep_data = load_seq_seps(contact_paths, labels, region_dict, bin_size*1e3)
+  seq_sep_data = load_seq_seps(contact_paths, labels, region_dict, bin_size*1e3, max_sep, num_cpu)
     
   plot_seq_sep_distrib(seq_sep_data, labels, region_label,
-                       bin_size, pdf=pdf)     
+                       bin_size, max_sep=max_sep or 1e8, pdf=pdf)     
   
   plot_count_distribs(seq_sep_data, labels, bin_size, pdf)  
   
@@ -463,6 +451,12 @@ def main(argv=None):
                          help='The sequence region size in kilobases for calculation of contact probabilities. ' \
                               'Cannot be smaller than for any pre-binned contact files.' \
                               'Default is %d (kb)' % DEFAULT_BIN_SIZE)
+
+  arg_parse.add_argument('-m', '--max-sep', metavar='MB_MAX_SEP', type=float, dest='m',
+                         help='Optional maximum sequence separation in megabases; contacts further apart are ignored.')
+
+  arg_parse.add_argument('-n', '--num-cpu', default=0, metavar='CPU_COUNT', dest='n', type=int,
+                         help='Number of CPU cores to use in parallel, for different contact files. Defaults to all available.')
  
   args = vars(arg_parse.parse_args(argv))
 
@@ -473,6 +467,8 @@ def main(argv=None):
   bin_size = args['s']
   labels = args['l'] or None
   region_label = args['rl']
+  max_sep = args['m'] * 1e6 if args['m'] else None
+  num_cpu = args['n'] or None
   
   if region_path:
     io.check_invalid_file(region_path)
@@ -484,7 +480,8 @@ def main(argv=None):
     util.warn('Output PDF file will not be written in screen graphics (-g) mode')
     pdf_path = None
   
-  contact_probability(contact_paths, pdf_path, region_path, bin_size, labels, region_label, screen_gfx)
+  contact_probability(contact_paths, pdf_path, region_path, bin_size, labels, region_label, screen_gfx,
+                      max_sep, num_cpu)
   
   
   
@@ -69,14 +69,10 @@ def _load_bin_data(data_paths, bin_size):
       
   for data_bed_path in data_dict:
     data_regions, data_values = data_dict[data_bed_path]
-    hists = []
-    
-    for chromo in chromos:
-      start, end = chromo_limits[chromo]
-      hist = util.bin_region_values(data_regions.get(chromo, []),
-                                    data_values.get(chromo, []),
-                                    bin_size, start, end)
-      hists.append(hist)
+    starts, ends = zip(*[chromo_limits[chromo] for chromo in chromos])
+    hists = util.bin_region_values_multi([data_regions.get(chromo, []) for chromo in chromos],
+                                         [data_values.get(chromo, []) for chromo in chromos],
+                                         bin_size, starts, ends)
                                                   
     binned_data_dict[data_bed_path] = np.concatenate(hists, axis=0)
     util.info(' .. bin {}'.format(data_bed_path), line_return=True)
@@ -36,6 +36,13 @@ def data_track_filter(bed_data_path, out_bed_path, include_paths, exclude_paths,
     val = exclude_seps[0]
     exclude_seps = [val] * len(exclude_regions)
   
+  # Interval indices for padded filter regions, made once for each track and chromosome
+  
+  include_indices = [{chromo:util.get_interval_index(regs[chromo] + np.array([-width, width])) for chromo in regs if len(regs[chromo])}
+                     for regs, width in zip(include_regions, include_seps)]
+  exclude_indices = [{chromo:util.get_interval_index(regs[chromo] + np.array([-width, width])) for chromo in regs if len(regs[chromo])}
+                     for regs, width in zip(exclude_regions, exclude_seps)]
+  
   filt_region_dict = {}
   filt_value_dict = {}
   filt_label_dict = {}
@@ -74,18 +81,11 @@ def data_track_filter(bed_data_path, out_bed_path, include_paths, exclude_paths,
       # Keep only data points which intersect these regions   
       keep = np.zeros(len(centers))
       
-      for i, intersect_regions in enumerate(include_regions):
-        if not len(intersect_regions[chromo]):
+      for chromo_indices in include_indices:
+        if chromo not in chromo_indices:
           continue
-          
-        width = include_seps[i]
-        filter_regions = intersect_regions[chromo] + np.array([-width, width])
-        
-        s = intersect_regions[chromo][:,0]
-        e = intersect_regions[chromo][:,0]
-        idx = s.argsort()
         
-        f = util.points_region_intersect(centers, filter_regions)
+        f = util.points_region_intersect(centers, chromo_indices[chromo])
         
         keep += f.astype(int)
         
@@ -106,13 +106,11 @@ def data_track_filter(bed_data_path, out_bed_path, include_paths, exclude_paths,
       # Remove datapoints which intersect these regions
       excl = np.zeros(len(centers))
       
-      for i, intersect_regions in enumerate(exclude_regions):
-        if not len(intersect_regions[chromo]):
+      for chromo_indices in exclude_indices:
+        if chromo not in chromo_indices:
           continue
 
-        width = exclude_seps[i]
-        filter_regions = intersect_regions[chromo] + np.array([-width, width])
-        excl += util.points_region_intersect(centers, filter_regions).astype(int)
+        excl += util.points_region_intersect(centers, chromo_indices[chromo]).astype(int)
       
       if exclude_any: # Excluded by any 
         excl = excl > 0
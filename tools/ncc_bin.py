@@ -15,14 +15,59 @@ CHR_KEY_SEP = ' '
 DEFAULT_FORMAT = 'NPZ'
 DEFAULT_BIN_SIZE = 50.0
 DEFAULT_MIN_BINS = 2
-M_SIZE = 500 # Size of submatrices in loading dict
-PRINT_FREQ = 200000
+COMPACT_SIZE = 2**20 # Minimum number of buffered bin counts for a chromosome pair before merging 
+SCAN_LINES = 100000 # Initial lines inspected for the number of contigs
+MAX_SCAN_CONTIGS = 200 # Small contigs are filtered if there are at least this many in the inspected lines
 MIN_TRANS_COUNT = 5
 
+def _merge_counts(bin_keys, bin_counts):
+  """Sum the counts of repeated packed bin keys, giving unique, sorted keys"""
+  
+  bin_keys, idx = np.unique(bin_keys, return_inverse=True)
+  bin_counts = np.bincount(idx.ravel(), weights=bin_counts, minlength=len(bin_keys))
+  
+  return bin_keys, bin_counts.astype(np.int64)
+
+
+def _compact_counts(bin_keys, bin_counts):
+  """Merge lists of (possibly repeated) packed bin keys and their counts into unique, sorted keys"""
+  
+  if len(bin_keys) == 1:
+    return bin_keys[0], bin_counts[0]
+  
+  return _merge_counts(np.concatenate(bin_keys), np.concatenate(bin_counts))
+
+
+def _get_count_dtype(max_count, min_dtype=np.uint8):
+  """Smallest unsigned integer type, no smaller than min_dtype, to hold all counts"""
+  
+  min_size = np.dtype(min_dtype).itemsize
+  
+  for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+    if (np.dtype(dtype).itemsize >= min_size) and (max_count <= np.iinfo(dtype).max):
+      return dtype
+
+
 def bin_ncc(ncc_in, out_file=None, bin_size=DEFAULT_BIN_SIZE, format=DEFAULT_FORMAT,
-            min_bins=DEFAULT_MIN_BINS, min_trans=MIN_TRANS_COUNT, dtype=np.uint8):
+            min_bins=DEFAULT_MIN_BINS, min_trans=MIN_TRANS_COUNT, dtype=np.uint8, level_bin_sizes=None):
 
   from nuc_tools import util, io
+  from formats import ncc, npz
+  
+  # Coarser resolution levels are aggregated from the finest bins, so must be exact multiples
+  
+  levels = [] # (bin size in bp, ratio to finest)
+  
+  for level_bin_size in sorted(set(level_bin_sizes or [])):
+    ratio = level_bin_size/float(bin_size)
+    
+    if ratio <= 1.0:
+      continue
+    
+    if ratio != int(ratio):
+      util.critical('Bin size %.1f kb is not a multiple of the smallest bin size %.1f kb' % (level_bin_size, bin_size))
+    
+    levels.append((int(level_bin_size * 1e3), int(ratio)))
   
   if not out_file:
     file_root, file_ext = os.path.splitext(ncc_in)
@@ -35,221 +80,154 @@ def bin_ncc(ncc_in, out_file=None, bin_size=DEFAULT_BIN_SIZE, format=DEFAULT_FOR
   util.info('Reading %s' % ncc_in)
   
   bin_bp = int(bin_size * 1e3)
-  contact_blocks = defaultdict(dict)
+  bin_keys = defaultdict(list)     # Chromosome pair : packed (bin_a, bin_b) arrays
+  bin_counts = defaultdict(list)   # Chromosome pair : contact counts for above
+  n_pending = defaultdict(int)     # Chromosome pair : uncompacted buffer size 
+  n_compact = defaultdict(int)     # Chromosome pair : size after last compaction 
+  pair_bins = {}                   # Chromosome pair : (min_a, max_a, min_b, max_b) bins
   counts = defaultdict(int)
-  
-  key_bin_size = M_SIZE * bin_bp
-  n_contacts = 0
-  exclude_contigs = set()
-  min_bin = {}
-  max_bin = defaultdict(int)
-  get_min_bin = min_bin.get
-  inf = float('inf')
-  
+  scan_chromos = set()
+  n_lines = 0
+
   t0 = time.time()
   
-  if format == 'NPZ':
-    # Pre-read check to filter very small contigs
-    
-    with io.open_file(ncc_in) as in_file_obj:
-      for i, line in enumerate(in_file_obj):
-        if (i == 1e5) and (len(max_bin) < 200):
-          break
-          
-        chr_a, start_a, end_a, f_start_a, f_end_a, strand_a, \
-          chr_b, start_b, end_b, f_start_b, f_end_b, strand_b, \
-          ambig_group, pair_id, swap_pair = line.split()      
-
-        pos_a = int(f_start_a) if strand_a == '+' else int(f_end_a)
-        pos_b = int(f_start_b) if strand_b == '+' else int(f_end_b)
-          
-        bin_a = int(pos_a/bin_bp)
-        bin_b = int(pos_b/bin_bp)
-
-        if bin_a < get_min_bin(chr_a, inf):
-          min_bin[chr_a] = bin_a
-
-        if bin_b < get_min_bin(chr_b, inf):
-          min_bin[chr_b] = bin_b              
-
-        if bin_a > max_bin[chr_a]:
-          max_bin[chr_a] = bin_a
-
-        if bin_b > max_bin[chr_b]:
-          max_bin[chr_b] = bin_b
-
-        if i % PRINT_FREQ == 0:
-          util.info("  Inspected {:,} lines, found {:,} chromosomes/contigs in {:.2f} s ".format(i, len(min_bin), time.time()-t0), line_return=True)
-    
-      else:
-        util.info("  Inspected {:,} lines, found {:,} chromosomes/contigs in {:.2f} s ".format(i, len(min_bin), time.time()-t0), line_return=True)
-        
-        for chromo in min_bin:
-          if (max_bin[chromo] - min_bin[chromo]) < min_bins:
-            exclude_contigs.add(chromo)
-          
-        util.info('Excluding {:,} small contigs from {:,}'.format(len(exclude_contigs), len(min_bin)))
-        min_bin = {}
-        max_bin = defaultdict(int)
-        get_min_bin = min_bin.get
-        t0 = time.time() 
-          
-    with io.open_file(ncc_in) as in_file_obj:
- 
-      for line in in_file_obj:
-        chr_a, start_a, end_a, f_start_a, f_end_a, strand_a, \
-          chr_b, start_b, end_b, f_start_b, f_end_b, strand_b, \
-          ambig_group, pair_id, swap_pair = line.split()      
-        
-        if chr_a in exclude_contigs:
-          continue
-        
-        if chr_b in exclude_contigs:
-          continue
-        
-        n_contacts += 1
-
-        pos_a = int(f_start_a) if strand_a == '+' else int(f_end_a)
-        pos_b = int(f_start_b) if strand_b == '+' else int(f_end_b)
-          
-        bin_a = int(pos_a/bin_bp)
-        bin_b = int(pos_b/bin_bp)
-        
-        if bin_a < get_min_bin(chr_a, inf):
-          min_bin[chr_a] = bin_a
-
-        if bin_b < get_min_bin(chr_b, inf):
-          min_bin[chr_b] = bin_b              
-
-        if bin_a > max_bin[chr_a]:
-          max_bin[chr_a] = bin_a
-
-        if bin_b > max_bin[chr_b]:
-          max_bin[chr_b] = bin_b
-        
-        key_bin_a = int(pos_a/key_bin_size)
-        key_bin_b = int(pos_b/key_bin_size)
-         
-        bin_a = bin_a % M_SIZE
-        bin_b = bin_b % M_SIZE
-        
-        if chr_a > chr_b:
-          chr_a, chr_b, bin_a, bin_b, key_bin_a, key_bin_b = chr_b, chr_a, bin_b, bin_a, key_bin_b, key_bin_a
-        
-        elif chr_a == chr_b and bin_b < bin_a:
-          bin_a, bin_b, key_bin_a, key_bin_b = bin_b, bin_a, key_bin_b, key_bin_a
-        
-        chromo_key = (chr_a, chr_b)
-        bin_key = (key_bin_a, key_bin_b)
-        
-        if bin_key in contact_blocks[chromo_key]:
-          mat = contact_blocks[chromo_key][bin_key]
-        else:
-          if chr_a == chr_b:
-            mat = np.zeros((M_SIZE, M_SIZE), dtype=dtype)
-          else:
-            mat = sparse.dok_matrix((M_SIZE, M_SIZE), dtype=dtype)
-          
-          contact_blocks[chromo_key][bin_key] = mat
-         
-          
-        if n_contacts % PRINT_FREQ == 0:
-          util.info("  Processed {:,} contacts for {:,} chromosomes/contigs in {:.2f} s ".format(n_contacts, len(min_bin), time.time()-t0), line_return=True)
-        
-        c = mat[bin_a, bin_b]
-        
-        if c > 254:
-          current_dtype = mat.dtype
-          
-          if current_dtype == 'uint8':
-            if hasattr(mat, 'toarray'):
-              mat = mat.toarray()
-          
-            mat = contact_blocks[chromo_key][bin_key] = mat.astype(np.uint16)
-          
-          elif c > 65534 and current_dtype == 'uint16':
-            mat = contact_blocks[chromo_key][bin_key] = mat.astype(np.uint32)
-        
-        mat[bin_a, bin_b] = c + 1
-        counts[chromo_key] += 1
+  # Single pass with contacts in large blocks; each block's bins are accumulated as COO style
+  # (packed bin key, count) buffers per chromosome pair, which are periodically compacted
+  
+  for chromos, chr_a, chr_b, pos_a, pos_b, ambig, pair_ids, inactive in ncc.read_ncc_blocks(ncc_in, pos_cols=(3, 4)):
+    if n_lines < SCAN_LINES: # Contigs seen at start, to decide on small contig filtering
+      m = SCAN_LINES-n_lines
+      scan_chromos.update([chromos[i] for i in np.unique(np.concatenate([chr_a[:m], chr_b[:m]]))])
+      
+    n_lines += len(chr_a)
+    bin_a = (pos_a / bin_bp).astype(np.int64) # Truncate, as int()
+    bin_b = (pos_b / bin_bp).astype(np.int64)
     
-    util.info("  Processed {:,} contacts for {:,} chromosomes/contigs in {:.2f} s ".format(n_contacts, len(min_bin), time.time()-t0), line_return=True)
+    swap = (chr_a > chr_b) | ((chr_a == chr_b) & (bin_b < bin_a)) # Upper triangle for cis
+    chr_a, chr_b = np.where(swap, chr_b, chr_a), np.where(swap, chr_a, chr_b)
+    bin_a, bin_b = np.where(swap, bin_b, bin_a), np.where(swap, bin_a, bin_b)
     
-    util.info('Saving data')
-    contacts = {}
-    n_exc_trans = 0
+    pair_codes = chr_a * len(chromos) + chr_b
+    order = np.argsort(pair_codes, kind='stable')
+    pair_codes, starts = np.unique(pair_codes[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
     
-    for chromo_key in sorted(counts):
-      chr_a, chr_b = chromo_key
-      min_a, max_a = min_bin[chr_a], max_bin[chr_a]
-      min_b, max_b = min_bin[chr_b], max_bin[chr_b]
-      min_a = min_b = 0
-      a = 1 + max_a - min_a
-      b = 1 + max_b - min_b
-     
-      if a < min_bins:
-        del contact_blocks[chromo_key]
-        continue
-
-      if b < min_bins:
-        del contact_blocks[chromo_key]
-        continue      
+    for s, e in zip(starts, ends):
+      idx = order[s:e]
+      chromo_key = (chromos[chr_a[idx[0]]], chromos[chr_b[idx[0]]])
+      b_a = bin_a[idx]
+      b_b = bin_b[idx]
       
-      pair_dtype = dtype
+      limits = (b_a.min(), b_a.max(), b_b.min(), b_b.max())
       
-      for mat in contact_blocks[chromo_key].values():
-        if mat.dtype == 'uint16':
-          pair_dtype = 'uint16'
-          break
-        
-        elif mat.dtype == 'uint8':
-          pair_dtype = 'uint8'
+      if chromo_key in pair_bins:
+        prev = pair_bins[chromo_key]
+        limits = (min(prev[0], limits[0]), max(prev[1], limits[1]),
+                  min(prev[2], limits[2]), max(prev[3], limits[3]))
       
-      mat = np.zeros((a, b), dtype=pair_dtype)
+      pair_bins[chromo_key] = limits
       
-      for key_bin_a, key_bin_b in contact_blocks[chromo_key]:
-        sub_mat = contact_blocks[chromo_key][(key_bin_a, key_bin_b)]
-        
-        if hasattr(sub_mat, 'toarray'):
-          sub_mat = sub_mat.toarray()
-        
-        p1 = (key_bin_a * M_SIZE) - min_a
-        p2 = min(a, p1 + M_SIZE)
-        p1 = max(0, p1)
-        
-        q1 = (key_bin_b * M_SIZE) - min_b
-        q2 = min(b, q1 + M_SIZE)
-        q1 = max(0, q1)
-        
-        r1 = 0 if key_bin_a else min_a # Is offset in first bin
-        r2 = 0 if key_bin_b else min_b
-        
-        #print chromo_key, key_bin_a, key_bin_b,  p1, p2, q1, q2, r1, r1+(p2-p1), r2, r2+(q2-q1)
-        mat[p1:p2, q1:q2] = sub_mat[r1:r1+(p2-p1), r2:r2+(q2-q1)]
-        
-      del contact_blocks[chromo_key]
+      keys, key_counts = np.unique((b_a << 32) | b_b, return_counts=True)
+      bin_keys[chromo_key].append(keys)
+      bin_counts[chromo_key].append(key_counts)
+      n_pending[chromo_key] += len(keys)
+      counts[chromo_key] += len(idx)
       
-      if chr_a != chr_b and min_trans and  mat.sum() < min_trans:
-        del mat
-        n_exc_trans += 1
-        continue
+      if n_pending[chromo_key] > max(COMPACT_SIZE, 2 * n_compact[chromo_key]):
+        keys, key_counts = _compact_counts(bin_keys[chromo_key], bin_counts[chromo_key])
+        bin_keys[chromo_key] = [keys]
+        bin_counts[chromo_key] = [key_counts]
+        n_pending[chromo_key] = n_compact[chromo_key] = len(keys)
       
-      key = chr_a + CHR_KEY_SEP + chr_b
+    util.info("  Processed {:,} contacts for {:,} chromosome pairs in {:.2f} s ".format(n_lines, len(pair_bins), time.time()-t0), line_return=True)
+  
+  # Filter very small contigs, given their full extent, if there are many contigs
+  
+  min_bin = {}
+  max_bin = defaultdict(int)
+  exclude_contigs = set()
+  
+  for (chr_a, chr_b), (min_a, max_a, min_b, max_b) in pair_bins.items():
+    for chromo, p_min, p_max in ((chr_a, min_a, max_a), (chr_b, min_b, max_b)):
+      min_bin[chromo] = min(min_bin.get(chromo, p_min), p_min)
+      max_bin[chromo] = max(max_bin[chromo], p_max)
+  
+  if (n_lines <= SCAN_LINES) or (len(scan_chromos) >= MAX_SCAN_CONTIGS):
+    for chromo in min_bin:
+      if (max_bin[chromo] - min_bin[chromo]) < min_bins:
+        exclude_contigs.add(chromo)
+  
+    util.info('Excluding {:,} small contigs from {:,}'.format(len(exclude_contigs), len(min_bin)))
+  
+  # Extents only from contacts that are kept
+  
+  max_bin = defaultdict(int)
+  n_contacts = 0
+  
+  for (chr_a, chr_b), (min_a, max_a, min_b, max_b) in pair_bins.items():
+    if (chr_a in exclude_contigs) or (chr_b in exclude_contigs):
+      continue
+    
+    max_bin[chr_a] = max(max_bin[chr_a], max_a)
+    max_bin[chr_b] = max(max_bin[chr_b], max_b)
+    n_contacts += counts[(chr_a, chr_b)]
+  
+  util.info('Saving data')
+  contacts = {}
+  n_exc_trans = 0
+  
+  for chromo_key in sorted(counts):
+    chr_a, chr_b = chromo_key
+    keys, key_counts = _compact_counts(bin_keys.pop(chromo_key), bin_counts.pop(chromo_key))
+    
+    if (chr_a in exclude_contigs) or (chr_b in exclude_contigs):
+      continue
+    
+    a = 1 + max_bin[chr_a]
+    b = 1 + max_bin[chr_b]
+    
+    if (a < min_bins) or (b < min_bins):
+      continue
+    
+    if chr_a != chr_b and min_trans and key_counts.sum() < min_trans:
+      n_exc_trans += 1
+      continue
+    
+    key = chr_a + CHR_KEY_SEP + chr_b
+    
+    rows = (keys >> 32).astype(np.int32)
+    cols = (keys & 0xFFFFFFFF).astype(np.int32)
+    
+    for level_bp, ratio in [(bin_bp, 1)] + levels:
+      if ratio > 1: # Sum finest bins into coarser ones; cis stays upper triangular
+        level_keys, level_counts = _merge_counts(((rows // ratio).astype(np.int64) << 32) | (cols // ratio), key_counts)
+        level_rows = (level_keys >> 32).astype(np.int32)
+        level_cols = (level_keys & 0xFFFFFFFF).astype(np.int32)
+      else:
+        level_rows, level_cols, level_counts = rows, cols, key_counts
+      
+      # Dtype chosen once, given the final counts
+      pair_dtype = _get_count_dtype(level_counts.max(), dtype)
+      n_a = int(math.ceil(a/float(ratio)))
+      n_b = int(math.ceil(b/float(ratio)))
+      mat = sparse.coo_matrix((level_counts.astype(pair_dtype), (level_rows, level_cols)), shape=(n_a, n_b))
       
       if chr_a == chr_b:
-        contacts[key] = sparse.csr_matrix(mat)
-      else:
-        contacts[key] = sparse.coo_matrix(mat)
+        mat = mat.tocsr()
       
-      del mat
+      contacts[npz.get_level_key(key, level_bp, bin_bp)] = mat
       
       # Store bin offsets and spans
-      contacts[chr_a] = np.array([min_a, a])
-      contacts[chr_b] = np.array([min_b, b])
-    
-    contacts['params'] = np.array([bin_size, min_bins])  
-     
-    np.savez_compressed(out_file, **contacts)    
+      contacts[npz.get_level_key(chr_a, level_bp, bin_bp)] = np.array([0, n_a])
+      contacts[npz.get_level_key(chr_b, level_bp, bin_bp)] = np.array([0, n_b])
+  
+  contacts['params'] = np.array([bin_size, min_bins])  
+  
+  if levels:
+    contacts[npz.LEVELS_KEY] = np.array([bin_size] + [x/1e3 for x, r in levels])
+    util.info('Including resolution levels: {} kb'.format(', '.join(['%g' % x for x in contacts[npz.LEVELS_KEY]])))
+   
+  np.savez_compressed(out_file, **contacts)    
   
   if n_exc_trans:
     util.info('Excluded {:,} inter-chromosome pairs due to low contact counts (< {:,})'.format(n_exc_trans, min_trans))    
@@ -274,9 +252,12 @@ def main(argv=None):
   arg_parse.add_argument(nargs=1, metavar='NCC_FILE', dest='i',
                          help='Input NCC format file containing Hi-C contact data. May be Gzipped.')
  
-  arg_parse.add_argument('-s', type=float, metavar='KB_BIN_SIZE',
-                         default=DEFAULT_BIN_SIZE, dest='s',
-                         help='Region bin size in kb, for grouping contacts')
+  arg_parse.add_argument('-s', type=float, metavar='KB_BIN_SIZE', nargs='+',
+                         default=[DEFAULT_BIN_SIZE], dest='s',
+                         help='Region bin size in kb, for grouping contacts. If more than one is ' \
+                              'specified a single, multi-resolution file is written; the smallest bin ' \
+                              'size is the base level and the others, which must be multiples of it, ' \
+                              'are aggregated from this. Default: %.1f' % DEFAULT_BIN_SIZE)
 
   arg_parse.add_argument('-o', metavar='OUT_FILE', default=None, dest='o',
                          help='Optional output file name. If not specified, the output file ' \
@@ -299,7 +280,7 @@ def main(argv=None):
 
   in_file  = args['i'][0]
   out_file = args['o']
-  bin_size = args['s']
+  bin_size = min(args['s'])
   fmt   = DEFAULT_FORMAT # args['f'].upper()  
   min_bins = args['m']
   min_trans = args['t']
@@ -316,7 +297,7 @@ def main(argv=None):
     msg = 'Output file format "%s" not known. Available: %s.' % (fmt, ', '.join(sorted(OUT_FORMATS)))
     util.critical(msg)  
     
-  bin_ncc(in_file, out_file, bin_size, fmt, min_bins, min_trans)
+  bin_ncc(in_file, out_file, bin_size, fmt, min_bins, min_trans, level_bin_sizes=args['s'])
  
 
 if __name__ == '__main__':
@@ -0,0 +1,69 @@
+import sys, os, time
+
+PROG_NAME = 'ncc_cache'
+VERSION = '1.0.0'
+DESCRIPTION = 'Build binary, memory-mappable .nccb caches for NCC format Hi-C contact files, for fast loading by other tools'
+
+def ncc_cache(ncc_paths, force=False):
+
+  from nuc_tools import util, io
+  from formats import ncc
+
+  n_built = 0
+
+  for ncc_path in ncc_paths:
+    cache_path = ncc.get_cache_path(ncc_path)
+
+    if not force and ncc.load_cache(ncc_path, cache_path):
+      util.info('Cache {} is current for {}'.format(cache_path, ncc_path))
+      continue
+
+    t0 = time.time()
+    util.info('Building cache for {}'.format(ncc_path))
+
+    if ncc.build_cache(ncc_path, cache_path):
+      n_built += 1
+      n_bytes = os.path.getsize(cache_path)
+      util.info('Written {} ({:,} bytes) in {:.2f} s'.format(cache_path, n_bytes, time.time()-t0))
+
+  util.info('Built {:,} of {:,} caches'.format(n_built, len(ncc_paths)))
+
+
+def main(argv=None):
+
+  from argparse import ArgumentParser
+  from nuc_tools import util, io
+
+  if argv is None:
+    argv = sys.argv[1:]
+
+  epilog = 'For further help email tjs23@cam.ac.uk or wb104@cam.ac.uk'
+  arg_parse = ArgumentParser(prog='nuc_tools ' + PROG_NAME, description=DESCRIPTION,
+                             epilog=epilog, prefix_chars='-', add_help=True)
+
+  arg_parse.add_argument(nargs='+', metavar='NCC_FILES', dest='i',
+                         help='Input NCC format files containing Hi-C contact data. May be Gzipped. ' \
+                              'Each cache is written alongside its NCC file with a .nccb file extension.')
+
+  arg_parse.add_argument('-f', '--force', default=False, action='store_true', dest='f',
+                         help='Rebuild caches even if they are current, i.e. the NCC file size ' \
+                              'and modification time are unchanged since the cache was made.')
+
+  args = vars(arg_parse.parse_args(argv))
+
+  ncc_paths = args['i']
+  force = args['f']
+
+  for ncc_path in ncc_paths:
+    io.check_invalid_file(ncc_path)
+
+    if not io.is_ncc(ncc_path):
+      util.critical('File "%s" does not appear to be NCC format' % ncc_path)
+
+  ncc_cache(ncc_paths, force)
+
+if __name__ == '__main__':
+
+  sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+  main()
@@ -192,9 +192,14 @@ def make_ab_compartment_tracks(pop_contacts_path, active_marks_track=None, binSi
     
     # Zero the void regions of the contact map
     # shifts seq regions about a little to exclude edge cases
-    void_regions = np.array(void_track_regions[chromo], np.int32)
+    void_index = nuc_util.get_interval_index(np.array(void_track_regions[chromo], np.int32))
+    
+    # Bins with either end in a void region, except those starting before the first void region
+    idx_v = nuc_util.interval_index_any(void_index, pos[:,0]) | nuc_util.interval_index_any(void_index, pos[:,1])
+    
+    if len(void_index.starts):
+      idx_v &= pos[:,0] >= void_index.starts[0]
     
-    idx_v = cyt_ab_kmeans.pairRegionsIntersection(pos, void_regions, exclude=False, allow_partial=True)
     idx_nv[idx_v] = 0
     
     # Select only non-void indices
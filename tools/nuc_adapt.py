@@ -15,20 +15,110 @@ PICARD    = '/home/tjs23/apps/picard.jar'
 FREEBAYES = 'freebayes'
 VCFUNIQ   = '/home/tjs23/apps/freebayes/vcflib/bin/vcfuniq'
  
-def freebayes_genotype_job(region, genome_fasta_path, bam_paths):
+GENOTYPE_TASKS_PER_CORE = 16 # Genotyping regions per CPU core, for load balancing
+MIN_REGION_SIZE = 100000     # Minimum size of a chromosome piece for genotyping
+
+def get_genotype_regions(bam_file_paths, num_tasks, min_size=MIN_REGION_SIZE):
+  """
+  Split the chromosomes/contigs of BAM files into lists of regions for parallel genotyping tasks,
+  in genome order, so that each task covers a similar number of mapped reads, according to the
+  BAM indices. Chromosomes with many reads are split into pieces, no smaller than min_size, and
+  runs of small or sparse chromosomes/contigs are grouped.
+  """
+  
+  from formats import sam
+  
+  chromo_sizes = []
+  chromo_reads = defaultdict(int)
+  
+  for i, bam_file_path in enumerate(bam_file_paths):
+    for chromo, size, n_mapped in sam.get_bam_chromo_counts(bam_file_path):
+      chromo_reads[chromo] += n_mapped
+      
+      if i == 0:
+        chromo_sizes.append((chromo, size))
   
-  out_vcf_path = 'temp_%s_freebayes.vcf' % region
+  task_reads = max(1.0, sum(chromo_reads.values()) / float(num_tasks))
+  
+  tasks = []
+  group = []
+  group_reads = 0
+  
+  for chromo, size in chromo_sizes:
+    n_reads = chromo_reads[chromo]
+    n_split = min(int(np.ceil(n_reads/task_reads)), size // min_size)
+    
+    if n_split < 2:
+      group.append((chromo, 0, size))
+      group_reads += n_reads
+      
+      if group_reads >= task_reads:
+        tasks.append(group)
+        group = []
+        group_reads = 0
+      
+      continue
+    
+    if group:
+      tasks.append(group)
+      group = []
+      group_reads = 0
+    
+    step = int(np.ceil(size/float(n_split)))
+    
+    for i in range(0, size, step):
+      tasks.append([(chromo, i, min(i+step, size))])
+  
+  if group:
+    tasks.append(group)
+  
+  return tasks
   
-  if not os.path.exists(out_vcf_path):
  
+def freebayes_genotype_job(regions, genome_fasta_path, bam_paths, region_dir):
+  """
+  Genotype a list of (chromo, start, end) regions using freebayes. The output VCF is named
+  for the regions and is only written once complete, so that existing outputs may be reused.
+  Returns the output VCF path, or None if freebayes failed.
+  """
+  
+  from nuc_tools import util
+  
+  chromo, start, end = regions[0]
+  region_name = '%s_%d-%d' % (chromo, start, end)
+  
+  if len(regions) > 1:
+    region_name += '_%d' % len(regions)
+  
+  out_vcf_path = os.path.join(region_dir, 'freebayes_%s.vcf' % region_name)
+  
+  if not os.path.exists(out_vcf_path):
+    temp_vcf_path = out_vcf_path + '.part'
     cmd_args = [FREEBAYES,
-                '-f', genome_fasta_path,
-                '-r', region,
-                '-v', out_vcf_path] #, '--ploidy', '2']
+                '-f', genome_fasta_path] #, '--ploidy', '2']
+    
+    if len(regions) == 1:
+      cmd_args += ['-r', '%s:%d-%d' % regions[0]]
+    
+    else:
+      bed_path = os.path.join(region_dir, 'freebayes_%s.bed' % region_name)
+      
+      with open(bed_path, 'w') as file_obj:
+        for region in regions:
+          file_obj.write('%s\t%d\t%d\n' % region)
+      
+      cmd_args += ['-t', bed_path]
  
+    cmd_args += ['-v', temp_vcf_path]
     cmd_args += bam_paths
  
-    util.call(cmd_args)
+    proc = util.call(cmd_args, wait=False)
+    proc.wait()
+    
+    if proc.returncode:
+      return None
+    
+    os.rename(temp_vcf_path, out_vcf_path)
 
   return out_vcf_path
   
@@ -36,60 +126,65 @@ def freebayes_genotype_job(region, genome_fasta_path, bam_paths):
 def call_genotype_freebayes(bam_file_paths, genome_fasta_path, out_vcf_path, min_qual, num_cpu):
   # FreeBayes pipeline
   
-  temp_file_path = util.get_temp_path(out_vcf_path)
-
-  # Make regions for parallelisation, splitting all chromos according to number of CPUs
+  from nuc_tools import util, parallel
+  import shutil, subprocess
   
-  chromo_sizes = util.get_bam_chromo_sizes(bam_file_paths[0])
+  # Make regions for parallelisation, with similar read coverage, many for each CPU
   
-  regions = []
-  region_fmt = '%s:%d-%d'
+  tasks = get_genotype_regions(bam_file_paths, num_cpu * GENOTYPE_TASKS_PER_CORE)
   
-  for chromo, size in chromo_sizes:
-    step = int(size/num_cpu) + 1 # will be rounded up
-    
-    i = 0
-    j = step
-    
-    while j < size:
-      regions.append(region_fmt % (chromo, i, j))
-      i = j
-      j += step
-    
-    regions.append(region_fmt % (chromo, i, size))
+  # Region outputs are kept until all are combined, so interrupted runs can be resumed
   
-  # Call haplotype for all strains at once, split into parallel regions
+  region_dir = os.path.splitext(out_vcf_path)[0] + '_regions'
   
+  if not os.path.exists(region_dir):
+    os.makedirs(region_dir)
   
-  common_args = [genome_fasta_path, bam_file_paths]
-  region_vcf_paths = util.parallel_split_job(freebayes_genotype_job, regions, common_args, num_cpu=num_cpu)
+  # Call haplotype for all strains at once, split into parallel regions, which are
+  # combined in order as they complete and streamed to remove duplicates
   
-  # Combine the regions which were run in parallel
+  util.info('Genotyping %d regions on %d cores' % (len(tasks), num_cpu))
   
-  util.info('Combining freebayes regions')
+  num_proc = min(num_cpu, len(tasks))
+  parallel.start_pool(num_proc) # Workers must not inherit the pipe to vcfuniq
   
-  with open(temp_file_path, 'w') as out_file_obj:
-    write = out_file_obj.write
- 
-    for i, region_vcf in enumerate(region_vcf_paths):
-      with open(region_vcf) as file_obj:
-        for line in file_obj:
-          if line[0] == '#':
-            if i == 0:
-              write(line)
- 
-          else:
+  common_args = [genome_fasta_path, bam_file_paths, region_dir]
+  proc = util.call([VCFUNIQ], stdin=subprocess.PIPE, stdout=out_vcf_path, wait=False)
+  write = proc.stdin.write
+  
+  try:
+    for i, region_vcf in enumerate(parallel.imap(freebayes_genotype_job, tasks, common_args,
+                                                 num_cpu=num_cpu, chunk_size=1)):
+      if not region_vcf:
+        util.critical('freebayes failed for regions starting %s:%d-%d' % tasks[i][0])
+      
+      with open(region_vcf, 'rb') as file_obj:
+        line = file_obj.readline()
+        
+        while line.startswith(b'#'): # Header from first region only
+          if i == 0:
             write(line)
+          
+          line = file_obj.readline()
+        
+        write(line)
+        shutil.copyfileobj(file_obj, proc.stdin)
+      
+      if (i+1) % num_proc == 0:
+        util.info(' .. combined %d of %d regions' % (i+1, len(tasks)), line_return=True)
+  
+  finally:
+    proc.stdin.close()
+    proc.wait()
   
-  cmd_args = [VCFUNIQ]
-  util.call(cmd_args, stdin=temp_file_path, stdout=out_vcf_path)
+  util.info(' .. combined %d regions' % len(tasks))
+  
+  if proc.returncode:
+    util.critical('vcfuniq failed with exit code %d' % proc.returncode)
   
   # Cleanup temp files
   
-  os.unlink(temp_file_path)
-
-  for file_path in region_vcf_paths:
-    os.unlink(file_path)
+  shutil.rmtree(region_dir)
  
   return out_vcf_path
 
@@ -149,16 +244,100 @@ def _make_test_files(fasta_path='adapt_test.fasta', vcf_path='adapt_test.vcf',
   # Check output with meld
   
 
+def _drop_front(rev_segs, n):
+  """
+  Remove n bytes from the start of a sequence held as a reversed list of segments
+  """
+  
+  while n > 0 and rev_segs:
+    seg = rev_segs[-1]
+    
+    if len(seg) <= n:
+      n -= len(seg)
+      rev_segs.pop()
+    
+    else:
+      rev_segs[-1] = seg[n:]
+      n = 0
+  
+  
+def apply_seq_variants(seq, variants):
+  """
+  Apply variants, a list of (position, ref_seq, alt_seq) with bytes sequences, to a sequence given
+  as a writable uint8 array, which is modified. The result is as if each slice seq[pos:pos+len(ref)]
+  were replaced by alt_seq, in reverse sorted order. Single base substitutions that do not overlap
+  other variants are set in one step, and the remainder are applied by joining sequence segments.
+  Returns the adapted sequence as bytes.
+  """
+  
+  if not variants:
+    return seq.tobytes()
+  
+  variants = sorted(variants, reverse=True)
+  n = len(seq)
+  
+  pos = np.array([v[0] for v in variants], np.int64)
+  ref_lens = np.array([len(v[1]) for v in variants], np.int64)
+  alt_lens = np.array([len(v[2]) for v in variants], np.int64)
+  
+  # Variant overlaps, in ascending order
+  
+  starts = pos[::-1]
+  ends = starts + np.maximum(ref_lens[::-1], 1)
+  prev_ends = np.maximum.accumulate(ends)
+  overlap = np.zeros(len(starts), bool)
+  overlap[1:] = starts[1:] < prev_ends[:-1]
+  overlap[:-1] |= overlap[1:]
+  overlap = overlap[::-1]
+  
+  is_snp = ~overlap & (ref_lens == 1) & (alt_lens == 1) & (pos >= 0) & (pos < n)
+  idx = np.flatnonzero(is_snp)
+  seq[pos[idx]] = np.frombuffer(b''.join([variants[i][2] for i in idx]), np.uint8)
+  
+  # Others, in reverse: sequence is seq[:p] followed by the adapted segments
+  
+  seq_view = memoryview(seq)
+  rev_segs = []
+  p = n
+  
+  for i in np.flatnonzero(~is_snp):
+    i, ref_seq, alt_seq = variants[i]
+    
+    if i <= p:
+      if i + len(ref_seq) < p:
+        rev_segs.append(seq_view[i+len(ref_seq):p])
+      else:
+        _drop_front(rev_segs, i + len(ref_seq) - p)
+      
+      rev_segs.append(alt_seq)
+      p = i
+    
+    else: # Within previous variants
+      tail = bytearray(b''.join(rev_segs[::-1]))
+      tail[i-p:i-p+len(ref_seq)] = alt_seq
+      rev_segs = [bytes(tail)]
+  
+  rev_segs.append(seq_view[:p])
+  
+  return b''.join(rev_segs[::-1])
+  
+  
 def vcf_adapt_fasta(fasta_in_path, vcf_path, fasta_out_path, min_qual=DEFAULT_QUAL):
+  """
+  Write a FASTA file of sequences adapted by VCF variants above a quality threshold. Sequences
+  are read, adapted and written one at a time.
+  """
+  
+  from nuc_tools import util, io
+  from formats import fasta
   
   msg = 'Reading VCF file %s' % vcf_path
   util.info(msg)
   
   vcf_dict = defaultdict(list)
   n_var = 0
-  n = None
   
-  with util.open_file(vcf_path) as file_obj:
+  with io.open_file(vcf_path) as file_obj:
     
     for line in file_obj:
       if line[0] == '#':
@@ -171,37 +350,16 @@ def vcf_adapt_fasta(fasta_in_path, vcf_path, fasta_out_path, min_qual=DEFAULT_QU
           continue
         
         pos = int(pos)
-        vcf_dict[contig].append((pos, list(ref), list(alt)))
+        vcf_dict[contig].append((pos, ref.encode('ascii'), alt.encode('ascii')))
         n_var += 1
 
-  msg = 'Sorting {:,} variations within {} segments'.format(n_var, len(vcf_dict))
-  util.info(msg)
-    
-  vcf_dict = dict(vcf_dict)
-  for chrom in vcf_dict:
-    vcf_dict[chrom] = sorted(vcf_dict[chrom], reverse=True)
-
-  msg = 'Adapting reference sequence in %s' % fasta_in_path
-  util.info(msg)
+  msg = 'Adapting reference sequence in %s with {:,} variations within {} segments'.format(n_var, len(vcf_dict))
+  util.info(msg % fasta_in_path)
   
-  with util.open_file(fasta_in_path) as file_obj:
-    inp_seqs = util.read_fasta(file_obj) # Chromo/contig_names must match
-    inp_seqs.reverse() 
-    out_seqs = []
-    
-    while inp_seqs:
-      seq_id, seq = inp_seqs.pop()
-      seq_vars = vcf_dict.get(seq_id, [])
-      seq = list(seq)
-      
-      for i, ref_seq, alt_seq in seq_vars: # Last processed first
-        n = len(ref_seq)
-        seq[i:i+len(ref_seq)] = alt_seq
-      
-      seq = ''.join(seq)
-      out_seqs.append((seq_id, seq))
-      
-    util.write_fasta(fasta_out_path, out_seqs)
+  with open(fasta_out_path, 'wb') as out_file_obj:
+    for seq_id, seq in fasta.iter_fasta_arrays(fasta_in_path): # Chromo/contig_names must match
+      seq = apply_seq_variants(seq, vcf_dict.pop(seq_id, []))
+      fasta.write_fasta_seq(out_file_obj, seq_id, seq)
       
       
 def nuc_adapt(genome_fasta_path, hic_bam_paths, vcf_path, fasta_out_path=None,
@@ -209,7 +367,7 @@ def nuc_adapt(genome_fasta_path, hic_bam_paths, vcf_path, fasta_out_path=None,
   # In future maybe do the clipping and genome mapping - get this code from NucProcess
   # Mapped reads should initially have been clipped at Hi-C ligation junction (separate ends)
   
-  from nuc_tools import util, core, parallel
+  from nuc_tools import util, parallel
   
   if not num_cpu:
     num_cpu = parallel.MAX_CORES
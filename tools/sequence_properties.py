@@ -9,94 +9,117 @@ DEFAULT_BIN_SIZE = 1000
 MIN_KNOWN = 20
 REP_WINDOW = 10
 DEFAULT_SMALLEST_CONTIG = 100
+BLOCK_CODES = 2**22 # Max. bases, or bins x triplet codes, counted together; limits memory use
 
-def sequence_properties(fastq_paths, out_path_root=None, bin_size=DEFAULT_BIN_SIZE, min_seq_len=DEFAULT_SMALLEST_CONTIG*1000):
+def get_seq_properties(seq, bin_size):
+  """
+  For a whole sequence, given as a uint8 array of upper case bases, get the per-bin GC fraction
+  of the known bases, the N fraction and the triplet entropy, relative to a uniform distribution
+  of the triplets observed in the bin. Bases are coded as small integers so that the triplets of
+  many bins are counted together.
+  """
+  
+  n = len(seq)
+  n_bins = int(math.ceil(n/float(bin_size)))
+  
+  gcat_hist = np.zeros(n_bins)
+  nn_hist = np.zeros(n_bins)
+  rep_hist = np.zeros(n_bins)
+  
+  if bin_size < MIN_KNOWN:
+    return gcat_hist, nn_hist, rep_hist
+  
+  # Codes 0-4 are GCATN, then any other symbols, then padding of the last bin
+  
+  symbols = [ord(x) for x in 'GCATN']
+  symbols += [x for x in np.flatnonzero(np.bincount(seq, minlength=256)) if x not in symbols]
+  n_sym = len(symbols) + 1
+  pad = n_sym-1
+  n_codes = n_sym ** 3
+  
+  code_table = np.full(256, pad, np.uint16)
+  code_table[symbols] = np.arange(len(symbols))
+  
+  bins_per_block = max(1, BLOCK_CODES // max(n_codes, bin_size))
+  
+  for b0 in range(0, n_bins, bins_per_block):
+    b1 = min(n_bins, b0+bins_per_block)
+    nb = b1-b0
+    
+    codes = np.full(nb * bin_size, pad, np.uint16)
+    sub_seq = seq[b0*bin_size:b1*bin_size]
+    codes[:len(sub_seq)] = code_table[sub_seq]
+    codes = codes.reshape(nb, bin_size)
+    
+    # Single bases
+    
+    nn = np.count_nonzero(codes == 4, axis=1)
+    gc = np.count_nonzero(codes < 2, axis=1)
+    
+    # Triplets within each bin, excluding those starting with N or including padding
+    
+    first = codes[:,:-2].astype(np.int64)
+    trips = (first * n_sym + codes[:,1:-1]) * n_sym + codes[:,2:]
+    trips += np.arange(nb)[:,None] * n_codes
+    valid = (first != 4) & (codes[:,2:] != pad)
+    
+    counts = np.bincount(trips[valid], minlength=nb*n_codes).reshape(nb, n_codes)
+    n_trips = counts.sum(axis=1)
+    n_kinds = np.count_nonzero(counts, axis=1)
+    sum_c_log_c = (counts * np.log(np.maximum(counts, 1))).sum(axis=1)
+    
+    # Bins with too few known bases are unset
+    
+    known = (bin_size - nn >= MIN_KNOWN)
+    
+    sizes = np.full(nb, bin_size)
+    
+    if b1 == n_bins:
+      sizes[-1] = n - (n_bins-1) * bin_size
+    
+    has_trips = (sizes >= MIN_KNOWN) & (n_trips > 0)
+    n_trips = np.maximum(n_trips, 1)
+    
+    nn_hist[b0:b1] = np.where(sizes >= MIN_KNOWN, nn/float(bin_size), 0.0)
+    rep_hist[b0:b1] = np.where(has_trips, np.log(np.maximum(n_kinds, 1)) - np.log(n_trips) + sum_c_log_c/n_trips, 0.0)
+    gcat_hist[b0:b1] = np.where(has_trips & known, gc/np.maximum(bin_size - nn, 1.0), 0.0)
+  
+  return gcat_hist, nn_hist, rep_hist
+  
+  
+def sequence_properties(fastq_paths, out_path_root=None, bin_size=DEFAULT_BIN_SIZE,
+                        min_seq_len=DEFAULT_SMALLEST_CONTIG*1000, num_cpu=None):
   
   from formats import fasta, bed
-  from nuc_tools import util, io
+  from nuc_tools import util, io, parallel
     
   if out_path_root:
     out_path_root = os.path.splitext(out_path_root)[0]
   else:
     out_path_root = os.path.splitext(fastq_paths[0])[0]
   
+  num_cpu = num_cpu or parallel.MAX_CORES
+  bin_size = int(bin_size)
   gcat_data = {}
   nn_data = {}
   rep_data = {}
   total = 0
   
-  r_idx = {r:i for i, r in enumerate('GCATN')}
-  
-  rep_step = int(REP_WINDOW/2)
-  rep_frac = 1.0/REP_WINDOW
-  probs_init = np.zeros(5, float)
-  prior = np.full(5, 0.2)
-  
-  G = ord('G')
-  C = ord('C')
-  A = ord('A')
-  T = ord('T')
-  N = ord('N')
-  
-  from scipy.stats import entropy
-  
-  unique = np.unique
-  ones = np.ones
-  column_stack = np.column_stack
-  
   for fastq_path in fastq_paths:
     util.info('Reading {}'.format(fastq_path))
-    seq_dict = fasta.read_fasta(fastq_path, as_array=True)
-  
-    for seq_name, seq in seq_dict.items():
-      n = len(seq)
-      if n < min_seq_len:
-        continue
-      
+    seqs = fasta.iter_fasta_arrays(fastq_path, min_seq_len) # One at a time
+    seq_names = []
+    
+    def seq_iter():
+      for seq_name, seq in seqs:
+        seq_names.append((seq_name, len(seq)))
+        util.info(' .. analysing {} over {:,} bp'.format(seq_name, len(seq)), line_return=True)
+        yield seq
+    
+    for k, (gcat_hist, nn_hist, rep_hist) in enumerate(parallel.stream(get_seq_properties, seq_iter(), (bin_size,),
+                                                                       num_cpu=num_cpu, max_pending=num_cpu)):
+      seq_name, n = seq_names[k]
       total += n
-      util.info(' .. analysing {} over {:,} bp'.format(seq_name, n), line_return=True)
-      n_bins = int(math.ceil(n/float(bin_size)))
-
-      gcat_hist = np.zeros(n_bins)
-      nn_hist = np.zeros(n_bins)
-      rep_hist = np.zeros(n_bins)
-  
-      for i in range(n_bins):
-        p1 = i*bin_size
-        p2 = min(p1 + bin_size, n)
-        sub_seq = seq[p1:p2]
-        
-        if len(sub_seq) < MIN_KNOWN:
-          continue
-        
-        uniq, counts = unique(sub_seq, return_counts=True)
-        count_dict = dict(zip(uniq, counts))
-        
-        nn = count_dict.get(N, 0)
-        nn_hist[i] = nn/float(bin_size)
-        
-        triples = column_stack([sub_seq[:-2], sub_seq[1:-1], sub_seq[2:]])
-        triples = triples[(triples != [N,N,N])[:,0]]
-         
-        if len(triples) < 1:
-          continue
-       
-        uniq, counts = unique(triples, axis=0, return_counts=True)
-
-        rep_hist[i] = entropy(counts, ones(len(counts)))
-        
-        if bin_size-nn < MIN_KNOWN:
-          continue
-        
-        gc = count_dict.get(G, 0) + count_dict.get(C, 0)
-        tt = bin_size-nn
-        if gc and tt:
-          ratio = gc/float(tt)
-        elif gc:
-          ratio = 0.0
-            
-        gcat_hist[i] = ratio
-      
       gcat_data[seq_name] = util.hist_to_data_track(gcat_hist, bin_size)
       nn_data[seq_name] = util.hist_to_data_track(nn_hist, bin_size)
       rep_data[seq_name] = util.hist_to_data_track(rep_hist, bin_size)
@@ -156,6 +179,9 @@ def main(argv=None):
 
   arg_parse.add_argument('-m', default=DEFAULT_SMALLEST_CONTIG, metavar='MIN_CONTIG_SIZE', type=int,
                          help='The minimum chromosome/contig sequence length in kilobases for inclusion. Default is {}.'.format(DEFAULT_SMALLEST_CONTIG))
+
+  arg_parse.add_argument('-n', '--num-cpu', default=0, metavar='CPU_COUNT', dest='n', type=int,
+                         help='Number of CPU cores to use in parallel, for different chromosomes/sequences. Defaults to all available.')
  
  
   args = vars(arg_parse.parse_args(argv))
@@ -164,11 +190,12 @@ def main(argv=None):
   out_path_root = args['o']
   bin_size = args['s']
   min_seq_len = args['m'] * 1000
+  num_cpu = args['n'] or None
   
   for fasta_path in fasta_paths:
     io.check_invalid_file(fasta_path)  
   
-  sequence_properties(fasta_paths, out_path_root, bin_size, min_seq_len)
+  sequence_properties(fasta_paths, out_path_root, bin_size, min_seq_len, num_cpu)
   
 
 if __name__ == "__main__":
@@ -86,14 +86,12 @@ def plot_structure_compare(seq_pos_dict1, coords_dict1, struc_label1,
   rmsd_mat = np.zeros((n_models, n_models))
   
   for i in range(n_models-1):
-    for j in range(i+1, n_models):
-       coords_a, coords_b = util.align_coord_pair(coord_models[i], coord_models[j], 10.0)
-       #coords_a, coords_b = util.align_coord_pair(coords_a, coords_b)
-       
-       model_rmsds, particle_rmsds = util.calc_rmsds(coords_a, [coords_b])
-       rmsd = model_rmsds[0]
-       rmsd_mat[i, j] = rmsd
-       rmsd_mat[j, i] = rmsd
+    # All later models aligned to this one at once
+    coords_a, coords_b = util.align_coord_batch(coord_models[i], coord_models[i+1:], 10.0)
+    
+    model_rmsds, particle_rmsds = util.calc_rmsds(coords_a, coords_b)
+    rmsd_mat[i, i+1:] = model_rmsds
+    rmsd_mat[i+1:, i] = model_rmsds
 
   
   mean_rmsd = rmsd_mat[:n_models1,n_models1:].mean()
@@ -8,7 +8,7 @@ from os.path import dirname
 from matplotlib import pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib.colors import LinearSegmentedColormap, ListedColormap, LogNorm, Colormap
-from scipy import stats
+from scipy import stats, sparse
 from scipy.cluster import hierarchy
 from scipy.spatial import distance
 
@@ -27,6 +27,7 @@ DENSITY_KEY = '_DENSITY_'
 PDF_DPI = 200
 NUM_BOOTSTRAP = 100
 DEFAULT_OFFSET_NULL = 5
+PAIR_BLOCK_SIZE = 2**18 # Particle pairs per block when calculating distances over all models
 
 DENS_OBS = 'observed data'
 DENS_ALL = 'all sites'
@@ -38,25 +39,59 @@ DENS_KEYS = (DENS_OBS, DENS_ALL, DENS_SHU, DENS_OFF, DENS_USR)
 MAX_CPU = multiprocessing.cpu_count()
 
 
-def _run_dens_calc(d_mat, vals, num_cpu=MAX_CPU):
+def _dens_calc_job(idx, data_handle, indices_handle, indptr_handle, w_handle, out_handle):
+  
+  from core.nuc_parallel import get_shared_array
+  
+  a, b = idx
+  indptr = get_shared_array(indptr_handle)[a:b+1]
+  s, e = indptr[0], indptr[-1]
+  weights = get_shared_array(w_handle)
+  
+  # Rows of the sparse density matrix; each test site's local density (wrt all data sites) multiplied by the data site values 
+  # Weights may have a column for each of several data tracks
+  d_rows = sparse.csr_matrix((get_shared_array(data_handle)[s:e], get_shared_array(indices_handle)[s:e], indptr-s),
+                             shape=(b-a, weights.shape[0]))
+  get_shared_array(out_handle)[a:b] = d_rows.dot(weights)
 
-  from core.nuc_parallel import run
+
+def _get_site_weights(n_sites, data_idx, vals):
+  
+  weights = np.zeros(n_sites, vals.dtype)
+  weights[data_idx] = vals # Only where test data is present
+  
+  return weights
   
-  weights = vals[None,:] # Size 1 first dim for broadcasting
   
-  def _job(idx):
-    a, b = idx
-    return (d_mat[a:b] * weights).sum(axis=1) # For each test site multiply individual local density (wrt all data sites) by unversal data site values 
+def _run_dens_calc(d_mat, weights, num_cpu=MAX_CPU):
+  
+  from core import nuc_parallel as parallel
   
   n, m = d_mat.shape
+  weights = weights.astype(np.result_type(d_mat.dtype, weights.dtype))
   
-  split_idx = np.linspace(0, n, num_cpu+1).astype(int)
-
-  job_data = [(split_idx[i], split_idx[i+1]) for i in range(num_cpu)]
+  if num_cpu < 2:
+    return d_mat.dot(weights)
+  
+  # Sparse matrix arrays are placed in shared memory for the worker processes
+  handles = [parallel.share_array(x)[0] for x in (d_mat.data, d_mat.indices, d_mat.indptr, weights)]
+  out_handle, out_shared = parallel.share_array(shape=(n,)+weights.shape[1:], dtype=weights.dtype)
   
-  results = run(_job, job_data, num_cpu=num_cpu, verbose=False)
+  n_jobs = min(n, num_cpu * parallel.CHUNKS_PER_CORE)
+  split_idx = np.linspace(0, n, n_jobs+1).astype(int)
+  job_data = [(split_idx[i], split_idx[i+1]) for i in range(n_jobs)]
   
-  return np.concatenate(results)
+  try:
+    parallel.run(_dens_calc_job, job_data, handles + [out_handle], num_cpu=num_cpu, verbose=False)
+    densities = np.array(out_shared)
+  
+  finally:
+    del out_shared
+    
+    for handle in handles + [out_handle]:
+      parallel.free_shared_array(handle)
+    
+  return densities
         
         
 def get_data_density(d_mat, chromo_limits, data_bed_path, bin_size, num_cpu):
@@ -96,26 +131,16 @@ def get_data_density(d_mat, chromo_limits, data_bed_path, bin_size, num_cpu):
   data_values = np.concatenate(data_values, axis=0)
   data_idx = np.concatenate(data_idx, axis=0)
 
-  densities = _run_dens_calc(d_mat[:,data_idx], data_values, num_cpu) # densities at all sites
+  weights = _get_site_weights(d_mat.shape[1], data_idx, data_values)
+  densities = _run_dens_calc(d_mat, weights, num_cpu) # densities at all sites
   densities /= densities.sum()
   
   return densities
   
   
-def get_point_density(d_mat, anch_idx, off_idx, user_idx, data_idx, data_values, num_cpu=MAX_CPU):
-  
-  from core.nuc_parallel import run
+def get_point_density(densities, anch_idx, off_idx, user_idx):
   
-  # First dim is obs or null sites
-  # Second dim is data sites
- 
-  #t0 = time()
- 
-  na, nb = d_mat.shape
-  
-  d_mat = d_mat[:,data_idx]  # Only where test data is present
-  
-  densities = _run_dens_calc(d_mat, data_values, num_cpu)
+  # Densities are for all sites wrt the data sites and values
  
   dens_dict = {}
   
@@ -127,7 +152,6 @@ def get_point_density(d_mat, anch_idx, off_idx, user_idx, data_idx, data_values,
   
   # A points vs B points with shuffled B values
   #dens_dict[DENS_SHU] = (d_mat[anch_idx] * w_mat2).sum(axis=1)
-  #dens_dict[DENS_SHU] = _run_dens_calc(d_mat[anch_idx], shuff_data_values)
   
   # Offset (from A) points vs B  
   dens_dict[DENS_OFF] = densities[off_idx]
@@ -136,10 +160,8 @@ def get_point_density(d_mat, anch_idx, off_idx, user_idx, data_idx, data_values,
   if len(user_idx):
     dens_dict[DENS_USR] = densities[user_idx]
   
-  #print 'TT: %.3f' % (time()-t0)
-  
   return dens_dict
-
+  
 
 def get_density_matrix(n3d_path, radius, min_seq_sep, power):
   
@@ -165,7 +187,6 @@ def get_density_matrix(n3d_path, radius, min_seq_sep, power):
   seq_pos = np.concatenate([seq_pos_dict[c] for c in chromos], axis=0)
   chr_idx = np.concatenate([np.full(len(seq_pos_dict[c]), chr_idx[c], int) for c in chromos], axis=0)
   n_models, n_coords, n_dim = coords.shape
-  d_mat = np.zeros((n_coords, n_coords), 'float32')
   
   # Get points where mean coord is within bounds  
   kdtree = cKDTree(coords.mean(axis=0))
@@ -176,113 +197,111 @@ def get_density_matrix(n3d_path, radius, min_seq_sep, power):
   valid = (chr_idx[idx_a] != chr_idx[idx_b]) | (np.abs(seq_pos[idx_a]-seq_pos[idx_b]) >= min_seq_sep)
   idx_a = idx_a[valid]
   idx_b = idx_b[valid]
+  n_pairs = len(idx_a)
+  dens = np.zeros(n_pairs, 'float32')
   
-  # Average of densities over all models
-  for i in range(n_models):    
-    util.info('  .. distance matrix for model %d' % i, line_return=True)     
-    p1 = coords[i, idx_a]
-    p2 = coords[i, idx_b]
+  # Average of densities over all models, for blocks of pairs
+  for i in range(0, n_pairs, PAIR_BLOCK_SIZE):
+    util.info('  .. distance matrix for pairs {:,} of {:,}'.format(min(i+PAIR_BLOCK_SIZE, n_pairs), n_pairs), line_return=True)     
+    j = i + PAIR_BLOCK_SIZE
     
-    d = p1-p2
-    d = (d*d).sum(axis=1)
+    d = coords[:, idx_a[i:j]] - coords[:, idx_b[i:j]]
+    d = (d*d).sum(axis=2)
     d[d < 1.0] = 1.0
     d **= (-power/2.0)
-    d_mat[idx_a, idx_b] += d/float(n_models)
+    dens[i:j] = d.mean(axis=0)
+  
+  # Only pairs within the radius are non-zero
+  d_mat = sparse.csr_matrix((dens, (idx_a, idx_b)), shape=(n_coords, n_coords))
   
   return d_mat, chromo_limits
 
 
-def get_pde(dens_mat, chromo_limits, anchor_bed_path, density_bed_path,
-            bin_size, null_bed, null_offset, num_cpu):
+def get_track_matrix(bed_paths, chromo_limits, bin_size, unit_values=False):
   """
+  Load and bin data tracks over the universal chromosome limits, once for all structures.
+  Returns a matrix with a column for each track and a row for each bin of the sorted chromosomes,
+  and the first row of each chromosome. If unit_values is set, regions are counted.
   """
-  from formats import n3d, bed
+  
+  from formats import bed
   from nuc_tools import util
-  from matplotlib import pyplot as plt
   
-  # # # particle_size must be checked to be same in all structures
-  # # # null hypothesis could include a max seq sep 
+  chromo_offsets = {}
+  n_bins = 0
   
-  anch_regions, anch_values = bed.load_bed_data_track(anchor_bed_path)[:2]
+  for chromo in sorted(chromo_limits):
+    start, end = chromo_limits[chromo]
+    chromo_offsets[chromo] = n_bins
+    n_bins += 1 + int(end/bin_size) - int(start/bin_size)
   
-  if anchor_bed_path == density_bed_path:
-    data_regions, data_values = anch_regions, anch_values
-  else:
-    data_regions, data_values = bed.load_bed_data_track(density_bed_path)[:2]
+  track_mat = np.zeros((n_bins, len(bed_paths)), 'float32')
   
-  if null_bed:
-    null_regions, null_values = bed.load_bed_data_track(null_bed)[:2]
-  else:
-    null_regions = None
+  chromos = sorted(chromo_offsets)
+  starts, ends = zip(*[chromo_limits[chromo] for chromo in chromos])
   
-  chromos = sorted(chromo_limits)
-      
-  # Get binned data track values over universal/max extent chromosome
+  for j, bed_path in enumerate(bed_paths):
+    regions, values = bed.load_bed_data_track(bed_path)[:2]
+    regions_list = [regions.get(chromo, []) for chromo in chromos]
+    
+    if unit_values:
+      values_list = [np.ones(len(x)) for x in regions_list]
+    else:
+      values_list = [values.get(chromo, []) for chromo in chromos]
+    
+    # All chromosomes binned together
+    hists = util.bin_region_values_multi(regions_list, values_list, bin_size, starts, ends)
+    track_mat[:,j] = np.concatenate(hists)
   
-  data_hists = {}
-  anch_hists = {}
-  null_hists = {}
+  return track_mat, chromo_offsets
   
-  # Structures can have a different regions
   
-  for chromo in chromo_limits:
-    start, end = chromo_limits[chromo]
-    data_hists[chromo] = util.bin_region_values(data_regions[chromo], data_values[chromo],
-                                           bin_size, start, end)
-    
-    hist = data_values[chromo]
-    anch_hists[chromo] = util.bin_region_values(anch_regions[chromo], anch_values[chromo],
-                                           bin_size, start, end)
-    
-    if null_regions:
-      null_hists[chromo] = util.bin_region_values(null_regions[chromo], np.ones(len(null_regions[chromo])),
-                                             bin_size, start, end)
-                               
-  # Get flat arrays for all particles from separate chromosomes
-
-  user_idx = []
-  anch_idx = []
-  data_idx = []
-  data_values = []
-  #anch_values = []
+def get_structure_rows(struc_chromo_limits, chromo_limits, chromo_offsets, bin_size):
+  """
+  Rows of a universal track matrix that correspond to the particles of a structure,
+  for the structure's sorted chromosomes as in its density matrix.
+  """
   
-  # Get flat arrays of track data, using same regions as particle arrays
-  a = 0
-  b = 0
-  c = 0
-  for chromo in chromos:    
-    hist = data_hists[chromo]
-    idx  = hist.nonzero()[0]
-    data_values.append( hist[idx] )
-    data_idx.append(a + idx)
-    a += len(hist)
-    
-    hist2 = anch_hists[chromo]
-    idx2 = hist2.nonzero()[0]
-    anch_idx.append(b +  idx2)
-    b += len(hist2)
-    
-    if null_regions:
-      hist3 = null_hists[chromo]
-      idx3 = hist3.nonzero()[0]
-      user_idx.append(c +  idx3)
-      c += len(hist3)
-    
-  data_values = np.concatenate(data_values, axis=0)
-  anch_idx = np.concatenate(anch_idx, axis=0)
-  data_idx = np.concatenate(data_idx, axis=0)
+  rows = []
   
-  #shuff_data_values = data_values[:]
-  #np.random.shuffle(shuff_data_values)
-
-  dens_dict = {}
-  if null_regions:
-    user_idx = np.concatenate(user_idx, axis=0)
-
-  off_idx = np.clip(np.unique(np.concatenate([anch_idx+null_offset, anch_idx-null_offset, anch_idx+null_offset-1, anch_idx-null_offset+1], axis=0)), 0, len(dens_mat)-1)
-  dens_dict = get_point_density(dens_mat, anch_idx, off_idx, user_idx, data_idx, data_values, num_cpu)      
+  for chromo in sorted(struc_chromo_limits):
+    start, end = struc_chromo_limits[chromo]
+    a = chromo_offsets[chromo] + int(start/bin_size) - int(chromo_limits[chromo][0]/bin_size)
+    rows.append(a + np.arange(1 + int(end/bin_size) - int(start/bin_size)))
+  
+  return np.concatenate(rows, axis=0)
+  
+  
+def get_pde(dens_mat, struc_rows, track_mat, null_vec, null_offset, num_cpu):
+  """
+  Point density enrichment data for one structure and all pairs of anchor and data tracks,
+  given the rows of universal, binned track and null site matrices for the structure's particles.
+  Densities for all data tracks are calculated together. Returns a dictionary of density
+  dictionaries keyed by (anchor, data) track indices.
+  """
+  
+  track_mat = track_mat[struc_rows]
+  n_sites, n_tracks = track_mat.shape
+  
+  # Densities at all sites for each data track
+  densities = _run_dens_calc(dens_mat, track_mat, num_cpu)
+  densities = [np.ascontiguousarray(densities[:,col]) for col in range(n_tracks)]
+  
+  if null_vec is not None:
+    user_idx = null_vec[struc_rows].nonzero()[0]
+  else:
+    user_idx = []
+  
+  pde_dicts = {}
+  
+  for row in range(n_tracks):
+    anch_idx = track_mat[:,row].nonzero()[0]
+    off_idx = np.clip(np.unique(np.concatenate([anch_idx+null_offset, anch_idx-null_offset, anch_idx+null_offset-1, anch_idx-null_offset+1], axis=0)), 0, n_sites-1)
+    
+    for col in range(n_tracks):
+      pde_dicts[(row, col)] = get_point_density(densities[col], anch_idx, off_idx, user_idx)
 
-  return dens_dict
+  return pde_dicts
     
     
 def overlap_plot(density_dict, data_labels, pdf=None, cmap='Blues', split_idx=None, is_primary=True, n_bins=100):
@@ -1002,6 +1021,15 @@ def structure_data_density(struc_paths1, struc_paths2, data_tracks, data_labels=
 
   min_seq_sep = min_sep * bin_size
   n_tracks = len(data_tracks)
+  
+  util.info('Binning data tracks')
+  track_mat, chromo_offsets = get_track_matrix(data_tracks, chromo_limits, bin_size)
+  
+  if null_bed:
+    null_vec = get_track_matrix([null_bed], chromo_limits, bin_size, unit_values=True)[0][:,0]
+  else:
+    null_vec = None
+  
   dens_dicts = {k:defaultdict(list) for k in DENS_KEYS}
   
   data_density = defaultdict(list)
@@ -1014,12 +1042,18 @@ def structure_data_density(struc_paths1, struc_paths2, data_tracks, data_labels=
       cache_file = os.path.join(cache_dir, n3d_root + '_sd.npz')
       
       if os.path.exists(cache_file):
-        file_dict = np.load(cache_file)
+        file_dict = np.load(cache_file, allow_pickle=True)
         struc_chromo_lims = {}
         
         for key in file_dict:
           if key == DENSITY_KEY:
             dens_mat = file_dict[key]
+            
+            if dens_mat.dtype == object: # Sparse
+              dens_mat = dens_mat[()]
+            else: # Older dense cache
+              dens_mat = sparse.csr_matrix(dens_mat)
+            
           else:
             struc_chromo_lims[key] = file_dict[key]
         
@@ -1042,21 +1076,15 @@ def structure_data_density(struc_paths1, struc_paths2, data_tracks, data_labels=
       data_density[i].append(densties)
       
     """
-    for row, anchor_bed_path in enumerate(data_tracks): # Anchor
-      util.info('  Considering {}'.format(os.path.basename(anchor_bed_path)))
-      bed_root1 = io.get_file_root(anchor_bed_path)
-      
-      for col, density_bed_path in enumerate(data_tracks): # Data
-        data_key = row, col
-        util.info('  .. compared to {}'.format(os.path.basename(density_bed_path)), line_return=True)
-        bed_root2 = io.get_file_root(density_bed_path)
- 
-        pde_dict = get_pde(dens_mat, struc_chromo_lims,
-                           anchor_bed_path, density_bed_path,
-                           bin_size, null_bed, null_offset, num_cpu)
+    util.info('  Calculating densities for {} data tracks'.format(n_tracks))
+    struc_rows = get_structure_rows(struc_chromo_lims, chromo_limits, chromo_offsets, bin_size)
+    pde_dicts = get_pde(dens_mat, struc_rows, track_mat, null_vec, null_offset, num_cpu)
+    
+    for data_key in sorted(pde_dicts): # (Anchor, data) track indices
+      pde_dict = pde_dicts[data_key]
  
-        for typ_key in pde_dict:
-          dens_dicts[typ_key][data_key].append(pde_dict[typ_key])
+      for typ_key in pde_dict:
+        dens_dicts[typ_key][data_key].append(pde_dict[typ_key])
     
   struc_labels = [os.path.basename(os.path.splitext(path)[0]) for path in struc_paths1+struc_paths2]
   